@@ -1,16 +1,51 @@
 """
 Admin Sessions Lambda Function
 Handles admin queries for all user sessions.
+
+Listings are cursor-paginated, newest first: each status is queried on
+StatusCreatedIndex (status + created_at) and the per-status results are
+k-way merged, so every page costs at most one bounded query per status.
+A student_id listing is one bounded query on StudentCreatedIndex
+(student_id + created_at), or on the session archive when one is
+configured. Stats come from the stream-maintained statistics store (STATS_TABLE).
+Searches still scan.
 """
+import base64
+import heapq
+import itertools
 import json
 import os
+import sys
 import boto3
 from boto3.dynamodb.conditions import Key, Attr
 from decimal import Decimal
 import time
 
+# Add common layer to path
+sys.path.insert(0, "/opt/python")
+
+from utils import (
+    DynamoDBClient,
+    SessionStatsStore,
+    SessionStatus,
+    get_session_archive,
+    query_session_history_page,
+)
+
 dynamodb = boto3.resource('dynamodb')
 sessions_table = dynamodb.Table(os.environ['SESSIONS_TABLE_NAME'])
+STATS_TABLE = os.environ.get('STATS_TABLE', '')
+
+# Statuses merged for status=all
+LIST_STATUSES = [
+    SessionStatus.PENDING,
+    SessionStatus.PROVISIONING,
+    SessionStatus.READY,
+    SessionStatus.ACTIVE,
+    SessionStatus.TERMINATING,
+    SessionStatus.TERMINATED,
+    SessionStatus.ERROR,
+]
 
 
 def lambda_handler(event, context):
@@ -21,13 +56,41 @@ def lambda_handler(event, context):
     - status: Filter by status (all, active, ready, provisioning, terminated)
     - search: Search by student_id or session_id
     - limit: Maximum number of results (default: 200)
+    - cursor: next_cursor from the previous page
+    - student_id: List only this student's sessions
+    - view: "recent" to read the stats store's recent-sessions view instead
     """
     try:
         # Extract query parameters
         params = event.get('queryStringParameters', {}) or {}
         status_filter = params.get('status', 'all')
         search_query = params.get('search', '').lower()
-        limit = int(params.get('limit', '200'))
+        limit = max(1, min(int(params.get('limit', '200')), 1000))
+        cursor = params.get('cursor')
+        student_id = params.get('student_id')
+        status = status_filter if status_filter and status_filter != 'all' else None
+        
+        if not search_query:
+            store = SessionStatsStore(STATS_TABLE) if STATS_TABLE else None
+            
+            if student_id:
+                sessions_db = DynamoDBClient(os.environ['SESSIONS_TABLE_NAME'])
+                try:
+                    sessions, next_cursor = query_session_history_page(
+                        sessions_db, get_session_archive(), student_id, limit, status, cursor=cursor
+                    )
+                except ValueError:
+                    return error_response(400, 'Invalid cursor')
+            elif store and params.get('view') == 'recent':
+                sessions, next_cursor = store.recent_sessions(limit=limit, status=status), None
+            else:
+                try:
+                    sessions, next_cursor = list_sessions_page(status, limit, cursor)
+                except ValueError:
+                    return error_response(400, 'Invalid cursor')
+            
+            stats = stats_from_counters(store.get_counters()) if store else calculate_stats(sessions)
+            return build_response(sessions, stats, next_cursor)
         
         # Scan the sessions table
         scan_params = {
@@ -64,24 +127,7 @@ def lambda_handler(event, context):
         # Calculate statistics
         stats = calculate_stats(sessions)
         
-        # Convert Decimals to native Python types for JSON serialization
-        sessions = json.loads(json.dumps(sessions, default=decimal_default))
-        
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({
-                'success': True,
-                'data': {
-                    'sessions': sessions,
-                    'stats': stats,
-                    'total_returned': len(sessions)
-                }
-            })
-        }
+        return build_response(sessions, stats)
         
     except Exception as e:
         print(f"Error: {str(e)}")
@@ -102,6 +148,142 @@ def lambda_handler(event, context):
         }
 
 
+def encode_cursor(session, status):
+    """Opaque cursor pointing just past `session` in (created_at, session_id) order."""
+    position = {'c': int(session.get('created_at', 0)), 'id': session['session_id'], 's': status or 'all'}
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, status):
+    """Return the (created_at, session_id) boundary of a cursor; ValueError if invalid."""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        boundary = (int(position['c']), str(position['id']))
+    except (TypeError, KeyError, ValueError) as e:
+        raise ValueError(f'Malformed cursor: {e}')
+    if position.get('s') != (status or 'all'):
+        raise ValueError('Cursor belongs to a different status filter')
+    return boundary
+
+
+def sort_key(session):
+    return (int(session.get('created_at', 0)), session.get('session_id', ''))
+
+
+def iter_status_newest_first(sessions_db, status, boundary, page_size):
+    """
+    Yield one status's sessions strictly older than `boundary`, newest first.
+    
+    The index orders by created_at only, so sessions sharing a created_at are
+    re-sorted by session_id to give the merge a total order.
+    """
+    key_condition = Key('status').eq(status)
+    if boundary:
+        key_condition = key_condition & Key('created_at').lte(boundary[0])
+    
+    items = sessions_db.iter_query(
+        key_condition,
+        index_name='StatusCreatedIndex',
+        page_size=page_size,
+        scan_forward=False,
+        strict=True,
+    )
+    for _, ties in itertools.groupby(items, key=lambda s: int(s.get('created_at', 0))):
+        for session in sorted(ties, key=sort_key, reverse=True):
+            if boundary is None or sort_key(session) < boundary:
+                yield session
+
+
+def list_sessions_page(status, limit, cursor=None):
+    """
+    Return (sessions, next_cursor) for one page, newest first.
+    
+    Each status is read lazily from StatusCreatedIndex and the streams are
+    k-way merged, so a page reads about `limit` items per status at most.
+    """
+    boundary = decode_cursor(cursor, status) if cursor else None
+    sessions_db = DynamoDBClient(os.environ['SESSIONS_TABLE_NAME'])
+    statuses = [status] if status else LIST_STATUSES
+    
+    merged = heapq.merge(
+        *[iter_status_newest_first(sessions_db, s, boundary, limit + 1) for s in statuses],
+        key=sort_key,
+        reverse=True,
+    )
+    page = list(itertools.islice(merged, limit + 1))
+    
+    next_cursor = encode_cursor(page[limit - 1], status) if len(page) > limit else None
+    return page[:limit], next_cursor
+
+
+def error_response(status_code, message):
+    return {
+        'statusCode': status_code,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps({
+            'success': False,
+            'error': message
+        })
+    }
+
+
+def build_response(sessions, stats, next_cursor=None):
+    """Build the API response for a list of sessions and their stats."""
+    # Convert Decimals to native Python types for JSON serialization
+    sessions = json.loads(json.dumps(sessions, default=decimal_default))
+    
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps({
+            'success': True,
+            'data': {
+                'sessions': sessions,
+                'stats': stats,
+                'total_returned': len(sessions),
+                'next_cursor': next_cursor
+            }
+        })
+    }
+
+
+def stats_from_counters(counters):
+    """Build dashboard statistics from the stats store's counter items."""
+    empty = {'total': 0, 'by_status': {}}
+    sessions = counters.get('sessions', empty)
+    pool = counters.get('pool', empty)
+    by_status = sessions['by_status']
+    
+    return {
+        'total_sessions': sessions['total'],
+        'active_count': by_status.get('active', 0),
+        'ready_count': by_status.get('ready', 0),
+        'provisioning_count': by_status.get('provisioning', 0),
+        'terminated_count': by_status.get('terminated', 0),
+        'error_count': by_status.get('error', 0),
+        # Starting instances are already assigned to a session
+        'instances_in_use': pool['by_status'].get('assigned', 0) + pool['by_status'].get('starting', 0),
+        'total_instances': pool['total'],
+        'by_plan': {
+            sk.split('#plan#', 1)[1]: counter['by_status']
+            for sk, counter in counters.items() if sk.startswith('sessions#plan#')
+        },
+        'pool': {
+            'by_status': pool['by_status'],
+            'by_plan': {
+                sk.split('#plan#', 1)[1]: counter['by_status']
+                for sk, counter in counters.items() if sk.startswith('pool#plan#')
+            },
+        },
+    }
+
+
 def calculate_stats(sessions):
     """Calculate session statistics."""
     stats = {
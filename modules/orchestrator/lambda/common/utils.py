@@ -2,14 +2,29 @@
 Common utilities for CyberLab Orchestrator Lambda functions.
 """
 
+import abc
+import base64
+import csv
+import hashlib
+import heapq
+import http.client
+import io
 import json
 import logging
+import math
 import os
+import random
+import socket
+import ssl
+import threading
 import time
+import urllib.parse
 import uuid
+from collections import deque
+from collections.abc import Mapping
 from datetime import datetime, timezone
 from decimal import Decimal
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 import boto3
 from boto3.dynamodb.conditions import Key, Attr
@@ -23,6 +38,17 @@ logger.setLevel(logging.INFO)
 PROJECT_NAME = os.environ.get("PROJECT_NAME", "cyberlab")
 ENVIRONMENT = os.environ.get("ENVIRONMENT", "dev")
 AWS_REGION = os.environ.get("AWS_REGION_NAME", "us-east-1")
+# Optional shared key/value table (hash key "cache_key", TTL on "expires_at")
+CACHE_TABLE = os.environ.get("CACHE_TABLE", "")
+# How long a Guacamole admin token is reused. Guacamole expires tokens after
+# 60 minutes of inactivity by default, so stay well inside that.
+GUACAMOLE_TOKEN_TTL = int(os.environ.get("GUACAMOLE_TOKEN_TTL", "1800"))
+# KMS key that encrypts Guacamole admin tokens shared through CACHE_TABLE. Without
+# it tokens are only cached in-process and never written to the table.
+GUACAMOLE_TOKEN_KMS_KEY = os.environ.get("GUACAMOLE_TOKEN_KMS_KEY", "")
+# Lifetime of published Guacamole activity records. pool-manager refreshes them every
+# minute, so a disconnect shows up within this long and one missed tick is tolerated.
+GUACAMOLE_ACTIVITY_TTL = int(os.environ.get("GUACAMOLE_ACTIVITY_TTL", "150"))
 DEFAULT_PLAN_LIMITS = {
     "freemium": 300,  # 5 hours
     "starter": 900,   # 15 hours
@@ -88,10 +114,12 @@ def calculate_expiry(ttl_hours: int) -> int:
 
 
 class DecimalEncoder(json.JSONEncoder):
-    """JSON encoder that handles Decimal types from DynamoDB."""
+    """JSON encoder that handles Decimal and set types from DynamoDB."""
     def default(self, obj):
         if isinstance(obj, Decimal):
             return int(obj) if obj % 1 == 0 else float(obj)
+        if isinstance(obj, (set, frozenset)):
+            return list(obj)
         return super().default(obj)
 
 
@@ -159,6 +187,65 @@ def get_query_parameter(event: Dict[str, Any], param_name: str, default: Optiona
     return query_params.get(param_name, default)
 
 
+def get_header(event: Dict[str, Any], header_name: str) -> Optional[str]:
+    """Get a request header from API Gateway event, ignoring case."""
+    header_name = header_name.lower()
+    for name, value in (event.get("headers") or {}).items():
+        if name.lower() == header_name:
+            return value
+    return None
+
+
+def cacheable_response(
+    event: Dict[str, Any],
+    data: Dict[str, Any],
+    message: str = "Success",
+    max_age: int = 0,
+    etag_source: Any = None,
+) -> Dict[str, Any]:
+    """
+    Create a success response carrying an ETag and Cache-Control.
+    
+    The ETag hashes `etag_source` (default: `data`). When the request's
+    If-None-Match already names it, a bodyless 304 is returned instead.
+    """
+    encoded = json.dumps(data if etag_source is None else etag_source, cls=DecimalEncoder, sort_keys=True)
+    etag = f'"{hashlib.sha256(encoded.encode()).hexdigest()[:32]}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"private, max-age={max_age}",
+    }
+    
+    if_none_match = get_header(event, "If-None-Match") or ""
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    if etag in candidates or "*" in candidates:
+        headers["X-Request-Id"] = str(uuid.uuid4())
+        return {"statusCode": 304, "headers": headers, "body": ""}
+    
+    return json_response(200, {
+        "success": True,
+        "message": message,
+        "data": data,
+        "timestamp": get_iso_timestamp(),
+    }, headers)
+
+
+def encode_page_cursor(position: Dict[str, Any]) -> str:
+    """Encode a query position (e.g. an ExclusiveStartKey) as an opaque URL-safe cursor."""
+    return base64.urlsafe_b64encode(json.dumps(position, default=int).encode()).decode().rstrip("=")
+
+
+def decode_page_cursor(cursor: str) -> Dict[str, Any]:
+    """Decode a cursor from encode_page_cursor; ValueError if it is malformed."""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Malformed cursor: {e}")
+    if not isinstance(position, dict):
+        raise ValueError("Malformed cursor")
+    return position
+
+
 class DynamoDBClient:
     """Helper class for DynamoDB operations."""
     
@@ -209,11 +296,13 @@ class DynamoDBClient:
         updates: Dict[str, Any], 
         condition_expression: str,
         expression_attribute_names: Optional[Dict[str, str]] = None,
-        expression_attribute_values: Optional[Dict[str, Any]] = None
-    ) -> bool:
+        expression_attribute_values: Optional[Dict[str, Any]] = None,
+        return_old: bool = False,
+    ):
         """
         Update an item in DynamoDB with a condition (for pessimistic locking).
         Returns True if update succeeded, False if condition failed or error occurred.
+        With return_old, a successful update returns the item's previous attributes instead of True.
         """
         try:
             update_expression = "SET " + ", ".join(f"#{k} = :{k}" for k in updates.keys())
@@ -228,13 +317,16 @@ class DynamoDBClient:
             if expression_attribute_values:
                 expr_values.update(expression_attribute_values)
             
-            self.table.update_item(
+            response = self.table.update_item(
                 Key=key,
                 UpdateExpression=update_expression,
                 ConditionExpression=condition_expression,
                 ExpressionAttributeNames=expr_names,
                 ExpressionAttributeValues=expr_values,
+                ReturnValues="ALL_OLD" if return_old else "NONE",
             )
+            if return_old:
+                return response.get("Attributes") or dict(key)
             return True
         except ClientError as e:
             if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
@@ -254,47 +346,315 @@ class DynamoDBClient:
             logger.error(f"DynamoDB delete_item error: {e}")
             return False
     
+    def conditional_put(
+        self,
+        item: Dict[str, Any],
+        condition_expression: str,
+        expression_attribute_names: Optional[Dict[str, str]] = None,
+        expression_attribute_values: Optional[Dict[str, Any]] = None,
+    ) -> bool:
+        """Put an item with a condition. Returns False if the condition failed or an error occurred."""
+        kwargs = {"Item": item, "ConditionExpression": condition_expression}
+        if expression_attribute_names:
+            kwargs["ExpressionAttributeNames"] = expression_attribute_names
+        if expression_attribute_values:
+            kwargs["ExpressionAttributeValues"] = expression_attribute_values
+        try:
+            self.table.put_item(**kwargs)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                logger.debug(f"Conditional put failed for {item}: condition not met")
+            else:
+                logger.error(f"DynamoDB conditional_put error: {e}")
+            return False
+    
+    def conditional_delete(
+        self,
+        key: Dict[str, Any],
+        condition_expression: str,
+        expression_attribute_names: Optional[Dict[str, str]] = None,
+        expression_attribute_values: Optional[Dict[str, Any]] = None,
+    ) -> bool:
+        """Delete an item with a condition. Returns False if the condition failed or an error occurred."""
+        kwargs = {"Key": key, "ConditionExpression": condition_expression}
+        if expression_attribute_names:
+            kwargs["ExpressionAttributeNames"] = expression_attribute_names
+        if expression_attribute_values:
+            kwargs["ExpressionAttributeValues"] = expression_attribute_values
+        try:
+            self.table.delete_item(**kwargs)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                logger.debug(f"Conditional delete failed for key {key}: condition not met")
+            else:
+                logger.error(f"DynamoDB conditional_delete error: {e}")
+            return False
+    
+    def iter_query(
+        self,
+        key_condition: Any,
+        index_name: Optional[str] = None,
+        projection: Optional[List[str]] = None,
+        page_size: Optional[int] = None,
+        limit: Optional[int] = None,
+        filter_expression: Any = None,
+        scan_forward: bool = True,
+        strict: bool = False,
+        start_key: Optional[Dict[str, Any]] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Lazily yield every item matching a query, one page at a time.
+        
+        Args:
+            key_condition: KeyConditionExpression, e.g. Key("status").eq("active")
+            index_name: GSI to query (None for the base table)
+            projection: Attribute names to return (None for all attributes)
+            page_size: Items DynamoDB evaluates per request (a hint, passed as Limit)
+            limit: Stop after yielding this many items
+            filter_expression: Optional FilterExpression applied server-side
+            scan_forward: Sort key order for tables/indexes with a range key
+            strict: Raise on DynamoDB errors instead of stopping early
+            start_key: ExclusiveStartKey to resume after
+        """
+        query_kwargs = {"KeyConditionExpression": key_condition, "ScanIndexForward": scan_forward}
+        if index_name:
+            query_kwargs["IndexName"] = index_name
+        if start_key:
+            query_kwargs["ExclusiveStartKey"] = start_key
+        if filter_expression is not None:
+            query_kwargs["FilterExpression"] = filter_expression
+        
+        yield from self._iter_pages(self.table.query, query_kwargs, projection, page_size, limit, strict)
+    
+    def iter_scan(
+        self,
+        projection: Optional[List[str]] = None,
+        page_size: Optional[int] = None,
+        limit: Optional[int] = None,
+        filter_expression: Any = None,
+        strict: bool = False,
+    ) -> Iterator[Dict[str, Any]]:
+        """Lazily yield every item in the table, one page at a time. See iter_query for arguments."""
+        scan_kwargs = {}
+        if filter_expression is not None:
+            scan_kwargs["FilterExpression"] = filter_expression
+        
+        yield from self._iter_pages(self.table.scan, scan_kwargs, projection, page_size, limit, strict)
+    
+    def _iter_pages(
+        self,
+        operation,
+        request_kwargs: Dict[str, Any],
+        projection: Optional[List[str]],
+        page_size: Optional[int],
+        limit: Optional[int],
+        strict: bool,
+    ) -> Iterator[Dict[str, Any]]:
+        """Follow LastEvaluatedKey across pages, yielding items until done or `limit` is reached."""
+        if projection:
+            # Alias every attribute so reserved words like "status" can be projected
+            request_kwargs["ProjectionExpression"] = ", ".join(f"#p{i}" for i in range(len(projection)))
+            request_kwargs["ExpressionAttributeNames"] = {f"#p{i}": name for i, name in enumerate(projection)}
+        if page_size:
+            request_kwargs["Limit"] = page_size
+        
+        yielded = 0
+        while True:
+            try:
+                response = operation(**request_kwargs)
+            except ClientError as e:
+                logger.error(f"DynamoDB {operation.__name__} error on {self.table_name}: {e}")
+                if strict:
+                    raise
+                return
+            
+            for item in response.get("Items", []):
+                yield item
+                yielded += 1
+                if limit is not None and yielded >= limit:
+                    return
+            
+            if "LastEvaluatedKey" not in response:
+                return
+            request_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    
     def query_by_index(self, index_name: str, key_name: str, key_value: str) -> list:
-        """Query items using a GSI."""
+        """Query all items with a given GSI partition key."""
+        return list(self.iter_query(Key(key_name).eq(key_value), index_name=index_name))
+    
+    def query_all_by_index(self, index_name: str, key_name: str, key_value: str, strict: bool = False) -> list:
+        """
+        Query all items with a given GSI partition key.
+        
+        With strict=True a DynamoDB error is raised instead of returning partial results.
+        """
+        return list(self.iter_query(Key(key_name).eq(key_value), index_name=index_name, strict=strict))
+    
+    def query_by_composite_key(
+        self,
+        index_name: str,
+        hash_key: str,
+        hash_value: Any,
+        range_key: str,
+        range_value: Any,
+        strict: bool = False
+    ) -> list:
+        """
+        Query a GSI on both its partition and sort key (e.g. PlanStatusIndex on plan + status).
+        
+        Only the matching partition/sort-key range is read, so the cost scales with the
+        number of matching items rather than with the whole partition of either key.
+        """
+        condition = Key(hash_key).eq(hash_value) & Key(range_key).eq(range_value)
+        return list(self.iter_query(condition, index_name=index_name, strict=strict))
+    
+    def scan_all(self, strict: bool = False) -> list:
+        """
+        Scan the whole table.
+        
+        With strict=True a DynamoDB error is raised instead of returning partial results.
+        """
+        return list(self.iter_scan(strict=strict))
+    
+    def batch_write(self, puts: Optional[list] = None, deletes: Optional[list] = None) -> bool:
+        """
+        Put and delete many items using BatchWriteItem (25 items per request).
+        
+        The batch writer resends unprocessed items automatically.
+        """
         try:
-            response = self.table.query(
-                IndexName=index_name,
-                KeyConditionExpression=Key(key_name).eq(key_value),
-            )
-            return response.get("Items", [])
+            with self.table.batch_writer() as batch:
+                for item in puts or []:
+                    batch.put_item(Item=item)
+                for key in deletes or []:
+                    batch.delete_item(Key=key)
+            return True
+        except ClientError as e:
+            logger.error(f"DynamoDB batch_write error: {e}")
+            return False
+    
+    def batch_get(
+        self,
+        keys: List[Dict[str, Any]],
+        projection: Optional[List[str]] = None,
+        strict: bool = False,
+    ) -> List[Dict[str, Any]]:
+        """
+        Get many items using BatchGetItem (100 keys per request).
+        
+        Unprocessed keys are retried with backoff. Missing items are simply
+        absent from the result. Returns [] on error, or raises with strict.
+        """
+        items = []
+        try:
+            for start in range(0, len(keys), 100):
+                request = {"Keys": keys[start:start + 100]}
+                if projection:
+                    request["ProjectionExpression"] = ", ".join(f"#p{i}" for i in range(len(projection)))
+                    request["ExpressionAttributeNames"] = {f"#p{i}": name for i, name in enumerate(projection)}
+                
+                pending = {self.table_name: request}
+                attempt = 0
+                while pending:
+                    response = self.dynamodb.batch_get_item(RequestItems=pending)
+                    items.extend(response.get("Responses", {}).get(self.table_name, []))
+                    pending = response.get("UnprocessedKeys") or {}
+                    if pending:
+                        attempt += 1
+                        time.sleep(min(0.05 * 2 ** attempt, 1.0))
+            return items
         except ClientError as e:
-            logger.error(f"DynamoDB query error: {e}")
+            logger.error(f"DynamoDB batch_get error: {e}")
+            if strict:
+                raise
             return []
     
-    def query_user_sessions(self, user_id: str, limit: int = 50, status_filter: Optional[str] = None) -> list:
+    def query_user_sessions(
+        self,
+        user_id: str,
+        limit: Optional[int] = 50,
+        status_filter: Any = None,
+        since: Optional[int] = None,
+        until: Optional[int] = None,
+    ) -> list:
         """
-        Query all sessions for a specific user using the StudentIndex GSI.
+        Query a user's sessions, newest first, using the StudentCreatedIndex GSI.
         
         Args:
             user_id: The student/user ID to query sessions for
-            limit: Maximum number of sessions to return
-            status_filter: Optional status to filter by (e.g., 'terminated', 'ready')
+            limit: Maximum number of sessions to return (None for all)
+            status_filter: Optional status, or list of statuses, to filter by (e.g., 'terminated', 'ready')
+            since: Only sessions created at or after this epoch second
+            until: Only sessions created at or before this epoch second
         
         Returns:
             List of session items from DynamoDB
         """
-        try:
-            query_kwargs = {
-                "IndexName": "StudentIndex",
-                "KeyConditionExpression": Key("student_id").eq(user_id),
-                "Limit": limit,
-                "ScanIndexForward": False,  # Most recent first
-            }
-            
-            # Add status filter if provided
-            if status_filter:
-                query_kwargs["FilterExpression"] = Attr("status").eq(status_filter)
-            
-            response = self.table.query(**query_kwargs)
-            return response.get("Items", [])
-        except ClientError as e:
-            logger.error(f"DynamoDB query_user_sessions error: {e}")
-            return []
+        return self.query_user_sessions_page(user_id, limit, status_filter, since, until)[0]
+    
+    def query_user_sessions_page(
+        self,
+        user_id: str,
+        limit: Optional[int] = 50,
+        status_filter: Any = None,
+        since: Optional[int] = None,
+        until: Optional[int] = None,
+        cursor: Optional[str] = None,
+    ) -> Tuple[list, Optional[str]]:
+        """
+        Return (sessions, next_cursor) for one page of a user's sessions, newest first.
+        
+        The index is sorted by created_at, so a page reads about `limit` items
+        (plus whatever the status filter drops) however long the history is.
+        next_cursor is None on the last page. Raises ValueError for a cursor
+        that is malformed or belongs to another user.
+        """
+        key_condition = Key("student_id").eq(user_id)
+        if since is not None and until is not None:
+            key_condition = key_condition & Key("created_at").between(int(since), int(until))
+        elif since is not None:
+            key_condition = key_condition & Key("created_at").gte(int(since))
+        elif until is not None:
+            key_condition = key_condition & Key("created_at").lte(int(until))
+        
+        start_key = None
+        if cursor:
+            start_key = decode_page_cursor(cursor)
+            if set(start_key) != {"student_id", "created_at", "session_id"} or start_key["student_id"] != user_id:
+                raise ValueError("Cursor belongs to a different query")
+        
+        filter_expression = None
+        if isinstance(status_filter, (list, tuple, set)):
+            filter_expression = Attr("status").is_in(list(status_filter))
+        elif status_filter:
+            filter_expression = Attr("status").eq(status_filter)
+        
+        # One extra item tells whether there is a next page.
+        # `limit` counts matching items across pages, so a filter can't truncate the result
+        fetch = None if limit is None else limit + 1
+        sessions = list(self.iter_query(
+            key_condition,
+            index_name="StudentCreatedIndex",
+            page_size=fetch,
+            limit=fetch,
+            filter_expression=filter_expression,
+            scan_forward=False,  # Most recent first
+            start_key=start_key,
+        ))
+        
+        if limit is None or len(sessions) <= limit:
+            return sessions, None
+        
+        # The last returned item's index and table keys resume the query right after it
+        last = sessions[limit - 1]
+        next_cursor = encode_page_cursor({
+            "student_id": user_id,
+            "created_at": int(last["created_at"]),
+            "session_id": last["session_id"],
+        })
+        return sessions[:limit], next_cursor
 
 
 class UsageTracker:
@@ -372,6 +732,19 @@ class UsageTracker:
             logger.error(f"DynamoDB update usage error: {e}")
             return None
 
+    def iter_month(self, usage_month: str, page_size: int = 500) -> Iterator[Dict[str, Any]]:
+        """
+        Lazily yield every user's usage item for a month via the MonthIndex GSI.
+        
+        Raises ClientError if a page fails, so reports are never silently partial.
+        """
+        return DynamoDBClient(self.table_name).iter_query(
+            Key("usage_month").eq(usage_month),
+            index_name="MonthIndex",
+            page_size=page_size,
+            strict=True,
+        )
+
     def is_over_quota(self, user_id: str, usage_month: str, quota_minutes: int) -> Dict[str, int]:
         """Check if user has exceeded quota. Returns dict with used and remaining."""
         used = self.get_usage_minutes(user_id, usage_month)
@@ -469,84 +842,129 @@ class EC2Client:
         self.ec2 = boto3.client("ec2", region_name=AWS_REGION)
         self.ec2_resource = boto3.resource("ec2", region_name=AWS_REGION)
     
+    # describe_instances filter values and describe_instance_status InstanceIds are capped per call
+    DESCRIBE_FILTER_CHUNK = 200
+    STATUS_CHUNK = 100
+    
     def get_instance_status(self, instance_id: str) -> Optional[Dict[str, Any]]:
         """Get EC2 instance status with health checks."""
-        try:
-            # Get basic instance info
-            response = self.ec2.describe_instances(InstanceIds=[instance_id])
-            reservations = response.get("Reservations", [])
-            if not reservations or not reservations[0].get("Instances"):
-                return None
-            
-            instance = reservations[0]["Instances"][0]
+        return self.get_instances_status([instance_id]).get(instance_id)
+    
+    def get_instances_status(self, instance_ids, include_health: bool = True) -> Dict[str, Dict[str, Any]]:
+        """
+        Get status for many EC2 instances in a fixed number of API calls.
+        
+        Resolves state, private IP, placement (AZ) and, optionally, status checks
+        with one paginated describe_instances and one describe_instance_status
+        per 100 running instances, instead of two calls per instance.
+        
+        Args:
+            instance_ids: Instance IDs to look up (duplicates and empties are ignored)
+            include_health: Also fetch status checks into instance["HealthChecks"]
             
-            # Get instance status checks (system + instance reachability)
-            try:
-                status_response = self.ec2.describe_instance_status(
-                    InstanceIds=[instance_id],
-                    IncludeAllInstances=False  # Only running instances
-                )
-                
-                if status_response.get("InstanceStatuses"):
-                    status_info = status_response["InstanceStatuses"][0]
-                    
-                    # Extract status check results
-                    system_status_obj = status_info.get("SystemStatus", {})
-                    instance_status_obj = status_info.get("InstanceStatus", {})
-                    
-                    system_status = system_status_obj.get("Status", "unknown")
-                    instance_status = instance_status_obj.get("Status", "unknown")
-                    
-                    # Get detailed checks (this is what shows as 3/3 in console)
-                    system_details = system_status_obj.get("Details", [])
-                    instance_details = instance_status_obj.get("Details", [])
-                    
-                    # Count passed checks
-                    total_checks = len(system_details) + len(instance_details)
-                    passed_checks = sum(
-                        1 for check in (system_details + instance_details)
-                        if check.get("Status") == "passed"
-                    )
-                    
-                    # Consider "insufficient-data" as acceptable (status checks may not report immediately)
-                    # Only "impaired" or "failed" is a real failure
-                    system_ok = system_status in ["ok", "insufficient-data", "not-applicable"]
-                    instance_ok = instance_status in ["ok", "insufficient-data", "not-applicable"]
-                    
-                    # All passed if both statuses OK or all individual checks passed
-                    all_passed = (system_ok and instance_ok) or (total_checks > 0 and passed_checks == total_checks)
-                    
-                    # Add health check info to instance data
-                    instance["HealthChecks"] = {
-                        "system_status": system_status,
-                        "instance_status": instance_status,
-                        "passed_checks": passed_checks,
-                        "total_checks": total_checks,
-                        "all_passed": all_passed
-                    }
-                    
-                    logger.info(f"Instance {instance_id} health: {passed_checks}/{total_checks} checks passed, "
-                               f"system={system_status}, instance={instance_status}")
-                else:
-                    # Instance exists but no status checks yet (likely just started)
-                    instance["HealthChecks"] = {
-                        "system_status": "initializing",
-                        "instance_status": "initializing",
-                        "all_passed": False
-                    }
-            except ClientError as status_error:
-                logger.warning(f"Could not get status checks for {instance_id}: {status_error}")
+        Returns:
+            Dict mapping instance ID to the describe_instances record.
+            Instances that no longer exist are absent from the result.
+        """
+        ids = list(dict.fromkeys(i for i in instance_ids if i))
+        instances: Dict[str, Dict[str, Any]] = {}
+        if not ids:
+            return instances
+        
+        try:
+            # Filter by instance-id rather than InstanceIds so one missing instance
+            # does not fail the whole batch with InvalidInstanceID.NotFound
+            paginator = self.ec2.get_paginator("describe_instances")
+            for start in range(0, len(ids), self.DESCRIBE_FILTER_CHUNK):
+                chunk = ids[start:start + self.DESCRIBE_FILTER_CHUNK]
+                for page in paginator.paginate(Filters=[{"Name": "instance-id", "Values": chunk}]):
+                    for reservation in page.get("Reservations", []):
+                        for instance in reservation.get("Instances", []):
+                            instances[instance["InstanceId"]] = instance
+        except ClientError as e:
+            logger.error(f"EC2 describe_instances error: {e}")
+            return {}
+        
+        if not include_health:
+            return instances
+        
+        # Status checks are only reported for running instances
+        running_ids = [
+            iid for iid, inst in instances.items()
+            if inst.get("State", {}).get("Name") == "running"
+        ]
+        statuses: Dict[str, Dict[str, Any]] = {}
+        status_error = None
+        try:
+            paginator = self.ec2.get_paginator("describe_instance_status")
+            for start in range(0, len(running_ids), self.STATUS_CHUNK):
+                chunk = running_ids[start:start + self.STATUS_CHUNK]
+                for page in paginator.paginate(InstanceIds=chunk, IncludeAllInstances=False):
+                    for status_info in page.get("InstanceStatuses", []):
+                        statuses[status_info["InstanceId"]] = status_info
+        except ClientError as e:
+            logger.warning(f"Could not get status checks for {len(running_ids)} instance(s): {e}")
+            status_error = e
+        
+        for instance_id, instance in instances.items():
+            status_info = statuses.get(instance_id)
+            if status_info:
+                instance["HealthChecks"] = self._summarize_health(status_info)
+            elif status_error is not None:
                 # Instance might not be running yet
                 instance["HealthChecks"] = {
                     "system_status": "unknown",
                     "instance_status": "unknown",
                     "all_passed": False
                 }
-            
-            return instance
-        except ClientError as e:
-            logger.error(f"EC2 describe_instances error: {e}")
-            return None
+            else:
+                # Instance exists but no status checks yet (likely just started)
+                instance["HealthChecks"] = {
+                    "system_status": "initializing",
+                    "instance_status": "initializing",
+                    "all_passed": False
+                }
+        
+        healthy = sum(1 for inst in instances.values() if inst["HealthChecks"].get("all_passed"))
+        logger.info(f"Resolved {len(instances)}/{len(ids)} instance(s), {healthy} passing all status checks")
+        return instances
+    
+    @staticmethod
+    def _summarize_health(status_info: Dict[str, Any]) -> Dict[str, Any]:
+        """Reduce a describe_instance_status entry to the HealthChecks summary."""
+        # Extract status check results
+        system_status_obj = status_info.get("SystemStatus", {})
+        instance_status_obj = status_info.get("InstanceStatus", {})
+        
+        system_status = system_status_obj.get("Status", "unknown")
+        instance_status = instance_status_obj.get("Status", "unknown")
+        
+        # Get detailed checks (this is what shows as 3/3 in console)
+        system_details = system_status_obj.get("Details", [])
+        instance_details = instance_status_obj.get("Details", [])
+        
+        # Count passed checks
+        total_checks = len(system_details) + len(instance_details)
+        passed_checks = sum(
+            1 for check in (system_details + instance_details)
+            if check.get("Status") == "passed"
+        )
+        
+        # Consider "insufficient-data" as acceptable (status checks may not report immediately)
+        # Only "impaired" or "failed" is a real failure
+        system_ok = system_status in ["ok", "insufficient-data", "not-applicable"]
+        instance_ok = instance_status in ["ok", "insufficient-data", "not-applicable"]
+        
+        # All passed if both statuses OK or all individual checks passed
+        all_passed = (system_ok and instance_ok) or (total_checks > 0 and passed_checks == total_checks)
+        
+        return {
+            "system_status": system_status,
+            "instance_status": instance_status,
+            "passed_checks": passed_checks,
+            "total_checks": total_checks,
+            "all_passed": all_passed
+        }
     
     def get_instance_private_ip(self, instance_id: str) -> Optional[str]:
         """Get the private IP of an EC2 instance."""
@@ -649,122 +1067,596 @@ class AutoScalingClient:
             return False
 
 
-class GuacamoleClient:
+# =============================================================================
+# HTTP Transport
+# =============================================================================
+
+class HTTPStatusError(Exception):
+    """Raised by KeepAliveTransport when the server answers with a 4xx/5xx status."""
+    
+    def __init__(self, status: int, reason: str, body: bytes = b""):
+        super().__init__(f"HTTP Error {status}: {reason}")
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+
+class _NoDelayHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection with Nagle disabled, so small requests aren't held back by delayed ACKs."""
+    
+    def connect(self):
+        super().connect()
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class _ResumableHTTPSConnection(http.client.HTTPSConnection):
+    """HTTPSConnection that resumes a cached TLS session when it (re)connects."""
+    
+    def __init__(self, host: str, port: int, tls_sessions: dict, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self._tls_sessions = tls_sessions
+    
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = self._context.wrap_socket(
+            self.sock,
+            server_hostname=self.host,
+            session=self._tls_sessions.get((self.host, self.port)),
+        )
+
+
+class KeepAliveTransport:
     """
-    Helper class for Guacamole REST API operations.
-    Creates RDP connections and generates client URLs.
+    Minimal pooled HTTP/1.1 client with keep-alive and TLS session resumption.
+    
+    Idle connections are kept per (scheme, host, port) and reused by later requests,
+    including requests from later warm invocations when the transport is held at
+    module scope (see get_http_transport). When a connection does have to be
+    re-opened, the previous TLS session is resumed to skip the full handshake.
     """
     
     def __init__(
         self,
-        base_url: str,
-        username: str = "guacadmin",
-        password: str = "guacadmin",
-        timeout: int = 10,
+        ssl_context: Optional[ssl.SSLContext] = None,
+        max_idle_per_host: int = 4,
+        idle_timeout: float = 15.0,
+        timing_history: int = 100,
     ):
         """
-        Initialize Guacamole client.
-        
         Args:
-            base_url: Guacamole base URL (e.g., https://guac.example.com/guacamole)
-            username: Admin username
-            password: Admin password
+            ssl_context: Context for HTTPS connections
+            max_idle_per_host: Idle connections kept per host
+            idle_timeout: Seconds an idle connection may be reused for. Keep this below
+                the server's keep-alive timeout (Tomcat defaults to 20s).
+            timing_history: Number of per-request timings kept for metrics()
         """
-        self.base_url = base_url.rstrip("/")
-        self.username = username
-        self.password = password
-        self.token = None
-        self.data_source = "postgresql"  # Default data source
-        # Per-request timeout in seconds for HTTP calls to Guacamole
-        # This can be overridden (e.g. shorter timeout for termination path)
-        self.timeout = timeout
+        self.ssl_context = ssl_context or ssl.create_default_context()
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
         
-        # Import here to avoid issues if not needed
-        try:
-            import urllib.request
-            import urllib.parse
-            import ssl
-            self.urllib_request = urllib.request
-            self.urllib_parse = urllib.parse
-            # Create SSL context that doesn't verify (for self-signed certs)
-            self.ssl_context = ssl.create_default_context()
-            self.ssl_context.check_hostname = False
-            self.ssl_context.verify_mode = ssl.CERT_NONE
-        except ImportError as e:
-            logger.error(f"Failed to import urllib: {e}")
-            raise
-    
-    def _make_request(self, method: str, endpoint: str, data: dict = None, 
-                      headers: dict = None, include_token: bool = True) -> Optional[dict]:
-        """Make HTTP request to Guacamole API."""
-        url = f"{self.base_url}/api{endpoint}"
+        self._idle = {}          # (scheme, host, port) -> [(connection, released_at)]
+        self._tls_sessions = {}  # (host, port) -> ssl.SSLSession
+        self._lock = threading.Lock()
         
-        req_headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json",
+        self.timings = deque(maxlen=timing_history)
+        self.stats = self._empty_stats()
+    
+    # Safe to send twice: a reused connection that drops after the request went
+    # out is only retried for these, since the server may have processed it
+    IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+    
+    @staticmethod
+    def _empty_stats() -> Dict[str, int]:
+        return {
+            "requests": 0,
+            "connections_opened": 0,
+            "connections_reused": 0,
+            "tls_resumed": 0,
+            "retries": 0,
+            "errors": 0,
         }
-        if headers:
-            req_headers.update(headers)
-        
-        if include_token and self.token:
-            url = f"{url}{'&' if '?' in url else '?'}token={self.token}"
+    
+    def request(
+        self,
+        method: str,
+        url: str,
+        body: Optional[bytes] = None,
+        headers: Optional[Dict[str, str]] = None,
+        timeout: float = 10.0,
+    ) -> Tuple[int, bytes]:
+        """
+        Send a request and return (status, body).
         
-        body = None
-        if data:
-            body = json.dumps(data).encode("utf-8")
+        Raises HTTPStatusError for 4xx/5xx responses and the underlying socket/HTTP
+        error if the request could not be completed.
+        """
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        key = (parts.scheme, parts.hostname, port)
+        target = parts.path or "/"
+        if parts.query:
+            target = f"{target}?{parts.query}"
         
+        start = time.monotonic()
+        reused = False
+        status = None
         try:
-            request = self.urllib_request.Request(
-                url, 
-                data=body, 
-                headers=req_headers,
-                method=method
-            )
-            
-            with self.urllib_request.urlopen(
-                request,
-                context=self.ssl_context,
-                timeout=self.timeout,
-            ) as response:
-                response_body = response.read().decode("utf-8")
-                if response_body:
-                    return json.loads(response_body)
-                return {}
-        except Exception as e:
-            logger.error(f"Guacamole API request failed: {method} {url} - {e}")
-            return None
+            for attempt in range(2):
+                conn, reused = self._acquire(key, timeout)
+                sent = False
+                try:
+                    conn.request(method, target, body=body, headers=headers or {})
+                    sent = True
+                    response = conn.getresponse()
+                    data = response.read()
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    conn.close()
+                    # The server closed an idle keep-alive connection: the rest of the
+                    # idle pool is likely stale too, so drop it and retry once on a new one.
+                    # A non-idempotent request that was already sent may have been
+                    # processed, so it is not repeated
+                    if reused and attempt == 0 and (not sent or method.upper() in self.IDEMPOTENT_METHODS):
+                        self.stats["retries"] += 1
+                        self._discard_idle(key)
+                        continue
+                    raise
+                except Exception:
+                    conn.close()
+                    raise
+                
+                status = response.status
+                self._release(key, conn, response.will_close)
+                break
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        finally:
+            # Never record the query string: it carries Guacamole auth tokens
+            self._record(method, parts.path, status, start, reused)
+        
+        if status >= 400:
+            raise HTTPStatusError(status, response.reason, data)
+        return status, data
     
-    def authenticate(self) -> bool:
-        """Authenticate with Guacamole and get auth token."""
-        try:
-            # Guacamole uses form-encoded auth
-            auth_data = self.urllib_parse.urlencode({
-                "username": self.username,
-                "password": self.password,
-            }).encode("utf-8")
-            
-            request = self.urllib_request.Request(
-                f"{self.base_url}/api/tokens",
-                data=auth_data,
-                headers={"Content-Type": "application/x-www-form-urlencoded"},
-                method="POST"
+    def _acquire(self, key: tuple, timeout: float):
+        """Return (connection, reused) - an idle pooled connection or a new one."""
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, released_at = idle.pop()
+                if now - released_at <= self.idle_timeout and conn.sock is not None:
+                    conn.timeout = timeout
+                    conn.sock.settimeout(timeout)
+                    self.stats["connections_reused"] += 1
+                    return conn, True
+                conn.close()
+        
+        scheme, host, port = key
+        if scheme == "https":
+            conn = _ResumableHTTPSConnection(
+                host, port, self._tls_sessions, timeout=timeout, context=self.ssl_context
             )
-            
-            with self.urllib_request.urlopen(request, context=self.ssl_context, timeout=self.timeout) as response:
-                result = json.loads(response.read().decode("utf-8"))
-                self.token = result.get("authToken")
-                self.data_source = result.get("dataSource", "postgresql")
-                logger.info(f"Guacamole auth successful, data source: {self.data_source}")
-                return self.token is not None
-        except Exception as e:
-            logger.error(f"Guacamole authentication failed: {e}")
-            return False
+        else:
+            conn = _NoDelayHTTPConnection(host, port, timeout=timeout)
+        self.stats["connections_opened"] += 1
+        return conn, False
     
-    def create_rdp_connection(
-        self,
-        name: str,
-        hostname: str,
-        port: int = 3389,
+    def _release(self, key: tuple, conn, will_close: bool) -> None:
+        """Return a connection to the idle pool, remembering its TLS session."""
+        sock = conn.sock
+        if isinstance(sock, ssl.SSLSocket):
+            if sock.session_reused:
+                self.stats["tls_resumed"] += 1
+            if sock.session is not None:
+                self._tls_sessions[(conn.host, conn.port)] = sock.session
+        
+        if will_close or sock is None:
+            conn.close()
+            return
+        
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+    
+    def _discard_idle(self, key: tuple) -> None:
+        with self._lock:
+            for conn, _ in self._idle.pop(key, []):
+                conn.close()
+    
+    def _record(self, method: str, path: str, status: Optional[int], start: float, reused: bool) -> None:
+        elapsed_ms = round((time.monotonic() - start) * 1000, 1)
+        self.stats["requests"] += 1
+        self.timings.append({
+            "method": method,
+            "path": path,
+            "status": status,
+            "ms": elapsed_ms,
+            "reused": reused,
+        })
+        logger.debug(f"[HTTP] {method} {path} -> {status} in {elapsed_ms}ms (reused={reused})")
+    
+    def metrics(self, reset: bool = False) -> Dict[str, Any]:
+        """
+        Summarize request timings and connection reuse.
+        
+        With reset=True the counters and timings are cleared afterwards, so a warm
+        Lambda can report per-invocation numbers.
+        """
+        durations = sorted(t["ms"] for t in self.timings)
+        summary = dict(self.stats)
+        if durations:
+            summary["avg_ms"] = round(sum(durations) / len(durations), 1)
+            summary["p50_ms"] = durations[len(durations) // 2]
+            summary["max_ms"] = durations[-1]
+        
+        if reset:
+            self.timings.clear()
+            self.stats = self._empty_stats()
+        
+        return summary
+    
+    def close(self) -> None:
+        """Close every idle connection."""
+        for key in list(self._idle):
+            self._discard_idle(key)
+
+
+# Shared across warm invocations of the same Lambda container
+_http_transport = None
+
+
+def get_http_transport() -> KeepAliveTransport:
+    """Return the module-level keep-alive transport used for Guacamole API calls."""
+    global _http_transport
+    if _http_transport is None:
+        # Guacamole commonly runs with a self-signed certificate
+        ssl_context = ssl.create_default_context()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+        _http_transport = KeepAliveTransport(ssl_context=ssl_context)
+    return _http_transport
+
+
+# =============================================================================
+# Guacamole Token Cache
+# =============================================================================
+
+class GuacamoleTokenCache:
+    """
+    Guacamole admin auth tokens shared between GuacamoleClient instances.
+    
+    Tokens are kept at module scope, so warm invocations reuse them, and optionally
+    in a short-TTL DynamoDB item so other Lambdas can reuse them as well. The item
+    only holds the token encrypted under `kms_key_id` (with the cache key as
+    encryption context) and a SHA-256 fingerprint used to invalidate it; without
+    a key nothing is written to the table. A token is treated as expired
+    `refresh_margin` seconds before its TTL so it is refreshed proactively rather
+    than failing mid-launch.
+    """
+    
+    KEY_PREFIX = "guacamole-token#"
+    
+    def __init__(
+        self,
+        table_name: str = "",
+        ttl: int = GUACAMOLE_TOKEN_TTL,
+        refresh_margin: int = 60,
+        kms_key_id: str = GUACAMOLE_TOKEN_KMS_KEY,
+    ):
+        self.table_name = table_name
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.kms_key_id = kms_key_id
+        self._local = {}  # cache_key -> {"token", "data_source", "expires_at"}
+        self._db = None
+        self._kms = None
+    
+    def _table(self):
+        if self._db is None and self.table_name and self.kms_key_id:
+            self._db = DynamoDBClient(self.table_name)
+            self._kms = boto3.client("kms", region_name=AWS_REGION)
+        return self._db
+    
+    @staticmethod
+    def fingerprint(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+    
+    def cache_key(self, base_url: str, username: str) -> str:
+        return f"{self.KEY_PREFIX}{username}@{base_url}"
+    
+    def get(self, cache_key: str) -> Optional[Dict[str, Any]]:
+        """Return a cached {"token", "data_source"} entry that is not about to expire."""
+        now = get_current_timestamp()
+        
+        entry = self._local.get(cache_key)
+        if entry and entry["expires_at"] - self.refresh_margin > now:
+            return entry
+        
+        db = self._table()
+        if db:
+            item = db.get_item({"cache_key": cache_key})
+            if item and item.get("token_ciphertext") and int(item.get("expires_at", 0)) - self.refresh_margin > now:
+                try:
+                    token = self._kms.decrypt(
+                        CiphertextBlob=base64.b64decode(item["token_ciphertext"]),
+                        EncryptionContext={"cache_key": cache_key},
+                    )["Plaintext"].decode("utf-8")
+                except (ClientError, ValueError) as e:
+                    logger.warning(f"Failed to decrypt cached Guacamole token: {e}")
+                    return None
+                entry = {
+                    "token": token,
+                    "data_source": item.get("data_source", "postgresql"),
+                    "expires_at": int(item["expires_at"]),
+                }
+                self._local[cache_key] = entry
+                return entry
+        
+        return None
+    
+    def put(self, cache_key: str, token: str, data_source: str) -> None:
+        entry = {
+            "token": token,
+            "data_source": data_source,
+            "expires_at": get_current_timestamp() + self.ttl,
+        }
+        self._local[cache_key] = entry
+        
+        db = self._table()
+        if db:
+            try:
+                ciphertext = self._kms.encrypt(
+                    KeyId=self.kms_key_id,
+                    Plaintext=token.encode("utf-8"),
+                    EncryptionContext={"cache_key": cache_key},
+                )["CiphertextBlob"]
+            except ClientError as e:
+                logger.warning(f"Failed to encrypt Guacamole token, caching it in-process only: {e}")
+                return
+            db.put_item({
+                "cache_key": cache_key,
+                "token_ciphertext": base64.b64encode(ciphertext).decode("ascii"),
+                "token_sha256": self.fingerprint(token),
+                "data_source": data_source,
+                "expires_at": entry["expires_at"],
+            })
+    
+    def invalidate(self, cache_key: str, token: str) -> None:
+        """Drop a token Guacamole rejected, unless another caller already replaced it."""
+        entry = self._local.get(cache_key)
+        if entry and entry["token"] == token:
+            del self._local[cache_key]
+        
+        db = self._table()
+        if db:
+            try:
+                db.table.delete_item(
+                    Key={"cache_key": cache_key},
+                    ConditionExpression=Attr("token_sha256").eq(self.fingerprint(token)),
+                )
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    logger.warning(f"Failed to invalidate cached Guacamole token: {e}")
+
+
+# Shared across warm invocations of the same Lambda container
+_guacamole_token_cache = None
+
+
+def get_guacamole_token_cache() -> GuacamoleTokenCache:
+    """Return the module-level Guacamole admin token cache."""
+    global _guacamole_token_cache
+    if _guacamole_token_cache is None:
+        _guacamole_token_cache = GuacamoleTokenCache(table_name=CACHE_TABLE)
+    return _guacamole_token_cache
+
+
+class GuacamoleActivitySnapshot:
+    """
+    Per-connection Guacamole activity shared through the cache table.
+    
+    pool-manager fetches activeConnections once per tick and publishes one
+    compact record per connection; session-heartbeat reads only its own
+    record, so Guacamole load stays flat however many students are active.
+    A missing or expired record means the connection has no active users.
+    """
+    
+    KEY_PREFIX = "guacamole-activity#"
+    
+    def __init__(self, table_name: str = CACHE_TABLE, ttl: int = GUACAMOLE_ACTIVITY_TTL):
+        self.db = DynamoDBClient(table_name)
+        self.ttl = ttl
+    
+    @staticmethod
+    def summarize(connections: Dict[str, Any]) -> Dict[str, Dict[str, int]]:
+        """
+        Reduce get_all_active_connections() output to
+        {connection_id: {"active_connections": n, "last_activity": unix_ts}}.
+        """
+        summary = {}
+        for connection_id, info in connections.items():
+            last_activity = 0
+            for active_session in info.get("active_sessions", []):
+                try:
+                    last_activity = max(last_activity, int(active_session.get("start_date")) // 1000)
+                except (ValueError, TypeError):
+                    pass
+            summary[str(connection_id)] = {
+                "active_connections": int(info.get("total_connections", 0)),
+                "last_activity": last_activity,
+            }
+        return summary
+    
+    def publish(self, connections: Dict[str, Any], now: int) -> int:
+        """Write one record per active connection. Returns the number written."""
+        puts = [
+            {
+                "cache_key": f"{self.KEY_PREFIX}{connection_id}",
+                "snapshot_at": now,
+                "expires_at": now + self.ttl,
+                **activity,
+            }
+            for connection_id, activity in self.summarize(connections).items()
+        ]
+        if puts and not self.db.batch_write(puts=puts):
+            return 0
+        return len(puts)
+    
+    def get(self, connection_id: str, now: int) -> Optional[Dict[str, int]]:
+        """Return the connection's published activity, None if it has none."""
+        item = self.db.get_item({"cache_key": f"{self.KEY_PREFIX}{connection_id}"})
+        # TTL deletion lags, so check expiry here
+        if not item or int(item.get("expires_at", 0)) <= now:
+            return None
+        return {
+            "active_connections": int(item.get("active_connections", 0)),
+            "last_activity": int(item.get("last_activity", 0)),
+            "snapshot_at": int(item.get("snapshot_at", 0)),
+        }
+
+
+class GuacamoleClient:
+    """
+    Helper class for Guacamole REST API operations.
+    Creates RDP connections and generates client URLs.
+    """
+    
+    def __init__(
+        self,
+        base_url: str,
+        username: str = "guacadmin",
+        password: str = "guacadmin",
+        timeout: int = 10,
+    ):
+        """
+        Initialize Guacamole client.
+        
+        Args:
+            base_url: Guacamole base URL (e.g., https://guac.example.com/guacamole)
+            username: Admin username
+            password: Admin password
+        """
+        self.base_url = base_url.rstrip("/")
+        self.username = username
+        self.password = password
+        self.token = None
+        self.data_source = "postgresql"  # Default data source
+        # Per-request timeout in seconds for HTTP calls to Guacamole
+        # This can be overridden (e.g. shorter timeout for termination path)
+        self.timeout = timeout
+        
+        self.urllib_parse = urllib.parse
+        # Pooled keep-alive connections, shared across clients and warm invocations
+        self.transport = get_http_transport()
+        # Admin tokens, shared across clients, warm invocations and (optionally) Lambdas
+        self.token_cache = get_guacamole_token_cache()
+        self.token_cache_key = self.token_cache.cache_key(self.base_url, self.username)
+    
+    def _send(self, method: str, url: str, body: Optional[bytes], headers: Dict[str, str],
+              timeout: Optional[float] = None) -> Any:
+        """Send a request over the shared transport and decode the JSON response."""
+        _, response_body = self.transport.request(
+            method,
+            url,
+            body=body,
+            headers=headers,
+            timeout=timeout or self.timeout,
+        )
+        if response_body:
+            return json.loads(response_body.decode("utf-8"))
+        return {}
+    
+    def _make_request(self, method: str, endpoint: str, data: dict = None, 
+                      headers: dict = None, include_token: bool = True,
+                      log_errors: bool = True) -> Optional[dict]:
+        """Make HTTP request to Guacamole API."""
+        url = f"{self.base_url}/api{endpoint}"
+        
+        req_headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        }
+        if headers:
+            req_headers.update(headers)
+        
+        body = None
+        if data:
+            body = json.dumps(data).encode("utf-8")
+        
+        sent_token = self.token if include_token else None
+        try:
+            try:
+                return self._send(method, self._with_token(url, sent_token), body, req_headers)
+            except HTTPStatusError as e:
+                # A cached token may have been expired or revoked server-side:
+                # re-authenticate once and retry with the fresh token
+                if not sent_token or e.status not in (401, 403):
+                    raise
+                logger.info(f"Guacamole rejected admin token (HTTP {e.status}), re-authenticating")
+                self.token_cache.invalidate(self.token_cache_key, sent_token)
+                if not self.authenticate(force=True):
+                    raise
+                return self._send(method, self._with_token(url, self.token), body, req_headers)
+        except Exception as e:
+            if log_errors:
+                logger.error(f"Guacamole API request failed: {method} {url} - {e}")
+            else:
+                logger.debug(f"Guacamole API request failed: {method} {url} - {e}")
+            return None
+    
+    @staticmethod
+    def _with_token(url: str, token: Optional[str]) -> str:
+        if not token:
+            return url
+        return f"{url}{'&' if '?' in url else '?'}token={token}"
+    
+    def authenticate(self, force: bool = False) -> bool:
+        """
+        Authenticate with Guacamole and get auth token.
+        
+        Reuses a cached admin token when one is available, unless force=True.
+        """
+        if not force:
+            cached = self.token_cache.get(self.token_cache_key)
+            if cached:
+                self.token = cached["token"]
+                self.data_source = cached["data_source"]
+                logger.debug(f"Reusing cached Guacamole token, data source: {self.data_source}")
+                return True
+        
+        try:
+            # Guacamole uses form-encoded auth
+            auth_data = self.urllib_parse.urlencode({
+                "username": self.username,
+                "password": self.password,
+            }).encode("utf-8")
+            
+            result = self._send(
+                "POST",
+                f"{self.base_url}/api/tokens",
+                auth_data,
+                {"Content-Type": "application/x-www-form-urlencoded"},
+            )
+            self.token = result.get("authToken")
+            self.data_source = result.get("dataSource", "postgresql")
+            logger.info(f"Guacamole auth successful, data source: {self.data_source}")
+            if self.token:
+                self.token_cache.put(self.token_cache_key, self.token, self.data_source)
+            return self.token is not None
+        except Exception as e:
+            logger.error(f"Guacamole authentication failed: {e}")
+            return False
+    
+    def create_rdp_connection(
+        self,
+        name: str,
+        hostname: str,
+        port: int = 3389,
         username: str = "",
         password: str = "",
         domain: str = "",
@@ -858,6 +1750,42 @@ class GuacamoleClient:
             return True
         return False
     
+    def connection_exists(self, connection_id: str) -> bool:
+        """Check whether a connection can be resolved by its identifier."""
+        if not self.token:
+            if not self.authenticate():
+                return False
+        
+        result = self._make_request(
+            "GET",
+            f"/session/data/{self.data_source}/connections/{connection_id}",
+            log_errors=False,
+        )
+        return bool(result)
+    
+    def is_token_valid(self, token: str, connection_id: Optional[str] = None) -> bool:
+        """
+        Check whether an auth token is accepted by Guacamole.
+        
+        If a connection ID is given, the token must also be able to read that
+        connection, which confirms the user's permission grant has propagated.
+        """
+        if not token:
+            return False
+        
+        if connection_id:
+            endpoint = f"/session/data/{self.data_source}/connections/{connection_id}"
+        else:
+            endpoint = f"/session/data/{self.data_source}/self"
+        
+        result = self._make_request(
+            "GET",
+            f"{endpoint}?token={token}",
+            include_token=False,
+            log_errors=False,
+        )
+        return bool(result)
+    
     def get_connection_url(self, connection_id: str, connection_type: str = "c") -> str:
         """
         Generate a URL to directly access a connection.
@@ -963,17 +1891,23 @@ class GuacamoleClient:
             logger.error(f"Error getting connection activity: {e}")
             return None
     
-    def get_all_active_connections(self) -> Dict[str, Any]:
+    def get_all_active_connections(self, strict: bool = False) -> Dict[str, Any]:
         """
         Get all active connections across the Guacamole server.
         
         Useful for checking overall activity and detecting orphaned sessions.
         
+        Args:
+            strict: Raise RuntimeError if the list can't be fetched, instead of
+                returning {} (which reads as "nothing is connected")
+        
         Returns:
             Dict mapping connection identifiers to their active session info
         """
         if not self.token:
             if not self.authenticate():
+                if strict:
+                    raise RuntimeError("Guacamole authentication failed")
                 return {}
         
         try:
@@ -983,7 +1917,7 @@ class GuacamoleClient:
             )
             
             if result is None:
-                return {}
+                raise RuntimeError("Guacamole returned no active connection list")
             
             # Group by connection identifier
             connections = {}
@@ -1008,6 +1942,8 @@ class GuacamoleClient:
             
         except Exception as e:
             logger.error(f"Error getting all active connections: {e}")
+            if strict:
+                raise
             return {}
     
     def create_user(self, username: str, password: str) -> bool:
@@ -1133,9 +2069,23 @@ class GuacamoleClient:
         Returns:
             List of connection identifiers
         """
+        return self.list_connections_by_hostname().get(hostname, [])
+    
+    def list_connections_by_hostname(self, strict: bool = False) -> Dict[str, list]:
+        """
+        Group every connection identifier by the hostname/IP it points to.
+        
+        One API call, for callers that need to look up many hostnames.
+        
+        Args:
+            strict: Raise RuntimeError if the list can't be fetched, instead of
+                returning {} (which reads as "no connections exist")
+        """
         if not self.token:
             if not self.authenticate():
-                return []
+                if strict:
+                    raise RuntimeError("Guacamole authentication failed")
+                return {}
         
         try:
             # Get all connections
@@ -1144,19 +2094,38 @@ class GuacamoleClient:
                 f"/session/data/{self.data_source}/connections"
             )
             
+            if result is None:
+                raise RuntimeError("Guacamole returned no connection list")
             if not result:
-                return []
+                return {}
             
-            found_ids = []
+            by_hostname = {}
             for conn_id, conn_data in result.items():
-                params = conn_data.get("parameters", {})
-                if params.get("hostname") == hostname:
-                    found_ids.append(conn_id)
+                hostname = conn_data.get("parameters", {}).get("hostname")
+                if hostname:
+                    by_hostname.setdefault(hostname, []).append(conn_id)
             
-            return found_ids
+            return by_hostname
         except Exception as e:
             logger.warning(f"Error finding connections by hostname: {e}")
-            return []
+            if strict:
+                raise
+            return {}
+    
+    def recycle_connection(self, connection_id: str, previous_user: Optional[str] = None) -> int:
+        """
+        Prepare a pre-built pool connection for its next session without deleting it.
+        
+        Force-disconnects any active tunnels and deletes the previous session user,
+        which also revokes that user's permission on the connection.
+        
+        Returns:
+            Number of active sessions killed
+        """
+        killed = self.kill_active_sessions(connection_id)
+        if previous_user:
+            self.delete_user(previous_user)
+        return killed
 
     def grant_connection_permission(self, username: str, connection_id: str) -> bool:
         """
@@ -1210,16 +2179,14 @@ class GuacamoleClient:
                 "password": password,
             }).encode("utf-8")
             
-            request = self.urllib_request.Request(
+            result = self._send(
+                "POST",
                 f"{self.base_url}/api/tokens",
-                data=auth_data,
-                headers={"Content-Type": "application/x-www-form-urlencoded"},
-                method="POST"
+                auth_data,
+                {"Content-Type": "application/x-www-form-urlencoded"},
+                timeout=10,
             )
-            
-            with self.urllib_request.urlopen(request, context=self.ssl_context, timeout=10) as response:
-                result = json.loads(response.read().decode("utf-8"))
-                return result.get("authToken")
+            return result.get("authToken")
         except Exception as e:
             logger.error(f"User authentication failed: {e}")
             return None
@@ -1229,6 +2196,8 @@ class GuacamoleClient:
         session_id: str,
         connection_id: str,
         student_id: str,
+        prober: Optional["ReadinessProber"] = None,
+        ready_timeout: float = 5.0,
     ) -> Optional[str]:
         """
         Create a temporary user for the session, grant them access to the connection,
@@ -1240,6 +2209,8 @@ class GuacamoleClient:
             session_id: The session ID (used to generate unique username)
             connection_id: The connection ID to grant access to
             student_id: The student ID (for username generation)
+            prober: Optional ReadinessProber to record the token wait against
+            ready_timeout: Upper bound in seconds for the session user token to become valid
             
         Returns:
             URL with embedded token for direct access, or None on failure
@@ -1262,29 +2233,29 @@ class GuacamoleClient:
             self.delete_user(username)
             return None
         
-        # Delay to ensure Guacamole propagates user/permission changes
-        # This prevents "disconnected" errors when the URL is opened immediately
-        # Guacamole needs time to fully initialize the user, permissions, and connection state
-        import time
-        logger.info(f"Waiting for Guacamole user/permission propagation...")
-        time.sleep(1.0)
-        logger.info(f"Guacamole user/permission propagation delay complete")
-        
-        # Authenticate as the new user and get their token
-        # Retry up to 3 times as Guacamole might take a moment to propagate
+        # Wait until Guacamole has propagated the user and permission changes:
+        # the new user must authenticate AND its token must resolve the connection.
+        # Opening the URL before that produces "disconnected" errors.
+        prober = prober or ReadinessProber()
         user_token = None
-        for i in range(3):
-            user_token = self.authenticate_user(username, password)
-            if user_token:
-                break
-            logger.info(f"Authentication attempt {i+1} for {username} failed, retrying in 1s...")
-            time.sleep(1.0)
+        
+        def session_user_token_ready() -> bool:
+            nonlocal user_token
+            if not user_token:
+                user_token = self.authenticate_user(username, password)
+            return self.is_token_valid(user_token, connection_id)
+        
+        token_valid = prober.wait_for("session_user_token", session_user_token_ready, ready_timeout)
             
         if not user_token:
             logger.error(f"Failed to authenticate as session user {username} after retries")
             # Don't delete the user here, it might be useful for debugging or next attempt
             return None
         
+        if not token_valid:
+            logger.warning(f"Session user {username} token could not be validated against "
+                           f"connection {connection_id}, returning URL anyway")
+        
         # Generate the URL with the user's token
         # IMPORTANT: Token must be BEFORE the # fragment to be sent to the server!
         # Wrong:   {base_url}/#/client/{encoded_id}?token={token}  <- token not sent
@@ -1297,48 +2268,1908 @@ class GuacamoleClient:
         return f"{self.base_url}/?token={user_token}#/client/{encoded_id}"
 
 
+# Claim condition for AVAILABLE pool instances: skips instances whose Guacamole
+# connection pool-manager is currently preparing (see preparing_until)
+POOL_CLAIM_CONDITION = (
+    "#status = :available AND "
+    "(attribute_not_exists(preparing_until) OR preparing_until < :now)"
+)
+
+
+def get_pooled_connection_id(pool_record: Optional[Dict[str, Any]], instance_ip: Optional[str]) -> Optional[str]:
+    """
+    Return the Guacamole connection pool-manager pre-built for an instance.
+    
+    Returns None if there is none, or if it targets a different address than the
+    instance currently has.
+    """
+    if not pool_record or not instance_ip:
+        return None
+    if pool_record.get("guacamole_connection_ip") != instance_ip:
+        return None
+    return pool_record.get("guacamole_connection_id")
+
+
 # =============================================================================
-# Moodle Token Verification
+# Instance Claims
 # =============================================================================
 
-class MoodleTokenVerifier:
+# How concurrent launches order AVAILABLE candidates: "sharded", "random" or "ordered"
+CLAIM_STRATEGY = os.environ.get("CLAIM_STRATEGY", "sharded")
+# Optional table of claim tickets, one per AVAILABLE instance (see ClaimTicketQueue)
+CLAIM_TICKETS_TABLE = os.environ.get("CLAIM_TICKETS_TABLE", "")
+CLAIM_TICKET_TTL = 3600
+
+
+def order_claim_candidates(candidates: List[Dict[str, Any]], claimant: str, strategy: str = CLAIM_STRATEGY) -> List[Dict[str, Any]]:
     """
-    Verifies signed tokens from the Moodle AttackBox plugin.
+    Order AVAILABLE pool records for one claimant.
     
-    Tokens are signed using HMAC-SHA256 and contain user information,
-    timestamp, expiry, and a nonce for replay attack prevention.
+    With "ordered", every claimant tries records in index order and a burst of
+    launches races for the same first record. "random" shuffles per call.
+    "sharded" sorts by instance_id and walks it from an offset, with a step
+    coprime to its length, both hashed from the claimant. Concurrent launches
+    start on different records without coordinating, and two that collide go
+    separate ways after the lost race instead of onto the same neighbour.
     """
+    if strategy == "ordered" or len(candidates) < 2:
+        return list(candidates)
+    if strategy == "random":
+        shuffled = list(candidates)
+        random.shuffle(shuffled)
+        return shuffled
     
-    def __init__(self, secret: str):
-        """
-        Initialize the token verifier.
-        
-        Args:
-            secret: The shared secret used for verifying token signatures.
-        """
-        self.secret = secret
-        self._used_nonces: set = set()  # In production, use Redis/DynamoDB
-        self._max_nonce_age = 300  # 5 minutes
+    ordered = sorted(candidates, key=lambda record: record["instance_id"])
+    size = len(ordered)
+    digest = hashlib.sha256(claimant.encode()).digest()
+    offset = int.from_bytes(digest[:4], "big") % size
+    step = 1 + int.from_bytes(digest[4:8], "big") % (size - 1) if size > 2 else 1
+    while math.gcd(step, size) != 1:
+        step += 1
+    return [ordered[(offset + n * step) % size] for n in range(size)]
+
+
+class ClaimTicketQueue:
+    """
+    Per-plan queue of claim tickets, one per AVAILABLE instance.
     
-    def verify_token(self, token: str) -> Optional[Dict[str, Any]]:
+    pool-manager issues a ticket for each AVAILABLE instance; a launch takes
+    the next one with a single conditional ADD on the plan's counter item, so
+    concurrent launches never race for the same instance. Items are keyed
+    (plan, seq): seq 0 holds the `issued`/`claimed` counters, seq n the nth
+    ticket. A ticket is only counted in `issued` after it is written, so a
+    taken number always resolves to a ticket. A ticket can go stale (the
+    instance was claimed another way); the claimer then takes the next one.
+    """
+    
+    def __init__(self, table_name: str = CLAIM_TICKETS_TABLE, ttl: int = CLAIM_TICKET_TTL):
+        self.db = DynamoDBClient(table_name)
+        self.ttl = ttl
+    
+    def counters(self, plan: str) -> Dict[str, int]:
+        """Return {issued, claimed} for a plan."""
+        try:
+            item = self.db.table.get_item(Key={"plan": plan, "seq": 0}, ConsistentRead=True).get("Item") or {}
+        except ClientError as e:
+            logger.error(f"[CLAIM_TICKETS] Failed to read counters for {plan}: {e}")
+            item = {}
+        return {"issued": int(item.get("issued", 0)), "claimed": int(item.get("claimed", 0))}
+    
+    def _advance_issued(self, plan: str, seq: int) -> None:
+        # Moves `issued` from seq - 1 to seq; losing means someone else already did
+        self.db.conditional_update(
+            {"plan": plan, "seq": 0},
+            {"issued": seq},
+            condition_expression="attribute_not_exists(issued) OR issued = :previous",
+            expression_attribute_values={":previous": seq - 1},
+        )
+    
+    def issue(self, plan: str, instance_id: str, now: int) -> Optional[int]:
+        """Issue a ticket for an AVAILABLE instance. Returns its sequence number."""
+        seq = self.counters(plan)["issued"] + 1
+        for _ in range(10):
+            try:
+                self.db.table.put_item(
+                    Item={"plan": plan, "seq": seq, "instance_id": instance_id, "issued_at": now, "expires_at": now + self.ttl},
+                    ConditionExpression="attribute_not_exists(seq)",
+                )
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    logger.error(f"[CLAIM_TICKETS] Failed to issue ticket for {instance_id}: {e}")
+                    return None
+                # Another issuer wrote this number; finish its step and take the next one
+                self._advance_issued(plan, seq)
+                seq += 1
+                continue
+            self._advance_issued(plan, seq)
+            return seq
+        logger.warning(f"[CLAIM_TICKETS] Gave up issuing a ticket for {instance_id} under contention")
+        return None
+    
+    def take(self, plan: str, max_skips: int = 3) -> Optional[Dict[str, Any]]:
         """
-        Verify a Moodle-signed token and return the payload if valid.
+        Atomically take the next outstanding ticket for a plan, or None if there is none.
         
-        Args:
-            token: The signed token (base64_payload.signature)
-            
-        Returns:
-            The decoded payload if valid, None if invalid.
+        A taken number whose ticket is gone (expired by TTL) or can't be read
+        is skipped, and the next number is taken, up to max_skips times.
         """
-        if not token or not self.secret:
-            logger.warning("Token verification failed: missing token or secret")
-            return None
-        
-        try:
-            # Split token into payload and signature
-            parts = token.split(".")
-            if len(parts) != 2:
-                logger.warning("Token verification failed: invalid token format")
+        for _ in range(max_skips + 1):
+            try:
+                response = self.db.table.update_item(
+                    Key={"plan": plan, "seq": 0},
+                    UpdateExpression="ADD claimed :one",
+                    ConditionExpression="issued > claimed OR (attribute_not_exists(claimed) AND issued > :zero)",
+                    ExpressionAttributeValues={":one": 1, ":zero": 0},
+                    ReturnValues="UPDATED_NEW",
+                )
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    logger.error(f"[CLAIM_TICKETS] Failed to take a ticket for {plan}: {e}")
+                return None
+            
+            seq = int(response["Attributes"]["claimed"])
+            try:
+                ticket = self.db.table.get_item(Key={"plan": plan, "seq": seq}, ConsistentRead=True).get("Item")
+            except ClientError as e:
+                logger.error(f"[CLAIM_TICKETS] Failed to read ticket {plan}/{seq}: {e}")
+                continue
+            if ticket:
+                return ticket
+            logger.info(f"[CLAIM_TICKETS] Ticket {plan}/{seq} has expired, taking the next one")
+        return None
+
+
+class InstanceClaimer:
+    """
+    Claims an AVAILABLE pool instance for a session.
+    
+    Outstanding claim tickets are tried first, when a ClaimTicketQueue is
+    given. Otherwise, or once they run out, AVAILABLE records are read from
+    PlanStatusIndex and tried in `order_claim_candidates` order with
+    POOL_CLAIM_CONDITION. A lost race moves straight on to the next candidate;
+    a round that loses every race re-reads the index after a short jittered
+    pause. `stats` counts claim attempts, lost races, rounds and tickets used
+    for the last claim.
+    """
+    
+    def __init__(
+        self,
+        pool_db,
+        strategy: str = CLAIM_STRATEGY,
+        tickets: Optional[ClaimTicketQueue] = None,
+        max_rounds: int = 3,
+        max_ticket_draws: int = 3,
+    ):
+        self.pool_db = pool_db
+        self.strategy = strategy
+        self.tickets = tickets
+        self.max_rounds = max_rounds
+        self.max_ticket_draws = max_ticket_draws
+        self.stats = {}
+    
+    def _try_claim(self, instance_id: str, assignment: Dict[str, Any], now: int) -> Optional[Dict[str, Any]]:
+        self.stats["attempts"] += 1
+        previous = self.pool_db.conditional_update(
+            {"instance_id": instance_id},
+            assignment,
+            condition_expression=POOL_CLAIM_CONDITION,
+            expression_attribute_names={"#status": "status"},
+            expression_attribute_values={
+                ":available": InstanceStatus.AVAILABLE,
+                ":now": now,
+            },
+            return_old=True,
+        )
+        if not previous:
+            self.stats["conflicts"] += 1
+            return None
+        return previous
+    
+    def claim(self, plan: str, claimant: str, assignment: Dict[str, Any], now: int,
+              exclude: Optional[set] = None) -> Optional[Dict[str, Any]]:
+        """
+        Claim an AVAILABLE instance of `plan`, writing `assignment` to its pool record.
+        
+        Returns the record as it was before the claim (so pre-built connection
+        and previous session user are still visible), or None if none could be
+        claimed. Instances in `exclude` are skipped.
+        """
+        self.stats = {"attempts": 0, "conflicts": 0, "rounds": 0, "tickets": 0}
+        exclude = exclude or set()
+        
+        if self.tickets:
+            for _ in range(self.max_ticket_draws):
+                ticket = self.tickets.take(plan)
+                if not ticket:
+                    break
+                self.stats["tickets"] += 1
+                if ticket["instance_id"] in exclude:
+                    continue
+                previous = self._try_claim(ticket["instance_id"], assignment, now)
+                if previous:
+                    return previous
+        
+        for round_number in range(self.max_rounds):
+            if round_number:
+                # Full jitter keeps retrying launches from re-reading the index in lockstep
+                time.sleep(random.uniform(0, 0.05 * 2 ** round_number))
+            self.stats["rounds"] += 1
+            
+            candidates = [
+                record for record in self.pool_db.query_by_composite_key(
+                    "PlanStatusIndex", "plan", plan, "status", InstanceStatus.AVAILABLE
+                )
+                if record["instance_id"] not in exclude
+            ]
+            if not candidates:
+                return None
+            
+            for record in order_claim_candidates(candidates, f"{claimant}:{round_number}", self.strategy):
+                previous = self._try_claim(record["instance_id"], assignment, now)
+                if previous:
+                    return previous
+        
+        return None
+
+
+_claim_tickets = None
+
+
+def get_claim_tickets() -> Optional[ClaimTicketQueue]:
+    """Return the claim ticket queue, or None when CLAIM_TICKETS_TABLE is not set."""
+    global _claim_tickets
+    if _claim_tickets is None and CLAIM_TICKETS_TABLE:
+        _claim_tickets = ClaimTicketQueue(CLAIM_TICKETS_TABLE)
+    return _claim_tickets
+
+
+# =============================================================================
+# Readiness Probing
+# =============================================================================
+
+# TPKT header + X.224 Connection Request + RDP Negotiation Request (TLS | CredSSP)
+RDP_NEGOTIATION_REQUEST = bytes([
+    0x03, 0x00, 0x00, 0x13,
+    0x0E, 0xE0, 0x00, 0x00, 0x00, 0x00, 0x00,
+    0x01, 0x00, 0x08, 0x00, 0x03, 0x00, 0x00, 0x00,
+])
+
+
+def probe_rdp(host: str, port: int = 3389, timeout: float = 2.0) -> bool:
+    """
+    Check that an RDP server completes the X.224 connection handshake.
+    
+    A bare TCP connect is not enough: xrdp accepts sockets before it is able
+    to serve sessions. A Connection Confirm reply means a new session can start.
+    """
+    if not host:
+        return False
+    
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            sock.settimeout(timeout)
+            sock.sendall(RDP_NEGOTIATION_REQUEST)
+            response = sock.recv(64)
+    except OSError:
+        return False
+    
+    # TPKT version 3, X.224 Connection Confirm (0xD0) code
+    return len(response) >= 6 and response[0] == 0x03 and (response[5] & 0xF0) == 0xD0
+
+
+class ReadinessProber:
+    """
+    Waits for readiness conditions with bounded exponential polling.
+    
+    Each wait ends as soon as its condition is true, and per-probe timings
+    are recorded so the condition that dominates launch latency is visible.
+    """
+    
+    def __init__(self, initial_interval: float = 0.1, max_interval: float = 2.0, backoff: float = 2.0):
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.timings: Dict[str, Dict[str, Any]] = {}
+    
+    def wait_for(self, name: str, check, timeout: float) -> bool:
+        """
+        Poll check() until it returns True or the timeout elapses.
+        
+        Exceptions raised by check() count as "not ready yet".
+        Returns whether the condition became true.
+        """
+        start = time.monotonic()
+        deadline = start + max(0.0, timeout)
+        interval = self.initial_interval
+        attempts = 0
+        
+        while True:
+            attempts += 1
+            try:
+                ready = bool(check())
+            except Exception as e:
+                logger.debug(f"[READINESS] {name} probe raised: {e}")
+                ready = False
+            
+            remaining = deadline - time.monotonic()
+            if ready or remaining <= 0:
+                break
+            
+            time.sleep(min(interval, remaining))
+            interval = min(interval * self.backoff, self.max_interval)
+        
+        elapsed_ms = int((time.monotonic() - start) * 1000)
+        previous = self.timings.get(name)
+        self.timings[name] = {
+            "ready": ready,
+            "elapsed_ms": elapsed_ms + (previous["elapsed_ms"] if previous else 0),
+            "attempts": attempts + (previous["attempts"] if previous else 0),
+        }
+        
+        if ready:
+            logger.info(f"[READINESS] {name} ready after {elapsed_ms}ms ({attempts} attempt(s))")
+        else:
+            logger.warning(f"[READINESS] {name} NOT ready after {elapsed_ms}ms ({attempts} attempt(s))")
+        return ready
+    
+    def skip(self, name: str, reason: str) -> None:
+        """Record a probe that was not run."""
+        self.timings[name] = {"ready": None, "elapsed_ms": 0, "attempts": 0, "skipped": reason}
+    
+    def summary(self) -> Dict[str, Any]:
+        """Return per-probe timings plus the total and the slowest probe."""
+        total_ms = sum(t["elapsed_ms"] for t in self.timings.values())
+        slowest = max(self.timings, key=lambda n: self.timings[n]["elapsed_ms"], default=None)
+        return {
+            "probes": self.timings,
+            "total_ms": total_ms,
+            "slowest": slowest,
+        }
+
+
+# =============================================================================
+# Launch Queue
+# =============================================================================
+
+# Set LAUNCH_QUEUE_URL for SQS, or LAUNCH_QUEUE_DIR for a file-backed spool
+# shared between local processes. With neither, jobs stay in-process.
+LAUNCH_QUEUE_URL = os.environ.get("LAUNCH_QUEUE_URL", "")
+LAUNCH_QUEUE_DIR = os.environ.get("LAUNCH_QUEUE_DIR", "")
+# A worker's claim on a PENDING session (provisioning_started_at) lapses after
+# this long, so a redelivered or re-queued job can take over from a worker that
+# died. Must exceed the provisioning worker's timeout.
+PROVISIONING_LEASE = int(os.environ.get("PROVISIONING_LEASE", "150"))
+
+
+class LaunchQueue(abc.ABC):
+    """
+    Queue of session launch jobs consumed by the provisioning worker.
+    
+    Jobs are small JSON-serializable dicts. `receive` returns (receipt, job)
+    pairs; a job is only removed once its receipt is passed to `delete`.
+    A job sent with `delay_seconds` is not received before the delay elapses.
+    """
+    
+    @abc.abstractmethod
+    def send(self, job: Dict[str, Any], delay_seconds: int = 0) -> bool:
+        """Enqueue a job; return False if it could not be enqueued."""
+    
+    @abc.abstractmethod
+    def receive(self, max_messages: int = 10) -> List[Tuple[str, Dict[str, Any]]]:
+        """Return up to max_messages visible (receipt, job) pairs."""
+    
+    @abc.abstractmethod
+    def delete(self, receipt: str) -> None:
+        """Remove a received job."""
+
+
+class SQSLaunchQueue(LaunchQueue):
+    """Launch queue backed by an SQS queue."""
+    
+    def __init__(self, queue_url: str):
+        self.queue_url = queue_url
+        self.sqs = boto3.client("sqs", region_name=AWS_REGION)
+    
+    def send(self, job: Dict[str, Any], delay_seconds: int = 0) -> bool:
+        try:
+            self.sqs.send_message(
+                QueueUrl=self.queue_url,
+                MessageBody=json.dumps(job, cls=DecimalEncoder),
+                # SQS caps message delays at 15 minutes
+                DelaySeconds=max(0, min(int(delay_seconds), 900)),
+            )
+            return True
+        except ClientError as e:
+            logger.error(f"Failed to enqueue launch job: {e}")
+            return False
+    
+    def receive(self, max_messages: int = 10) -> List[Tuple[str, Dict[str, Any]]]:
+        try:
+            response = self.sqs.receive_message(
+                QueueUrl=self.queue_url,
+                MaxNumberOfMessages=min(max_messages, 10),
+                WaitTimeSeconds=1,
+            )
+        except ClientError as e:
+            logger.error(f"Failed to receive launch jobs: {e}")
+            return []
+        return [
+            (message["ReceiptHandle"], json.loads(message["Body"]))
+            for message in response.get("Messages", [])
+        ]
+    
+    def delete(self, receipt: str) -> None:
+        try:
+            self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=receipt)
+        except ClientError as e:
+            logger.warning(f"Failed to delete launch job: {e}")
+
+
+class MemoryLaunchQueue(LaunchQueue):
+    """In-process launch queue for local runs; jobs are lost when the process exits."""
+    
+    def __init__(self):
+        self._jobs = deque()
+        self._lock = threading.Lock()
+    
+    def send(self, job: Dict[str, Any], delay_seconds: int = 0) -> bool:
+        # Round-trip through JSON so local runs see the same types as SQS
+        with self._lock:
+            self._jobs.append((
+                time.time() + delay_seconds,
+                uuid.uuid4().hex,
+                json.loads(json.dumps(job, cls=DecimalEncoder)),
+            ))
+        return True
+    
+    def receive(self, max_messages: int = 10) -> List[Tuple[str, Dict[str, Any]]]:
+        now = time.time()
+        with self._lock:
+            batch = []
+            delayed = deque()
+            while self._jobs and len(batch) < max_messages:
+                visible_at, receipt, job = self._jobs.popleft()
+                if visible_at > now:
+                    delayed.append((visible_at, receipt, job))
+                else:
+                    batch.append((receipt, job))
+            self._jobs.extendleft(reversed(delayed))
+            return batch
+    
+    def delete(self, receipt: str) -> None:
+        pass
+    
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+
+class FileLaunchQueue(LaunchQueue):
+    """
+    Launch queue spooled to a directory, one JSON file per job.
+    
+    Receiving renames a job file to `.claimed`, which is atomic on one
+    filesystem, so several local workers can share the directory. File names
+    start with the time a job becomes visible, so delayed jobs sort last.
+    """
+    
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+    
+    def send(self, job: Dict[str, Any], delay_seconds: int = 0) -> bool:
+        visible_at = time.time_ns() + int(delay_seconds * 1_000_000_000)
+        name = f"{visible_at:020d}-{uuid.uuid4().hex[:8]}.json"
+        tmp_path = os.path.join(self.directory, f".{name}.tmp")
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(job, f, cls=DecimalEncoder)
+            os.replace(tmp_path, os.path.join(self.directory, name))
+            return True
+        except OSError as e:
+            logger.error(f"Failed to spool launch job to {self.directory}: {e}")
+            return False
+    
+    def receive(self, max_messages: int = 10) -> List[Tuple[str, Dict[str, Any]]]:
+        batch = []
+        now = time.time_ns()
+        for name in sorted(os.listdir(self.directory)):
+            if len(batch) >= max_messages:
+                break
+            if not name.endswith(".json"):
+                continue
+            if int(name.split("-", 1)[0]) > now:
+                break  # This and every later job is still delayed
+            
+            path = os.path.join(self.directory, name)
+            claimed_path = f"{path}.claimed"
+            try:
+                os.rename(path, claimed_path)
+                with open(claimed_path) as f:
+                    batch.append((claimed_path, json.load(f)))
+            except FileNotFoundError:
+                continue  # Claimed by another worker
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping unreadable launch job {name}: {e}")
+        return batch
+    
+    def delete(self, receipt: str) -> None:
+        try:
+            os.remove(receipt)
+        except FileNotFoundError:
+            pass
+
+
+def parse_sqs_launch_jobs(event: Dict[str, Any]) -> List[Tuple[str, Dict[str, Any]]]:
+    """Return (message_id, job) pairs from an SQS-triggered Lambda event."""
+    jobs = []
+    for record in event.get("Records", []):
+        if record.get("eventSource") != "aws:sqs":
+            continue
+        try:
+            jobs.append((record["messageId"], json.loads(record["body"])))
+        except (KeyError, ValueError) as e:
+            logger.warning(f"Skipping malformed launch job record: {e}")
+    return jobs
+
+
+# Shared across warm invocations of the same Lambda container
+_launch_queue = None
+
+
+def get_launch_queue() -> LaunchQueue:
+    """Return the launch queue selected by LAUNCH_QUEUE_URL / LAUNCH_QUEUE_DIR."""
+    global _launch_queue
+    if _launch_queue is None:
+        if LAUNCH_QUEUE_URL:
+            _launch_queue = SQSLaunchQueue(LAUNCH_QUEUE_URL)
+        elif LAUNCH_QUEUE_DIR:
+            _launch_queue = FileLaunchQueue(LAUNCH_QUEUE_DIR)
+        else:
+            _launch_queue = MemoryLaunchQueue()
+    return _launch_queue
+
+
+# =============================================================================
+# Launch Single-Flight
+# =============================================================================
+
+# Lease on a student's launch lock; a crashed holder frees it when this runs out
+LAUNCH_LOCK_LEASE = int(os.environ.get("LAUNCH_LOCK_LEASE", "60"))
+# How long a duplicate launch waits for the first one before giving up with 409
+LAUNCH_LOCK_WAIT = float(os.environ.get("LAUNCH_LOCK_WAIT", "15"))
+# How long a launch response is replayed for its Idempotency-Key
+IDEMPOTENCY_TTL = int(os.environ.get("IDEMPOTENCY_TTL", "86400"))
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+
+class LaunchGate:
+    """
+    Per-student single-flight lock and Idempotency-Key response cache.
+    
+    Both live in the cache table. The lock is a conditional put with a lease
+    (expires_at), so only one launch per student runs at a time. Duplicates
+    poll until it is released, then either replay the stored response for
+    their Idempotency-Key or run themselves, when the launch's existing
+    session check returns the session the first request created. Responses
+    other than 5xx are stored per (student, key) so retries replay them.
+    
+    If the cache table is unavailable, launches run without the lock.
+    """
+    
+    LOCK_PREFIX = "launch-lock#"
+    RESPONSE_PREFIX = "idempotency#"
+    
+    def __init__(
+        self,
+        table_name: str = CACHE_TABLE,
+        lease: int = LAUNCH_LOCK_LEASE,
+        wait: float = LAUNCH_LOCK_WAIT,
+        response_ttl: int = IDEMPOTENCY_TTL,
+    ):
+        self.db = DynamoDBClient(table_name)
+        self.lease = lease
+        self.wait = wait
+        self.response_ttl = response_ttl
+    
+    def acquire(self, student_id: str, owner: str) -> bool:
+        """Take the student's launch lock. Returns False while another launch holds it."""
+        now = get_current_timestamp()
+        try:
+            self.db.table.put_item(
+                Item={"cache_key": f"{self.LOCK_PREFIX}{student_id}", "owner": owner, "expires_at": now + self.lease},
+                # TTL deletion lags, so an expired lease doesn't count as held
+                ConditionExpression="attribute_not_exists(cache_key) OR expires_at < :now",
+                ExpressionAttributeValues={":now": now},
+            )
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            logger.warning(f"[LAUNCH_GATE] Lock unavailable, launching without it: {e}")
+            return True
+    
+    def release(self, student_id: str, owner: str) -> None:
+        """Release the lock if this launch still holds it."""
+        try:
+            self.db.table.delete_item(
+                Key={"cache_key": f"{self.LOCK_PREFIX}{student_id}"},
+                ConditionExpression="#owner = :owner",
+                ExpressionAttributeNames={"#owner": "owner"},
+                ExpressionAttributeValues={":owner": owner},
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                logger.warning(f"[LAUNCH_GATE] Failed to release launch lock for {student_id}: {e}")
+    
+    def get_response(self, student_id: str, idempotency_key: str) -> Optional[Dict[str, Any]]:
+        """Return the stored response for an Idempotency-Key, marked as replayed."""
+        item = self.db.get_item({"cache_key": f"{self.RESPONSE_PREFIX}{student_id}#{idempotency_key}"})
+        if not item or int(item.get("expires_at", 0)) < get_current_timestamp():
+            return None
+        response = json.loads(item["response"])
+        response["headers"] = {**response.get("headers", {}), "Idempotent-Replayed": "true"}
+        return response
+    
+    def put_response(self, student_id: str, idempotency_key: str, response: Dict[str, Any]) -> None:
+        """Store a launch response for replay."""
+        self.db.put_item({
+            "cache_key": f"{self.RESPONSE_PREFIX}{student_id}#{idempotency_key}",
+            "response": json.dumps(response, cls=DecimalEncoder),
+            "expires_at": get_current_timestamp() + self.response_ttl,
+        })
+    
+    def run(self, student_id: str, idempotency_key: Optional[str], launch: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        """Run `launch` as the student's only launch in flight, replaying stored responses."""
+        if idempotency_key:
+            replay = self.get_response(student_id, idempotency_key)
+            if replay:
+                logger.info(f"[LAUNCH_GATE] Replaying launch response for {student_id}")
+                return replay
+        
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + self.wait
+        delay = 0.1
+        while not self.acquire(student_id, owner):
+            if time.monotonic() >= deadline:
+                logger.warning(f"[LAUNCH_GATE] Launch for {student_id} still in progress after {self.wait}s")
+                return error_response(409, "A launch for this student is already in progress. Please retry shortly.")
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+            if idempotency_key:
+                replay = self.get_response(student_id, idempotency_key)
+                if replay:
+                    logger.info(f"[LAUNCH_GATE] Sharing the concurrent launch response for {student_id}")
+                    return replay
+        
+        try:
+            if idempotency_key:
+                # The holder we waited for may have finished between our check and the lock
+                replay = self.get_response(student_id, idempotency_key)
+                if replay:
+                    return replay
+            
+            response = launch()
+            if idempotency_key and response.get("statusCode", 500) < 500:
+                self.put_response(student_id, idempotency_key, response)
+            return response
+        finally:
+            self.release(student_id, owner)
+
+
+# =============================================================================
+# Stream Image Decoding
+# =============================================================================
+
+def _decode_number(value: str) -> Any:
+    # Most numbers in our tables are timestamps and counters
+    if "." in value or "e" in value or "E" in value:
+        return Decimal(value)
+    return int(value)
+
+
+def decode_stream_value(value: Dict[str, Any]) -> Any:
+    """
+    Decode one typed DynamoDB stream attribute value, e.g. {"N": "1.5"}.
+    
+    Numbers decode to int when integral and Decimal otherwise, string and
+    number sets to sets, and binary values stay base64-encoded as delivered.
+    """
+    for type_code, raw in value.items():
+        # Ordered by how often each type appears in session images
+        if type_code == "S":
+            return raw
+        if type_code == "N":
+            if "." in raw or "e" in raw or "E" in raw:
+                return Decimal(raw)
+            return int(raw)
+        if type_code == "M":
+            return {k: decode_stream_value(v) for k, v in raw.items()}
+        if type_code == "BOOL":
+            return raw
+        if type_code == "NULL":
+            return None
+        if type_code == "L":
+            return [decode_stream_value(v) for v in raw]
+        if type_code == "SS" or type_code == "BS":
+            return set(raw)
+        if type_code == "NS":
+            return {_decode_number(v) for v in raw}
+        if type_code == "B":
+            return raw
+        raise ValueError(f"Unknown DynamoDB attribute type: {type_code}")
+    raise ValueError("Empty DynamoDB attribute value")
+
+
+class StreamImage(Mapping):
+    """
+    Read-only view of a DynamoDB stream image (NewImage/OldImage).
+    
+    Attributes are decoded on first access and cached, so large nested maps
+    such as connection_info are only decoded if something reads them.
+    `raw_equal` compares an attribute between two images without decoding it.
+    """
+    
+    __slots__ = ("_raw", "_decoded")
+    
+    def __init__(self, raw: Optional[Dict[str, Any]]):
+        self._raw = raw or {}
+        self._decoded = {}
+    
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return self._decoded[key]
+        except KeyError:
+            value = decode_stream_value(self._raw[key])
+            self._decoded[key] = value
+            return value
+    
+    def __iter__(self):
+        return iter(self._raw)
+    
+    def __len__(self) -> int:
+        return len(self._raw)
+    
+    def raw_equal(self, other: "StreamImage", key: str) -> bool:
+        return self._raw.get(key) == other._raw.get(key)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {key: self[key] for key in self._raw}
+
+
+# =============================================================================
+# Session Heartbeats
+# =============================================================================
+
+# Narrow per-session heartbeat records (hash key "session_id", TTL on "expires_at")
+HEARTBEATS_TABLE = os.environ.get("HEARTBEATS_TABLE", "")
+# Heartbeat records outlive the longest idle termination threshold
+HEARTBEAT_TTL = int(os.environ.get("HEARTBEAT_TTL", "7200"))
+
+
+class HeartbeatStore:
+    """
+    Latest heartbeat per session, kept out of the session item.
+    
+    Each heartbeat overwrites one small record here, so its write cost doesn't
+    depend on the session item's size and it produces no sessions stream
+    record. session-heartbeat only writes the session itself on state
+    transitions, and pool-manager reads these records in bulk for idle checks.
+    """
+    
+    FIELDS = ["session_id", "last_active_at", "last_heartbeat_at", "idle_seconds", "guacamole_connected", "focus_mode"]
+    
+    def __init__(self, table_name: str = HEARTBEATS_TABLE, ttl: int = HEARTBEAT_TTL):
+        self.db = DynamoDBClient(table_name)
+        self.ttl = ttl
+    
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        return self.db.get_item({"session_id": session_id})
+    
+    def put(self, session_id: str, now: int, **fields: Any) -> bool:
+        item = {field: fields[field] for field in self.FIELDS if fields.get(field) is not None}
+        item.update({"session_id": session_id, "last_heartbeat_at": now, "expires_at": now + self.ttl})
+        return self.db.put_item(item)
+    
+    def get_many(self, session_ids: List[str], strict: bool = False) -> Dict[str, Dict[str, Any]]:
+        """Return {session_id: record} for the sessions that have one. With strict, a failed read raises."""
+        if not session_ids:
+            return {}
+        items = self.db.batch_get(
+            [{"session_id": session_id} for session_id in session_ids], projection=self.FIELDS, strict=strict
+        )
+        return {item["session_id"]: item for item in items}
+
+
+# =============================================================================
+# Active Session Pointers
+# =============================================================================
+
+# One item per student listing their live session IDs (hash key "student_id")
+ACTIVE_SESSIONS_TABLE = os.environ.get("ACTIVE_SESSIONS_TABLE", "")
+
+LIVE_SESSION_STATUSES = [
+    SessionStatus.PENDING,
+    SessionStatus.PROVISIONING,
+    SessionStatus.READY,
+    SessionStatus.ACTIVE,
+]
+
+
+class ActiveSessionPointers:
+    """
+    Per-student pointer to live sessions, so the launch check is one GetItem.
+    
+    The pointer holds a string set `session_ids`. Creating a session adds to it
+    in the same transaction as the session put, conditional on the set being
+    below MAX_SESSIONS, and terminate-session and stale-session cleanup remove
+    from it in the same transaction as the status change. Other terminations
+    (expiry, idle, errors) are removed by session-stats from the sessions
+    stream, and `live_sessions` drops any entry whose session is no longer
+    live, so a lagging entry costs one extra read and never blocks a launch.
+    A missing pointer (students from before the pointer existed) returns None
+    and callers fall back to StudentCreatedIndex, then `seed` it.
+    """
+    
+    def __init__(self, sessions_db: "DynamoDBClient", table_name: str = ACTIVE_SESSIONS_TABLE):
+        self.sessions_db = sessions_db
+        self.db = DynamoDBClient(table_name)
+        self.client = self.db.dynamodb.meta.client
+    
+    def _pointer_add(self, student_id: str, session_id: str, max_sessions: int, now: int) -> Dict[str, Any]:
+        return {"Update": {
+            "TableName": self.db.table_name,
+            "Key": {"student_id": student_id},
+            "UpdateExpression": "ADD session_ids :ids SET updated_at = :now",
+            "ConditionExpression": "attribute_not_exists(session_ids) OR size(session_ids) < :max",
+            "ExpressionAttributeValues": {":ids": {session_id}, ":now": now, ":max": max_sessions},
+        }}
+    
+    def _pointer_remove(self, student_id: str, session_id: str, now: int) -> Dict[str, Any]:
+        return {"Update": {
+            "TableName": self.db.table_name,
+            "Key": {"student_id": student_id},
+            "UpdateExpression": "DELETE session_ids :ids SET updated_at = :now",
+            "ExpressionAttributeValues": {":ids": {session_id}, ":now": now},
+        }}
+    
+    def live_sessions(self, student_id: str) -> Optional[List[Dict[str, Any]]]:
+        """
+        Return the student's live sessions via the pointer, or None if there is no pointer.
+        
+        Entries whose session is gone or no longer live are removed from the pointer.
+        """
+        try:
+            pointer = self.db.table.get_item(Key={"student_id": student_id}, ConsistentRead=True).get("Item")
+        except ClientError as e:
+            logger.warning(f"[ACTIVE_POINTER] Failed to read pointer for {student_id}: {e}")
+            return None
+        if pointer is None:
+            return None
+        
+        live = []
+        for session_id in sorted(pointer.get("session_ids") or ()):
+            try:
+                session = self.sessions_db.table.get_item(Key={"session_id": session_id}, ConsistentRead=True).get("Item")
+            except ClientError as e:
+                logger.warning(f"[ACTIVE_POINTER] Failed to read session {session_id}: {e}")
+                return None
+            if session and session.get("status") in LIVE_SESSION_STATUSES:
+                live.append(session)
+            else:
+                self.release(student_id, session_id)
+        # Newest first, like the StudentCreatedIndex fallback
+        live.sort(key=lambda s: (int(s.get("created_at") or 0), s["session_id"]), reverse=True)
+        return live
+    
+    def seed(self, student_id: str, sessions: List[Dict[str, Any]]) -> None:
+        """Create a missing pointer from sessions found through StudentCreatedIndex."""
+        item = {"student_id": student_id, "updated_at": get_current_timestamp()}
+        session_ids = {s["session_id"] for s in sessions if s.get("status") in LIVE_SESSION_STATUSES}
+        if session_ids:
+            item["session_ids"] = session_ids
+        try:
+            self.db.table.put_item(Item=item, ConditionExpression="attribute_not_exists(student_id)")
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                logger.warning(f"[ACTIVE_POINTER] Failed to seed pointer for {student_id}: {e}")
+    
+    def create_session(self, session: Dict[str, Any], max_sessions: int) -> Optional[bool]:
+        """
+        Write a new session and add it to its student's pointer in one transaction.
+        
+        Returns False if the student already has max_sessions live sessions,
+        None if the write failed for any other reason.
+        """
+        try:
+            self.client.transact_write_items(TransactItems=[
+                {"Put": {
+                    "TableName": self.sessions_db.table_name,
+                    "Item": session,
+                    "ConditionExpression": "attribute_not_exists(session_id)",
+                }},
+                self._pointer_add(session["student_id"], session["session_id"], max_sessions, session["updated_at"]),
+            ])
+            return True
+        except ClientError as e:
+            reasons = [r.get("Code") for r in e.response.get("CancellationReasons", [])]
+            if len(reasons) > 1 and reasons[1] == "ConditionalCheckFailed":
+                logger.warning(f"[ACTIVE_POINTER] Session limit reached for {session['student_id']}")
+                return False
+            logger.error(f"[ACTIVE_POINTER] Failed to create session {session['session_id']}: {e}")
+            return None
+    
+    def end_session(self, session: Dict[str, Any], updates: Dict[str, Any]) -> bool:
+        """Apply a terminal status update to a session and remove it from the pointer in one transaction."""
+        now = updates.get("updated_at") or get_current_timestamp()
+        names = {f"#{k}": k for k in updates}
+        values = {f":{k}": v for k, v in updates.items()}
+        try:
+            self.client.transact_write_items(TransactItems=[
+                {"Update": {
+                    "TableName": self.sessions_db.table_name,
+                    "Key": {"session_id": session["session_id"]},
+                    "UpdateExpression": "SET " + ", ".join(f"#{k} = :{k}" for k in updates),
+                    "ExpressionAttributeNames": names,
+                    "ExpressionAttributeValues": values,
+                }},
+                self._pointer_remove(session["student_id"], session["session_id"], now),
+            ])
+            return True
+        except ClientError as e:
+            logger.error(f"[ACTIVE_POINTER] Failed to end session {session['session_id']}: {e}")
+            return False
+    
+    def release(self, student_id: str, session_id: str) -> None:
+        """Remove a session from its student's pointer."""
+        try:
+            self.db.table.update_item(
+                Key={"student_id": student_id},
+                UpdateExpression="DELETE session_ids :ids",
+                ConditionExpression="attribute_exists(student_id)",
+                ExpressionAttributeValues={":ids": {session_id}},
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                logger.warning(f"[ACTIVE_POINTER] Failed to release {session_id} for {student_id}: {e}")
+
+
+# =============================================================================
+# Session Statistics
+# =============================================================================
+
+# Stream-maintained aggregates (hash key "pk", range key "sk", TTL on "ttl")
+STATS_TABLE = os.environ.get("STATS_TABLE", "")
+# How long finished sessions stay in the recent-sessions view
+RECENT_SESSIONS_RETENTION_DAYS = int(os.environ.get("RECENT_SESSIONS_RETENTION_DAYS", "7"))
+
+
+class SessionStatsStore:
+    """
+    Aggregates over the sessions and instance pool tables, kept current by the
+    session-stats stream consumer so admin reads never scan the source tables.
+    
+    Layout:
+        pk="counters", sk="sessions" | "sessions#plan#<plan>" | "pool" | "pool#plan#<plan>"
+            count_<status> and total attributes, maintained with atomic ADDs
+        pk="recent", sk="<created_at>#<session_id>"
+            compact copy of the session (RECENT_FIELDS), newest first
+        pk="applied", sk="<stream eventID>#<part>"
+            marker of a stream record whose counter updates were written (apply_once)
+    
+    Write methods raise ClientError so the stream consumer can retry the record.
+    """
+    
+    COUNTERS_PK = "counters"
+    RECENT_PK = "recent"
+    APPLIED_PK = "applied"
+    # Stream records are retried for at most 24 hours
+    APPLIED_RETENTION = 2 * 86400
+    MAX_TRANSACTION_ITEMS = 100
+    RECENT_FIELDS = [
+        "session_id", "student_id", "student_name", "plan", "status", "instance_id",
+        "instance_ip", "created_at", "expires_at", "terminated_at",
+        "termination_reason", "error",
+    ]
+    
+    def __init__(self, table_name: str = STATS_TABLE):
+        self.db = DynamoDBClient(table_name)
+    
+    @staticmethod
+    def counter_keys(kind: str, plan: Optional[str]) -> List[str]:
+        keys = [kind]
+        if plan:
+            keys.append(f"{kind}#plan#{plan}")
+        return keys
+    
+    def transition_updates(
+        self,
+        kind: str,
+        old: Optional[Tuple[Optional[str], Optional[str]]],
+        new: Optional[Tuple[Optional[str], Optional[str]]],
+    ) -> List[Dict[str, Any]]:
+        """
+        Return the transaction updates that move one item between counters,
+        to be written with `apply_once`.
+        
+        Args:
+            kind: "sessions" or "pool"
+            old: (plan, status) before the change, None for an insert
+            new: (plan, status) after the change, None for a removal
+        """
+        if old == new:
+            return []
+        
+        deltas = {}  # sk -> {status: delta}
+        for state, step in ((old, -1), (new, 1)):
+            if not state or not state[1]:
+                continue
+            plan, status = state
+            for sk in self.counter_keys(kind, plan):
+                deltas.setdefault(sk, {})
+                deltas[sk][status] = deltas[sk].get(status, 0) + step
+        
+        updates = []
+        for sk, by_status in deltas.items():
+            by_status = {status: delta for status, delta in by_status.items() if delta}
+            total = sum(by_status.values())
+            if not by_status:
+                continue
+            
+            names = {f"#c{i}": f"count_{status}" for i, status in enumerate(by_status)}
+            values = {f":c{i}": delta for i, delta in enumerate(by_status.values())}
+            clauses = [f"#c{i} :c{i}" for i in range(len(by_status))]
+            if total:
+                names["#total"] = "total"
+                values[":total"] = total
+                clauses.append("#total :total")
+            
+            updates.append({"Update": {
+                "TableName": self.db.table_name,
+                "Key": {"pk": self.COUNTERS_PK, "sk": sk},
+                "UpdateExpression": "ADD " + ", ".join(clauses),
+                "ExpressionAttributeNames": names,
+                "ExpressionAttributeValues": values,
+            }})
+        return updates
+    
+    def apply_once(self, record_id: str, updates: List[Dict[str, Any]]) -> bool:
+        """
+        Write the updates of one stream record exactly once.
+        
+        The updates go in one transaction with a marker item keyed by the
+        record's ID, conditional on the marker not existing, so a retried
+        record whose updates were already written is a no-op. Markers expire
+        after APPLIED_RETENTION, past the point a stream record can be retried.
+        
+        Returns:
+            False if there was nothing to write or the record was already applied
+        """
+        applied = False
+        expires_at = get_current_timestamp() + self.APPLIED_RETENTION
+        # One slot of each transaction is the marker
+        for part, start in enumerate(range(0, len(updates), self.MAX_TRANSACTION_ITEMS - 1)):
+            marker = {"Put": {
+                "TableName": self.db.table_name,
+                "Item": {"pk": self.APPLIED_PK, "sk": f"{record_id}#{part}", "ttl": expires_at},
+                "ConditionExpression": "attribute_not_exists(sk)",
+            }}
+            try:
+                self.db.dynamodb.meta.client.transact_write_items(
+                    TransactItems=[marker] + updates[start:start + self.MAX_TRANSACTION_ITEMS - 1]
+                )
+                applied = True
+            except ClientError as e:
+                reasons = [r.get("Code") for r in e.response.get("CancellationReasons", [])]
+                if not reasons or reasons[0] != "ConditionalCheckFailed":
+                    raise
+        return applied
+    
+    def _recent_sort_key(self, session: Dict[str, Any]) -> str:
+        return f"{int(session.get('created_at') or 0):010d}#{session['session_id']}"
+    
+    def put_recent(self, session: Dict[str, Any]) -> None:
+        """Insert or refresh a session in the recent-sessions view."""
+        item = {field: session[field] for field in self.RECENT_FIELDS if session.get(field) is not None}
+        item.update({
+            "pk": self.RECENT_PK,
+            "sk": self._recent_sort_key(session),
+            # Ages out of the view after the session has been around for the retention period
+            "ttl": int(session.get("created_at") or get_current_timestamp()) + RECENT_SESSIONS_RETENTION_DAYS * 86400,
+        })
+        self.db.table.put_item(Item=item)
+    
+    def replace_counters(self, counters: Dict[str, Dict[str, int]]) -> None:
+        """Overwrite counter items with absolute values, e.g. after a full recount."""
+        puts = []
+        for sk, by_status in counters.items():
+            item = {"pk": self.COUNTERS_PK, "sk": sk, "total": sum(by_status.values())}
+            item.update({f"count_{status}": count for status, count in by_status.items()})
+            puts.append(item)
+        if puts and not self.db.batch_write(puts=puts):
+            raise RuntimeError("Failed to write recounted session statistics")
+    
+    def get_counters(self) -> Dict[str, Dict[str, Any]]:
+        """Return {sk: {"total": n, "by_status": {status: n}}} for every counter item."""
+        counters = {}
+        for item in self.db.iter_query(Key("pk").eq(self.COUNTERS_PK)):
+            counters[item["sk"]] = {
+                "total": int(item.get("total", 0)),
+                "by_status": {
+                    name[len("count_"):]: int(value)
+                    for name, value in item.items()
+                    if name.startswith("count_") and int(value)
+                },
+            }
+        return counters
+    
+    def recent_sessions(self, limit: int = 50, status: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Return the newest sessions in the view, optionally with one status."""
+        return list(self.db.iter_query(
+            Key("pk").eq(self.RECENT_PK),
+            projection=self.RECENT_FIELDS,
+            page_size=max(limit, 25),
+            limit=limit,
+            filter_expression=Attr("status").eq(status) if status else None,
+            scan_forward=False,
+        ))
+
+
+# =============================================================================
+# Usage Rollups
+# =============================================================================
+
+# Per-student usage buckets (hash key "student_id", range key "bucket")
+USAGE_ROLLUP_TABLE = os.environ.get("USAGE_ROLLUP_TABLE", "")
+
+
+def to_epoch_seconds(value: Any) -> Optional[float]:
+    """Normalize a stored timestamp (epoch number, Decimal or ISO string) to epoch seconds."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float, Decimal)):
+        return float(value)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def split_by_day(start: float, end: float) -> Iterator[Tuple[str, float]]:
+    """Yield (YYYY-MM-DD, seconds) for each UTC day the interval [start, end) touches."""
+    while start < end:
+        day = datetime.fromtimestamp(start, tz=timezone.utc)
+        midnight = datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp() + 86400
+        chunk_end = min(end, midnight)
+        yield day.strftime("%Y-%m-%d"), chunk_end - start
+        start = chunk_end
+
+
+def iter_periods(granularity: str, start: str, end: str) -> Iterator[str]:
+    """Yield every day (YYYY-MM-DD) or month (YYYY-MM) from start to end inclusive."""
+    if granularity == "month":
+        year, month = int(start[:4]), int(start[5:7])
+        while f"{year:04d}-{month:02d}" <= end:
+            yield f"{year:04d}-{month:02d}"
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return
+    
+    day = datetime.strptime(start, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    while day.strftime("%Y-%m-%d") <= end:
+        yield day.strftime("%Y-%m-%d")
+        day = datetime.fromtimestamp(day.timestamp() + 86400, tz=timezone.utc)
+
+
+class UsageRollupStore:
+    """
+    Per-student usage totals by day and month, kept current from the sessions
+    stream by session-stats so usage reads are a single range query.
+    
+    Layout:
+        student_id=<id>, bucket="day#YYYY-MM-DD" | "month#YYYY-MM"
+            seconds: session time in the bucket, split across UTC midnights
+            sessions: sessions started in the bucket
+    
+    Buckets outlive the sessions they were built from, which the sessions
+    table removes by TTL. Stream updates are written by session-stats in the
+    same once-per-record transaction as the session counters; write methods
+    raise ClientError so the stream consumer can retry the record.
+    """
+    
+    GRANULARITIES = ("day", "month")
+    
+    def __init__(self, table_name: str = USAGE_ROLLUP_TABLE):
+        self.db = DynamoDBClient(table_name)
+    
+    @staticmethod
+    def bucket_key(granularity: str, period: str) -> str:
+        return f"{granularity}#{period}"
+    
+    @staticmethod
+    def session_deltas(session: Dict[str, Any], count_start: bool, count_time: bool) -> Dict[str, Dict[str, float]]:
+        """Return {bucket: {"seconds": s, "sessions": n}} that one session contributes."""
+        deltas = {}
+        
+        def add(day: str, field: str, amount: float) -> None:
+            for bucket in (UsageRollupStore.bucket_key("day", day), UsageRollupStore.bucket_key("month", day[:7])):
+                totals = deltas.setdefault(bucket, {"seconds": 0, "sessions": 0})
+                totals[field] += amount
+        
+        start = to_epoch_seconds(session.get("created_at"))
+        if start is None:
+            return deltas
+        
+        if count_start:
+            add(datetime.fromtimestamp(start, tz=timezone.utc).strftime("%Y-%m-%d"), "sessions", 1)
+        
+        end = to_epoch_seconds(session.get("terminated_at"))
+        if count_time and end is not None:
+            for day, seconds in split_by_day(start, end):
+                add(day, "seconds", seconds)
+        
+        return deltas
+    
+    def session_updates(self, old: Optional[Mapping], new: Optional[Mapping]) -> List[Dict[str, Any]]:
+        """
+        Return the transaction updates that fold one session change into the
+        buckets, to be written with SessionStatsStore.apply_once.
+        
+        A session counts once when it is inserted, and its time is added once
+        when it gains terminated_at. Removals (TTL) leave the buckets alone.
+        """
+        if new is None or not new.get("student_id"):
+            return []
+        
+        count_start = old is None
+        count_time = new.get("terminated_at") is not None and (old is None or old.get("terminated_at") is None)
+        if not (count_start or count_time):
+            return []
+        
+        return [
+            {"Update": {
+                "TableName": self.db.table_name,
+                "Key": {"student_id": new["student_id"], "bucket": bucket},
+                "UpdateExpression": "ADD #seconds :seconds, #sessions :sessions",
+                "ExpressionAttributeNames": {"#seconds": "seconds", "#sessions": "sessions"},
+                "ExpressionAttributeValues": {
+                    ":seconds": Decimal(str(round(totals["seconds"], 3))),
+                    ":sessions": totals["sessions"],
+                },
+            }}
+            for bucket, totals in self.session_deltas(new, count_start, count_time).items()
+        ]
+    
+    def seed_buckets(self, student_id: str, buckets: Dict[str, Dict[str, float]]) -> int:
+        """
+        Write recounted buckets that don't exist yet; existing buckets may hold
+        usage from sessions already removed by TTL and are left untouched.
+        
+        Returns:
+            Number of buckets written
+        """
+        written = 0
+        for bucket, totals in buckets.items():
+            try:
+                self.db.table.put_item(
+                    Item={
+                        "student_id": student_id,
+                        "bucket": bucket,
+                        "seconds": Decimal(str(round(totals["seconds"], 3))),
+                        "sessions": totals["sessions"],
+                    },
+                    ConditionExpression="attribute_not_exists(bucket)",
+                )
+                written += 1
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+        return written
+    
+    def get_range(self, student_id: str, granularity: str, start: str, end: str) -> List[Dict[str, Any]]:
+        """
+        Return [{"period", "minutes", "sessions"}] for every period from start
+        to end inclusive (YYYY-MM-DD for days, YYYY-MM for months), with
+        zeros for periods that have no usage.
+        """
+        stored = {}
+        for item in self.db.iter_query(
+            Key("student_id").eq(student_id) & Key("bucket").between(
+                self.bucket_key(granularity, start), self.bucket_key(granularity, end)
+            ),
+            strict=True,
+        ):
+            stored[item["bucket"].split("#", 1)[1]] = item
+        
+        buckets = []
+        for period in iter_periods(granularity, start, end):
+            item = stored.get(period, {})
+            buckets.append({
+                "period": period,
+                "minutes": int(item.get("seconds", 0)) // 60,
+                "sessions": int(item.get("sessions", 0)),
+            })
+        return buckets
+    
+    def totals(self, student_id: str) -> Dict[str, int]:
+        """Return all-time {"minutes", "sessions"} for a student from the month buckets."""
+        seconds = 0
+        sessions = 0
+        for item in self.db.iter_query(
+            Key("student_id").eq(student_id) & Key("bucket").begins_with("month#"),
+            strict=True,
+        ):
+            seconds += item.get("seconds", 0)
+            sessions += int(item.get("sessions", 0))
+        return {"minutes": int(seconds) // 60, "sessions": sessions}
+
+
+# =============================================================================
+# Session Archive
+# =============================================================================
+
+# Append-only session history (hash key "student_id", range key "sk"); set
+# SESSION_ARCHIVE_DIR instead for date-partitioned NDJSON files on local disk
+SESSION_HISTORY_TABLE = os.environ.get("SESSION_HISTORY_TABLE", "")
+SESSION_ARCHIVE_DIR = os.environ.get("SESSION_ARCHIVE_DIR", "")
+# How long an archived session stays in the sessions table for status polls
+SESSION_ARCHIVE_GRACE = int(os.environ.get("SESSION_ARCHIVE_GRACE", "900"))
+
+FINISHED_SESSION_STATUSES = [SessionStatus.TERMINATED, SessionStatus.ERROR]
+
+
+class SessionArchive(abc.ABC):
+    """
+    Append-only history of finished sessions, fed from the sessions stream
+    by session-stats.
+    
+    When a session reaches a finished status a compact record is written
+    here, then the live item is trimmed: bulky attributes are removed and its
+    TTL is brought forward to SESSION_ARCHIVE_GRACE after termination, so the
+    sessions table only holds live and recently finished sessions. Items the
+    TTL removes before they were archived (e.g. written before the archive
+    existed) are archived from the REMOVE record. Writes are idempotent per
+    session and raise so the stream consumer can retry the record.
+    """
+    
+    RECORD_FIELDS = [
+        "session_id", "student_id", "student_name", "course_id", "lab_id", "plan",
+        "status", "termination_reason", "instance_id", "created_at", "terminated_at",
+    ]
+    # Dropped from archived live items; nothing reads them once a session is finished
+    TRIM_FIELDS = ["connection_info", "metadata", "advance_chain"]
+    
+    @classmethod
+    def compact(cls, session: Mapping) -> Dict[str, Any]:
+        record = {field: session.get(field) for field in cls.RECORD_FIELDS if session.get(field) is not None}
+        record["archived_at"] = get_current_timestamp()
+        return record
+    
+    @abc.abstractmethod
+    def append(self, record: Dict[str, Any]) -> None:
+        """Store a compact record; appending the same session again must be harmless."""
+    
+    @abc.abstractmethod
+    def query_page(
+        self,
+        student_id: str,
+        limit: int = 50,
+        status_filter: Any = None,
+        since: Optional[int] = None,
+        until: Optional[int] = None,
+        cursor: Optional[str] = None,
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Return (records, next_cursor) for one page of a student's archived
+        sessions, newest first. Raises ValueError for an invalid cursor.
+        """
+    
+    @abc.abstractmethod
+    def iter_records(self) -> Iterator[Dict[str, Any]]:
+        """Yield every archived record once, in no particular order (for recounts)."""
+    
+    def apply_session(self, old: Optional[Mapping], new: Optional[Mapping], sessions_db: "DynamoDBClient") -> bool:
+        """
+        Archive a session that just finished, or that the TTL removed unarchived,
+        and trim finished live items.
+        
+        Returns:
+            True if anything was written
+        """
+        if new is None:
+            if old is None or not old.get("student_id") or old.get("archived_at") is not None:
+                return False
+            self.append(self.compact(old))
+            return True
+        
+        if not new.get("student_id") or new.get("status") not in FINISHED_SESSION_STATUSES:
+            return False
+        if old is not None and old.get("status") == new.get("status"):
+            return False
+        
+        self.append(self.compact(new))
+        self.trim(new, sessions_db)
+        return True
+    
+    def trim(self, session: Mapping, sessions_db: "DynamoDBClient") -> bool:
+        """Mark an archived live item and bring its TTL forward, unless its status moved on or it is already marked."""
+        now = get_current_timestamp()
+        finished_at = int(to_epoch_seconds(session.get("terminated_at")) or now)
+        trim_at = finished_at + SESSION_ARCHIVE_GRACE
+        if session.get("expires_at"):
+            trim_at = min(trim_at, int(session["expires_at"]))
+        try:
+            sessions_db.table.update_item(
+                Key={"session_id": session["session_id"]},
+                UpdateExpression="SET archived_at = :now, expires_at = :trim_at REMOVE "
+                                 + ", ".join(self.TRIM_FIELDS),
+                ConditionExpression="#status = :status AND attribute_not_exists(archived_at)",
+                ExpressionAttributeNames={"#status": "status"},
+                ExpressionAttributeValues={":now": now, ":trim_at": trim_at, ":status": session["status"]},
+            )
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            return False
+
+
+class DynamoDBSessionArchive(SessionArchive):
+    """
+    Session archive in a DynamoDB table.
+    
+    Layout:
+        student_id=<id>, sk="<created_at, 10 digits>#<session_id>"
+            the compact record from SessionArchive.compact
+    """
+    
+    def __init__(self, table_name: str = SESSION_HISTORY_TABLE):
+        self.db = DynamoDBClient(table_name)
+    
+    @staticmethod
+    def sort_key(created_at: Any, session_id: str = "") -> str:
+        return f"{int(created_at or 0):010d}#{session_id}"
+    
+    def append(self, record: Dict[str, Any]) -> None:
+        item = dict(record)
+        item["sk"] = self.sort_key(record.get("created_at"), record["session_id"])
+        self.db.table.put_item(Item=item)
+    
+    def iter_records(self):
+        return self.db.iter_scan(strict=True)
+    
+    def query_page(self, student_id, limit=50, status_filter=None, since=None, until=None, cursor=None):
+        # "~" sorts after every session ID, so `until` includes its whole second
+        key_condition = Key("student_id").eq(student_id)
+        if since is not None and until is not None:
+            key_condition = key_condition & Key("sk").between(self.sort_key(since), self.sort_key(until, "~"))
+        elif since is not None:
+            key_condition = key_condition & Key("sk").gte(self.sort_key(since))
+        elif until is not None:
+            key_condition = key_condition & Key("sk").lte(self.sort_key(until, "~"))
+        
+        start_key = None
+        if cursor:
+            start_key = decode_page_cursor(cursor)
+            if set(start_key) != {"student_id", "sk"} or start_key["student_id"] != student_id:
+                raise ValueError("Cursor belongs to a different query")
+        
+        filter_expression = None
+        if isinstance(status_filter, (list, tuple, set)):
+            filter_expression = Attr("status").is_in(list(status_filter))
+        elif status_filter:
+            filter_expression = Attr("status").eq(status_filter)
+        
+        records = list(self.db.iter_query(
+            key_condition,
+            page_size=limit + 1,
+            limit=limit + 1,
+            filter_expression=filter_expression,
+            scan_forward=False,
+            strict=True,
+            start_key=start_key,
+        ))
+        if len(records) <= limit:
+            return records, None
+        return records[:limit], encode_page_cursor({"student_id": student_id, "sk": records[limit - 1]["sk"]})
+
+
+class FileSessionArchive(SessionArchive):
+    """
+    Session archive as NDJSON files for local runs, one file per UTC day of
+    termination (YYYY-MM-DD.ndjson).
+    
+    Files are only appended to, so a retried record can appear twice; reads
+    keep the last copy of each session. Queries read every file.
+    """
+    
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+    
+    def append(self, record: Dict[str, Any]) -> None:
+        finished_at = to_epoch_seconds(record.get("terminated_at")) or record["archived_at"]
+        day = datetime.fromtimestamp(finished_at, tz=timezone.utc).strftime("%Y-%m-%d")
+        with self._lock, open(os.path.join(self.directory, f"{day}.ndjson"), "a") as f:
+            f.write(json.dumps(record, cls=DecimalEncoder) + "\n")
+    
+    def _records(self, student_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        records = {}
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".ndjson"):
+                continue
+            with open(os.path.join(self.directory, name)) as f:
+                for line in f:
+                    record = json.loads(line)
+                    if student_id is None or record.get("student_id") == student_id:
+                        records[record["session_id"]] = record
+        return list(records.values())
+    
+    def iter_records(self):
+        return iter(self._records())
+    
+    def query_page(self, student_id, limit=50, status_filter=None, since=None, until=None, cursor=None):
+        statuses = set(status_filter) if isinstance(status_filter, (list, tuple, set)) else {status_filter}
+        boundary = None
+        if cursor:
+            position = decode_page_cursor(cursor)
+            if set(position) != {"student_id", "created_at", "session_id"} or position["student_id"] != student_id:
+                raise ValueError("Cursor belongs to a different query")
+            boundary = (position["created_at"], position["session_id"])
+        
+        def position_of(record):
+            return (int(record.get("created_at") or 0), record["session_id"])
+        
+        records = sorted(
+            (
+                record for record in self._records(student_id)
+                if (not status_filter or record.get("status") in statuses)
+                and (since is None or position_of(record)[0] >= since)
+                and (until is None or position_of(record)[0] <= until)
+                and (boundary is None or position_of(record) < boundary)
+            ),
+            key=position_of,
+            reverse=True,
+        )
+        if len(records) <= limit:
+            return records, None
+        created_at, session_id = position_of(records[limit - 1])
+        return records[:limit], encode_page_cursor(
+            {"student_id": student_id, "created_at": created_at, "session_id": session_id}
+        )
+
+
+# Shared across warm invocations of the same Lambda container
+_session_archive: Optional[SessionArchive] = None
+
+
+def get_session_archive() -> Optional[SessionArchive]:
+    """Return the archive selected by SESSION_HISTORY_TABLE / SESSION_ARCHIVE_DIR, None if neither is set."""
+    global _session_archive
+    if _session_archive is None:
+        if SESSION_HISTORY_TABLE:
+            _session_archive = DynamoDBSessionArchive(SESSION_HISTORY_TABLE)
+        elif SESSION_ARCHIVE_DIR:
+            _session_archive = FileSessionArchive(SESSION_ARCHIVE_DIR)
+    return _session_archive
+
+
+def query_session_history_page(
+    sessions_db: "DynamoDBClient",
+    archive: Optional[SessionArchive],
+    student_id: str,
+    limit: int = 50,
+    status_filter: Any = None,
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+    cursor: Optional[str] = None,
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Return (sessions, next_cursor) for one page of a student's sessions, newest first.
+    
+    Without an archive this is a page of the sessions table. With one,
+    finished sessions are paged from the archive and the first page also
+    carries the sessions still in the sessions table that the archive doesn't
+    have yet (live, or finished moments ago), so it can hold a few more than
+    `limit` sessions. The sessions table only keeps those briefly, so this
+    reads a small partition. Raises ValueError for an invalid cursor.
+    """
+    if archive is None:
+        return sessions_db.query_user_sessions_page(student_id, limit, status_filter, since, until, cursor)
+    
+    archived, next_cursor = archive.query_page(student_id, limit, status_filter, since, until, cursor)
+    if cursor:
+        return archived, next_cursor
+    
+    archived_ids = {record["session_id"] for record in archived}
+    unarchived = [
+        session for session in sessions_db.query_user_sessions(student_id, None, status_filter, since, until)
+        if not session.get("archived_at") and session["session_id"] not in archived_ids
+    ]
+    sessions = sorted(
+        unarchived + archived,
+        key=lambda session: (int(session.get("created_at") or 0), session["session_id"]),
+        reverse=True,
+    )
+    return sessions, next_cursor
+
+
+def iter_session_history(
+    sessions_db: "DynamoDBClient",
+    archive: Optional[SessionArchive],
+    student_id: str,
+    page_size: int = 100,
+) -> Iterator[Dict[str, Any]]:
+    """Yield all of a student's sessions, newest first, page by page (see query_session_history_page)."""
+    cursor = None
+    while True:
+        sessions, cursor = query_session_history_page(sessions_db, archive, student_id, page_size, cursor=cursor)
+        yield from sessions
+        if not cursor:
+            return
+
+
+# =============================================================================
+# Usage Reports
+# =============================================================================
+
+REPORT_FIELDS = [
+    "record", "usage_month", "plan", "user_id", "rank", "users",
+    "consumed_minutes", "session_count", "quota_minutes", "quota_exhausted",
+]
+
+
+class LocalUsageTable:
+    """
+    Stand-in for the usage table that reads items from an NDJSON file, either
+    plain items or DynamoDB export lines ({"Item": {"user_id": {"S": ...}}}).
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+    
+    def iter_month(self, usage_month: str, page_size: int = 500) -> Iterator[Dict[str, Any]]:
+        with open(self.path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                item = json.loads(line, parse_float=Decimal)
+                if "Item" in item:
+                    item = StreamImage(item["Item"]).to_dict()
+                if item.get("usage_month") == usage_month:
+                    yield item
+
+
+class MonthlyUsageReport:
+    """
+    Streaming usage report for one month.
+    
+    iter_records() consumes usage items one at a time and yields flat records
+    (see REPORT_FIELDS), so a month of any size is reported in constant memory:
+        record="user"       one per usage item, as it is read (optional)
+        record="plan"       consumed minutes, sessions, users and quota
+                            exhaustions per plan, after the last item
+        record="top_user"   the top_n heaviest users across all plans
+        record="total"      the month as a whole
+    """
+    
+    def __init__(self, usage_month: str, top_n: int = 10, plan_limits: Optional[Dict[str, int]] = None):
+        self.usage_month = usage_month
+        self.top_n = top_n
+        self.plan_limits = plan_limits or DEFAULT_PLAN_LIMITS
+        self.plans: Dict[str, Dict[str, int]] = {}
+        self._top: List[Tuple[int, str, Dict[str, Any]]] = []  # min-heap of the heaviest users
+    
+    def user_record(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        """Normalize one usage item and fold it into the aggregates."""
+        plan = item.get("plan") or PlanTier.FREEMIUM
+        consumed = int(item.get("consumed_minutes", 0))
+        quota = int(item.get("quota_minutes", self.plan_limits.get(plan, -1)))
+        record = {
+            "record": "user",
+            "usage_month": self.usage_month,
+            "plan": plan,
+            "user_id": item.get("user_id"),
+            "consumed_minutes": consumed,
+            "session_count": int(item.get("session_count", 0)),
+            "quota_minutes": quota,
+            "quota_exhausted": quota > 0 and consumed >= quota,
+        }
+        
+        totals = self.plans.setdefault(plan, {"users": 0, "consumed_minutes": 0, "session_count": 0, "quota_exhausted": 0})
+        totals["users"] += 1
+        totals["consumed_minutes"] += consumed
+        totals["session_count"] += record["session_count"]
+        totals["quota_exhausted"] += int(record["quota_exhausted"])
+        
+        entry = (consumed, str(record["user_id"]), record)
+        if len(self._top) < self.top_n:
+            heapq.heappush(self._top, entry)
+        elif self.top_n and entry[:2] > self._top[0][:2]:
+            heapq.heapreplace(self._top, entry)
+        
+        return record
+    
+    def iter_records(self, items, include_users: bool = True) -> Iterator[Dict[str, Any]]:
+        for item in items:
+            record = self.user_record(item)
+            if include_users:
+                yield record
+        
+        for plan in sorted(self.plans):
+            yield {"record": "plan", "usage_month": self.usage_month, "plan": plan, **self.plans[plan]}
+        
+        ranked = sorted(self._top, key=lambda entry: entry[:2], reverse=True)
+        for rank, (_, _, record) in enumerate(ranked, start=1):
+            yield {**record, "record": "top_user", "rank": rank}
+        
+        yield {"record": "total", "usage_month": self.usage_month, **self.totals()}
+    
+    def totals(self) -> Dict[str, int]:
+        totals = {"users": 0, "consumed_minutes": 0, "session_count": 0, "quota_exhausted": 0}
+        for plan_totals in self.plans.values():
+            for name in totals:
+                totals[name] += plan_totals[name]
+        return totals
+
+
+def iter_csv(records, fields: List[str] = REPORT_FIELDS) -> Iterator[str]:
+    """Yield a CSV header and then one line per record."""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction="ignore")
+    
+    def drain() -> str:
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return line
+    
+    writer.writeheader()
+    yield drain()
+    for record in records:
+        writer.writerow(record)
+        yield drain()
+
+
+def iter_ndjson(records) -> Iterator[str]:
+    """Yield one JSON line per record."""
+    for record in records:
+        yield json.dumps(record, cls=DecimalEncoder) + "\n"
+
+
+# =============================================================================
+# Moodle Token Verification
+# =============================================================================
+
+# "memory" (per container) or "dynamodb" (shared through CACHE_TABLE)
+MOODLE_NONCE_STORE = os.environ.get("MOODLE_NONCE_STORE", "dynamodb" if CACHE_TABLE else "memory")
+# Tokens are accepted until their own `expires` (the plugin's token_validity
+# setting), and their nonce is kept that long. This caps the lifetime a token
+# may claim, which bounds how long nonces are kept; longer-lived tokens are
+# rejected with a warning naming this setting.
+MOODLE_TOKEN_MAX_AGE = int(os.environ.get("MOODLE_TOKEN_MAX_AGE", "3600"))
+# Tolerated clock difference between Moodle and Lambda
+MOODLE_CLOCK_SKEW = 30
+
+
+class NonceStore(abc.ABC):
+    """Records token nonces until they expire so a token can only be used once."""
+    
+    @abc.abstractmethod
+    def add(self, nonce: str, expires_at: float) -> bool:
+        """Record a nonce; return False if it was already recorded and hasn't expired."""
+
+
+class MemoryNonceStore(NonceStore):
+    """
+    Per-container nonce store: a ring of time buckets keyed by expiry.
+    
+    A nonce lands in the bucket for its expiry time, so a replayed token (same
+    payload, same expiry) is checked against exactly one bucket. A bucket is
+    cleared when the ring comes back round to it, by which time everything in
+    it has expired, so memory is bounded by the nonces issued in one window.
+    """
+    
+    def __init__(self, max_age: int = MOODLE_TOKEN_MAX_AGE + 2 * MOODLE_CLOCK_SKEW, buckets: int = 10):
+        self.bucket_seconds = max(1, -(-max_age // buckets))
+        # Two spare buckets: the one being filled and the one straddling expiry
+        self._ring: List[Tuple[Optional[int], set]] = [(None, set()) for _ in range(buckets + 2)]
+        self._lock = threading.Lock()
+    
+    def add(self, nonce: str, expires_at: float) -> bool:
+        epoch = int(expires_at // self.bucket_seconds)
+        slot = epoch % len(self._ring)
+        with self._lock:
+            slot_epoch, nonces = self._ring[slot]
+            if slot_epoch != epoch:
+                nonces = set()
+                self._ring[slot] = (epoch, nonces)
+            elif nonce in nonces:
+                return False
+            nonces.add(nonce)
+            return True
+
+
+class DynamoDBNonceStore(NonceStore):
+    """
+    Nonce store shared by every container through a conditional put into the
+    cache table, with the item's TTL at the nonce's expiry.
+    
+    An in-process ring answers repeats within a container without a round
+    trip, and keeps replay protection in place if DynamoDB is unavailable.
+    """
+    
+    KEY_PREFIX = "nonce#"
+    
+    def __init__(self, table_name: str = CACHE_TABLE):
+        self.db = DynamoDBClient(table_name)
+        self.local = MemoryNonceStore()
+    
+    def add(self, nonce: str, expires_at: float) -> bool:
+        if not self.local.add(nonce, expires_at):
+            return False
+        
+        try:
+            self.db.table.put_item(
+                Item={"cache_key": f"{self.KEY_PREFIX}{nonce}", "expires_at": int(expires_at) + 1},
+                # TTL deletion lags, so an expired item doesn't count as a use
+                ConditionExpression="attribute_not_exists(cache_key) OR expires_at < :now",
+                ExpressionAttributeValues={":now": get_current_timestamp()},
+            )
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            logger.warning(f"Nonce store unavailable, checking this container only: {e}")
+            return True
+
+
+class MoodleTokenVerifier:
+    """
+    Verifies signed tokens from the Moodle AttackBox plugin.
+    
+    Tokens are signed using HMAC-SHA256 and contain user information,
+    timestamp, expiry, and a nonce for replay attack prevention.
+    """
+    
+    def __init__(self, secret: str, nonce_store: Optional[NonceStore] = None):
+        """
+        Initialize the token verifier.
+        
+        Args:
+            secret: The shared secret used for verifying token signatures.
+            nonce_store: Where used nonces are recorded (default: in-process ring)
+        """
+        self.secret = secret
+        self._max_nonce_age = MOODLE_TOKEN_MAX_AGE
+        # A nonce expires at most MAX_AGE after a token issued up to one skew ahead, plus one skew
+        self.nonce_store = nonce_store or MemoryNonceStore(self._max_nonce_age + 2 * MOODLE_CLOCK_SKEW)
+    
+    def verify_token(self, token: str) -> Optional[Dict[str, Any]]:
+        """
+        Verify a Moodle-signed token and return the payload if valid.
+        
+        Args:
+            token: The signed token (base64_payload.signature)
+            
+        Returns:
+            The decoded payload if valid, None if invalid.
+        """
+        if not token or not self.secret:
+            logger.warning("Token verification failed: missing token or secret")
+            return None
+        
+        try:
+            # Split token into payload and signature
+            parts = token.split(".")
+            if len(parts) != 2:
+                logger.warning("Token verification failed: invalid token format")
                 return None
             
             payload_base64, signature = parts
@@ -1362,20 +4193,32 @@ class MoodleTokenVerifier:
             payload = json.loads(payload_json)
             
             # Verify expiry
+            now = time.time()
             expires = payload.get("expires", 0)
-            if time.time() > expires:
+            if now > expires:
                 logger.warning("Token verification failed: token expired")
                 return None
             
-            # Verify nonce (prevent replay attacks)
+            # Tokens are only accepted for as long as their nonce is remembered
+            issued = payload.get("timestamp")
+            if issued is not None and issued > now + MOODLE_CLOCK_SKEW:
+                logger.warning("Token verification failed: token issued in the future")
+                return None
+            lifetime = expires - (issued if issued is not None else now)
+            if lifetime > self._max_nonce_age:
+                logger.warning(
+                    f"Token verification failed: token lifetime {int(lifetime)}s exceeds "
+                    f"MOODLE_TOKEN_MAX_AGE ({self._max_nonce_age}s); lower the plugin's "
+                    f"token_validity or raise MOODLE_TOKEN_MAX_AGE"
+                )
+                return None
+            
+            # Verify nonce (prevent replay attacks); it is kept until the token expires
             nonce = payload.get("nonce")
             if nonce:
-                if nonce in self._used_nonces:
+                if not self.nonce_store.add(nonce, expires + MOODLE_CLOCK_SKEW):
                     logger.warning("Token verification failed: nonce already used (replay attack?)")
                     return None
-                self._used_nonces.add(nonce)
-                # Clean up old nonces (in production, use TTL in Redis/DynamoDB)
-                self._cleanup_old_nonces()
             
             logger.info(f"Token verified for user: {payload.get('user_id')}")
             return payload
@@ -1393,13 +4236,31 @@ class MoodleTokenVerifier:
         
         import base64
         return base64.urlsafe_b64decode(data).decode("utf-8")
-    
-    def _cleanup_old_nonces(self):
-        """Clean up nonces older than max age (simple in-memory implementation)."""
-        # In production, this would be handled by TTL in Redis/DynamoDB
-        # For Lambda, nonces are cleared on cold starts anyway
-        if len(self._used_nonces) > 10000:
-            self._used_nonces.clear()
+
+
+# Shared across warm invocations of the same Lambda container
+_nonce_store = None
+_token_verifiers: Dict[str, MoodleTokenVerifier] = {}
+
+
+def get_nonce_store() -> NonceStore:
+    """Return the module-level nonce store selected by MOODLE_NONCE_STORE."""
+    global _nonce_store
+    if _nonce_store is None:
+        if MOODLE_NONCE_STORE == "dynamodb" and CACHE_TABLE:
+            _nonce_store = DynamoDBNonceStore(CACHE_TABLE)
+        else:
+            _nonce_store = MemoryNonceStore()
+    return _nonce_store
+
+
+def get_token_verifier(secret: str) -> MoodleTokenVerifier:
+    """Return the module-level verifier for a secret, sharing one nonce store."""
+    verifier = _token_verifiers.get(secret)
+    if verifier is None:
+        verifier = MoodleTokenVerifier(secret, nonce_store=get_nonce_store())
+        _token_verifiers[secret] = verifier
+    return verifier
 
 
 def get_moodle_token_from_event(event: Dict[str, Any]) -> Optional[str]:
@@ -1449,5 +4310,4 @@ def verify_moodle_request(event: Dict[str, Any], secret: str) -> Optional[Dict[s
         logger.warning("No Moodle token found in request")
         return None
     
-    verifier = MoodleTokenVerifier(secret)
-    return verifier.verify_token(token)
+    return get_token_verifier(secret).verify_token(token)
@@ -2,7 +2,9 @@
 Create Session Lambda Function
 
 Handles requests from Moodle to launch an AttackBox for a student.
-Automatically creates an RDP connection in Guacamole.
+The API handler only accepts the launch: it writes a PENDING session and
+enqueues a launch job. The provisioning worker (worker_handler) allocates
+the instance and automatically creates an RDP connection in Guacamole.
 """
 
 import logging
@@ -13,11 +15,20 @@ import sys
 sys.path.insert(0, "/opt/python")
 
 from utils import (
+    ACTIVE_SESSIONS_TABLE,
+    ActiveSessionPointers,
     AutoScalingClient,
+    CACHE_TABLE,
     DynamoDBClient,
     EC2Client,
     GuacamoleClient,
+    InstanceClaimer,
     InstanceStatus,
+    LaunchGate,
+    MAX_IDEMPOTENCY_KEY_LENGTH,
+    MemoryLaunchQueue,
+    PROVISIONING_LEASE,
+    ReadinessProber,
     SessionStatus,
     UsageTracker,
     calculate_expiry,
@@ -25,9 +36,16 @@ from utils import (
     DEFAULT_PLAN_LIMITS,
     generate_session_id,
     get_current_timestamp,
+    get_claim_tickets,
+    get_header,
+    get_http_transport,
     get_iso_timestamp,
+    get_launch_queue,
     get_moodle_token_from_event,
+    get_pooled_connection_id,
     parse_request_body,
+    parse_sqs_launch_jobs,
+    probe_rdp,
     success_response,
     verify_moodle_request,
 )
@@ -60,6 +78,23 @@ REQUIRE_MOODLE_AUTH = os.environ.get("REQUIRE_MOODLE_AUTH", "false").lower() ==
 RDP_USERNAME = os.environ.get("RDP_USERNAME", "kali")
 RDP_PASSWORD = os.environ.get("RDP_PASSWORD", "kali")
 
+# Readiness probing (upper bounds in seconds - each wait ends as soon as its condition holds)
+# The RDP handshake probe needs a network path to the instance's private IP (VPC-attached Lambda)
+ENABLE_RDP_PROBE = os.environ.get("ENABLE_RDP_PROBE", "false").lower() == "true"
+RDP_RESET_TIMEOUT = int(os.environ.get("RDP_RESET_TIMEOUT", "20"))
+RDP_READY_TIMEOUT = int(os.environ.get("RDP_READY_TIMEOUT", "8"))
+GUACAMOLE_READY_TIMEOUT = int(os.environ.get("GUACAMOLE_READY_TIMEOUT", "5"))
+
+# Claimed pool instances found not running before giving up on the pool
+MAX_UNUSABLE_CLAIMS = 3
+
+# Background progression of PROVISIONING sessions (seconds)
+ADVANCE_INTERVAL = int(os.environ.get("ADVANCE_INTERVAL", "5"))
+# Instance running this long is treated as ready even if status checks are still pending
+HEALTH_CHECK_GRACE = 120
+# Session still without an instance after this long is failed
+ALLOCATION_TIMEOUT = 480
+
 
 def get_asg_for_plan(plan: str) -> str:
     """Get the ASG name for a given plan tier."""
@@ -185,7 +220,9 @@ def cleanup_stale_session(
     session: dict,
     sessions_db: DynamoDBClient,
     pool_db: DynamoDBClient,
-    reason: str = "stale_reconnect"
+    reason: str = "stale_reconnect",
+    release_resources: bool = True,
+    pointers: ActiveSessionPointers = None,
 ) -> None:
     """
     Clean up a stale session that the user is no longer connected to.
@@ -198,11 +235,14 @@ def cleanup_stale_session(
         sessions_db: DynamoDB client for sessions table
         pool_db: DynamoDB client for instance pool table
         reason: The termination reason to record
+        release_resources: Also release the instance and Guacamole resources now.
+            The accept step leaves this to the provisioning worker.
+        pointers: Active session pointers to remove the session from in the
+            same transaction as the status change
     """
     session_id = session["session_id"]
     student_id = session.get("student_id")
     instance_id = session.get("instance_id")
-    connection_info = session.get("connection_info", {})
     now = get_current_timestamp()
     
     logger.info(f"[STALE_SESSION_CLEANUP] ========== STARTING STALE SESSION CLEANUP ==========")
@@ -214,30 +254,61 @@ def cleanup_stale_session(
     
     # Update session status to terminated
     logger.info(f"[STALE_SESSION_CLEANUP] Marking session as TERMINATED in DynamoDB...")
-    sessions_db.update_item(
-        {"session_id": session_id},
-        {
-            "status": SessionStatus.TERMINATED,
-            "termination_reason": reason,
-            "terminated_at": now,
-            "updated_at": now,
-        }
-    )
+    updates = {
+        "status": SessionStatus.TERMINATED,
+        "termination_reason": reason,
+        "terminated_at": now,
+        "updated_at": now,
+    }
+    if pointers is None or not pointers.end_session(session, updates):
+        sessions_db.update_item({"session_id": session_id}, updates)
+        if pointers is not None:
+            # Otherwise the create transaction right after would still count this session
+            pointers.release(session["student_id"], session_id)
     logger.info(f"[STALE_SESSION_CLEANUP] Session marked as TERMINATED successfully")
     
+    if release_resources:
+        release_stale_session_resources(session, pool_db)
+    else:
+        logger.info(f"[STALE_SESSION_CLEANUP] Instance and Guacamole release deferred to provisioning worker")
+        return
+    
+    logger.info(f"[STALE_SESSION_CLEANUP] ========== STALE SESSION CLEANUP COMPLETE ==========")
+    logger.info(f"[STALE_SESSION_CLEANUP] User {student_id} can now create a new session")
+
+
+def release_stale_session_resources(session: dict, pool_db: DynamoDBClient) -> None:
+    """
+    Release the instance and Guacamole resources held by a stale session.
+    
+    Args:
+        session: The (already terminated) session record
+        pool_db: DynamoDB client for instance pool table
+    """
+    instance_id = session.get("instance_id")
+    connection_info = session.get("connection_info", {})
+    now = get_current_timestamp()
+    
     # Release the instance back to the pool if assigned
     if instance_id:
         logger.info(f"[STALE_SESSION_CLEANUP] Releasing instance {instance_id} back to pool...")
-        pool_db.update_item(
+        # Only if still held by this session - pool-manager may have released and
+        # reassigned it while the launch job was queued
+        released = pool_db.conditional_update(
             {"instance_id": instance_id},
             {
                 "status": InstanceStatus.AVAILABLE,
                 "session_id": None,
                 "student_id": None,
                 "released_at": now,
-            }
+            },
+            condition_expression="session_id = :stale_session_id",
+            expression_attribute_values={":stale_session_id": session["session_id"]},
         )
-        logger.info(f"[STALE_SESSION_CLEANUP] Instance {instance_id} released to pool (status=AVAILABLE)")
+        if released:
+            logger.info(f"[STALE_SESSION_CLEANUP] Instance {instance_id} released to pool (status=AVAILABLE)")
+        else:
+            logger.info(f"[STALE_SESSION_CLEANUP] Instance {instance_id} no longer held by this session, leaving it")
     else:
         logger.info(f"[STALE_SESSION_CLEANUP] No instance to release")
     
@@ -259,8 +330,11 @@ def cleanup_stale_session(
                     timeout=3,
                 )
                 
-                # Delete the connection
-                if guac_connection_id:
+                # Delete the connection (pre-built pool connections are kept and only recycled)
+                if guac_connection_id and connection_info.get("guacamole_connection_pooled"):
+                    logger.info(f"[STALE_SESSION_CLEANUP] Recycling pooled Guacamole connection {guac_connection_id}...")
+                    guac.kill_active_sessions(guac_connection_id)
+                elif guac_connection_id:
                     logger.info(f"[STALE_SESSION_CLEANUP] Deleting Guacamole connection {guac_connection_id}...")
                     if guac.delete_connection(guac_connection_id):
                         logger.info(f"[STALE_SESSION_CLEANUP] Guacamole connection {guac_connection_id} deleted successfully")
@@ -280,9 +354,6 @@ def cleanup_stale_session(
                 logger.warning(f"[STALE_SESSION_CLEANUP] Guacamole cleanup failed (non-blocking): {e}")
     else:
         logger.info(f"[STALE_SESSION_CLEANUP] No Guacamole resources to clean up")
-    
-    logger.info(f"[STALE_SESSION_CLEANUP] ========== STALE SESSION CLEANUP COMPLETE ==========")
-    logger.info(f"[STALE_SESSION_CLEANUP] User {student_id} can now create a new session")
 
 
 def regenerate_guacamole_session_access(
@@ -290,6 +361,7 @@ def regenerate_guacamole_session_access(
     student_id: str,
     connection_id: str,
     existing_connection_info: dict,
+    prober: ReadinessProber = None,
 ) -> dict:
     """
     Regenerate the Guacamole session user and URL for an existing session.
@@ -306,10 +378,12 @@ def regenerate_guacamole_session_access(
         student_id: The student ID
         connection_id: The existing Guacamole connection ID
         existing_connection_info: The existing connection_info dict
+        prober: Optional ReadinessProber to record readiness waits against
         
     Returns:
         Updated connection_info dict with new URL, or empty dict on failure
     """
+    prober = prober or ReadinessProber()
     logger.info(f"[REGENERATE_ACCESS] ========== REGENERATING SESSION ACCESS ==========")
     logger.info(f"[REGENERATE_ACCESS] Session ID: {session_id}")
     logger.info(f"[REGENERATE_ACCESS] Connection ID: {connection_id}")
@@ -345,9 +419,12 @@ def regenerate_guacamole_session_access(
             killed = guac.kill_active_sessions(connection_id)
             if killed > 0:
                 logger.info(f"[REGENERATE_ACCESS] Successfully killed {killed} active session(s)")
-                # Small delay to allow Guacamole to fully release the connection
-                import time
-                time.sleep(2.0)
+                # Wait until Guacamole has fully released the connection
+                prober.wait_for(
+                    "killed_sessions_released",
+                    lambda: connection_id not in guac.get_all_active_connections(strict=True),
+                    GUACAMOLE_READY_TIMEOUT,
+                )
             else:
                 logger.info(f"[REGENERATE_ACCESS] No active sessions found to kill")
         except Exception as e:
@@ -362,6 +439,8 @@ def regenerate_guacamole_session_access(
             session_id=session_id,
             connection_id=connection_id,
             student_id=student_id,
+            prober=prober,
+            ready_timeout=GUACAMOLE_READY_TIMEOUT,
         )
         
         session_username = f"session_{session_id[-8:]}"
@@ -388,21 +467,49 @@ def regenerate_guacamole_session_access(
         return {}
 
 
+def wait_for_rdp_reset(prober: ReadinessProber, instance_ip: str, released_at: int, max_wait: float) -> bool:
+    """
+    Wait for a recently released instance's RDP server to accept a new session.
+    
+    Probes the RDP handshake when the Lambda can reach the instance; otherwise
+    the only observable condition is the reset window elapsing since release.
+    """
+    if ENABLE_RDP_PROBE and instance_ip:
+        return prober.wait_for("rdp_reset", lambda: probe_rdp(instance_ip), max_wait)
+    return prober.wait_for(
+        "rdp_reset",
+        lambda: get_current_timestamp() - released_at >= RDP_RESET_TIMEOUT,
+        max_wait,
+    )
+
+
 def create_guacamole_connection(
     session_id: str,
     student_id: str,
     student_name: str,
     instance_ip: str,
     course_id: str = "",
+    prober: ReadinessProber = None,
+    pooled_connection_id: str = None,
+    previous_session_user: str = None,
+    pool_db: DynamoDBClient = None,
+    instance_id: str = None,
 ) -> dict:
     """
     Create an RDP connection in Guacamole for the student.
     Also creates a temporary user with access only to this connection,
     providing secure, direct access without sharing credentials.
     
+    If pool-manager already built a connection for the instance (pooled_connection_id),
+    only the session user is attached to it; the connection is recycled, not deleted,
+    when the session ends. If attaching fails, a fresh connection is created, which
+    replaces the pre-built one, and the pool record (pool_db, instance_id) stops
+    pointing at it so pool-manager builds a new one.
+    
     Returns:
         dict with connection_id and connection_url, or empty dict on failure
     """
+    prober = prober or ReadinessProber()
     # Use internal URL for API calls
     internal_url = get_guacamole_internal_url()
     # Use public URL for student-facing links
@@ -419,49 +526,71 @@ def create_guacamole_connection(
             password=GUACAMOLE_ADMIN_PASS,
         )
         
-        # CLEANUP STALE CONNECTIONS:
-        # Before creating a new connection, search for any existing connections pointing to the same IP.
-        # This prevents Guacamole from having multiple connections to the same AttackBox, 
-        # which can cause "Disconnected" errors due to protocol-level session locking.
-        logger.info(f"[GUACAMOLE_CLEANUP] Searching for stale connections to IP {instance_ip}...")
-        try:
-            stale_ids = guac.find_connections_by_hostname(instance_ip)
-            if stale_ids:
-                logger.info(f"[GUACAMOLE_CLEANUP] Found {len(stale_ids)} stale connection(s): {stale_ids}")
-                for stale_id in stale_ids:
-                    # Kill active sessions for this stale connection
-                    guac.kill_active_sessions(stale_id)
-                    # Delete the connection
-                    if guac.delete_connection(stale_id):
-                        logger.info(f"[GUACAMOLE_CLEANUP] Deleted stale connection {stale_id}")
-                
-                # Small delay after cleanup to allow guacd to release the RDP lock
-                import time
-                time.sleep(2.0)
-        except Exception as e:
-            logger.warning(f"[GUACAMOLE_CLEANUP] Stale connection cleanup failed (non-blocking): {e}")
+        if pooled_connection_id:
+            # Pre-built connection: make sure nothing from the previous session can still use it
+            connection_id = pooled_connection_id
+            logger.info(f"[GUACAMOLE_POOL] Using pre-built connection {connection_id} for {instance_ip}")
+            killed = guac.recycle_connection(connection_id, previous_session_user)
+            if killed > 0:
+                prober.wait_for(
+                    "killed_sessions_released",
+                    lambda: connection_id not in guac.get_all_active_connections(strict=True),
+                    GUACAMOLE_READY_TIMEOUT,
+                )
+        else:
+            # CLEANUP STALE CONNECTIONS:
+            # Before creating a new connection, search for any existing connections pointing to the same IP.
+            # This prevents Guacamole from having multiple connections to the same AttackBox, 
+            # which can cause "Disconnected" errors due to protocol-level session locking.
+            logger.info(f"[GUACAMOLE_CLEANUP] Searching for stale connections to IP {instance_ip}...")
+            try:
+                stale_ids = guac.find_connections_by_hostname(instance_ip)
+                if stale_ids:
+                    logger.info(f"[GUACAMOLE_CLEANUP] Found {len(stale_ids)} stale connection(s): {stale_ids}")
+                    for stale_id in stale_ids:
+                        # Kill active sessions for this stale connection
+                        guac.kill_active_sessions(stale_id)
+                        # Delete the connection
+                        if guac.delete_connection(stale_id):
+                            logger.info(f"[GUACAMOLE_CLEANUP] Deleted stale connection {stale_id}")
+                    
+                    # Wait until guacd has dropped the stale tunnels (releases the RDP lock)
+                    prober.wait_for(
+                        "stale_connections_released",
+                        lambda: not set(stale_ids) & set(guac.get_all_active_connections(strict=True)),
+                        GUACAMOLE_READY_TIMEOUT,
+                    )
+            except Exception as e:
+                logger.warning(f"[GUACAMOLE_CLEANUP] Stale connection cleanup failed (non-blocking): {e}")
 
-        # Create a unique connection name
-        connection_name = f"AttackBox - {student_name} ({session_id[-8:]})"
-        if course_id:
-            connection_name = f"[{course_id}] {connection_name}"
-        
-        # Create RDP connection
-        connection_id = guac.create_rdp_connection(
-            name=connection_name,
-            hostname=instance_ip,
-            port=3389,
-            username=RDP_USERNAME,
-            password=RDP_PASSWORD,
-            security="any",
-            ignore_cert=True,
-        )
-        
-        if not connection_id:
-            logger.error("Failed to create Guacamole connection")
-            return {}
-        
-        logger.info(f"Created Guacamole connection {connection_id} for session {session_id}")
+            # Create a unique connection name
+            connection_name = f"AttackBox - {student_name} ({session_id[-8:]})"
+            if course_id:
+                connection_name = f"[{course_id}] {connection_name}"
+            
+            # Create RDP connection
+            connection_id = guac.create_rdp_connection(
+                name=connection_name,
+                hostname=instance_ip,
+                port=3389,
+                username=RDP_USERNAME,
+                password=RDP_PASSWORD,
+                security="any",
+                ignore_cert=True,
+            )
+            
+            if not connection_id:
+                logger.error("Failed to create Guacamole connection")
+                return {}
+            
+            logger.info(f"Created Guacamole connection {connection_id} for session {session_id}")
+            
+            # Make sure the new connection resolves before handing out access to it
+            prober.wait_for(
+                "guacamole_connection_resolvable",
+                lambda: guac.connection_exists(connection_id),
+                GUACAMOLE_READY_TIMEOUT,
+            )
         
         # Switch to public URL for generating student-facing links
         guac.base_url = public_url
@@ -472,6 +601,8 @@ def create_guacamole_connection(
             session_id=session_id,
             connection_id=connection_id,
             student_id=student_id,
+            prober=prober,
+            ready_timeout=GUACAMOLE_READY_TIMEOUT,
         )
         
         # Generate username for cleanup later
@@ -486,7 +617,28 @@ def create_guacamole_connection(
                 "guacamole_connection_url": direct_url,  # URL with embedded token
                 "guacamole_base_url": public_url,
                 "guacamole_session_user": session_username,
+                "guacamole_connection_pooled": bool(pooled_connection_id),
             }
+        elif pooled_connection_id:
+            # The pre-built connection may have been removed from Guacamole: build one for this session
+            logger.warning(f"[GUACAMOLE_POOL] Could not attach a session user to pre-built connection "
+                           f"{pooled_connection_id}, creating a new connection")
+            if pool_db is not None and instance_id:
+                # The new connection deletes every other connection to this address
+                pool_db.conditional_update(
+                    {"instance_id": instance_id},
+                    {"guacamole_connection_id": None, "guacamole_connection_ip": None},
+                    condition_expression="#guacamole_connection_id = :pooled_connection_id",
+                    expression_attribute_values={":pooled_connection_id": pooled_connection_id},
+                )
+            return create_guacamole_connection(
+                session_id=session_id,
+                student_id=student_id,
+                student_name=student_name,
+                instance_ip=instance_ip,
+                course_id=course_id,
+                prober=prober,
+            )
         else:
             # Fallback to regular URL (will require login)
             logger.warning("[GUACAMOLE_URL] Could not create session user, falling back to regular URL (will require login!)")
@@ -512,6 +664,11 @@ def handler(event, context):
     - Token contains user info (user_id, username, fullname, email)
     - Falls back to request body if auth not required
     
+    Idempotency:
+    - Only one launch per student runs at a time (LaunchGate); a duplicate
+      waits for it and gets the session it created
+    - An optional Idempotency-Key header makes retries replay the first response
+    
     Expected request body (when not using token auth):
     {
         "student_id": "student123",
@@ -527,6 +684,9 @@ def handler(event, context):
         # Parse request body
         body = parse_request_body(event)
         
+        # Records how long each readiness condition takes on this launch
+        prober = ReadinessProber()
+        
         # Try to verify Moodle token if provided
         token_payload = None
         moodle_token = get_moodle_token_from_event(event)
@@ -569,305 +729,409 @@ def handler(event, context):
         if not student_id:
             return error_response(400, "Missing required field: student_id")
         
-        # Resolve plan and quota from token
-        plan, quota_minutes, roles = resolve_plan_info(token_payload)
-        logger.info(f"User {student_id} plan: {plan}, quota: {quota_minutes} minutes")
+        idempotency_key = get_header(event, "Idempotency-Key")
+        if idempotency_key and len(idempotency_key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+            return error_response(400, "Idempotency-Key is too long")
         
-        # Check usage quota (unless unlimited)
-        if USAGE_TABLE and quota_minutes != -1:
-            usage_tracker = UsageTracker(USAGE_TABLE)
-            quota_check = usage_tracker.check_quota(student_id, quota_minutes)
-            
-            if not quota_check["allowed"]:
-                logger.warning(f"Quota exceeded for user {student_id}: {quota_check}")
-                return error_response(
-                    403,
-                    "Monthly usage limit exceeded",
-                    {
-                        "error": "quota_exceeded",
-                        "plan": plan,
-                        "consumed_minutes": quota_check["consumed_minutes"],
-                        "quota_minutes": quota_minutes,
-                        "remaining_minutes": 0,
-                        "resets_at": quota_check["resets_at"],
-                    }
-                )
-            
-            logger.info(f"Quota check passed: {quota_check['remaining_minutes']} minutes remaining")
+        def launch():
+            return accept_launch(student_id, student_name, course_id, lab_id, metadata, token_payload, prober)
         
-        # Initialize clients
-        sessions_db = DynamoDBClient(SESSIONS_TABLE)
-        pool_db = DynamoDBClient(INSTANCE_POOL_TABLE)
-        ec2_client = EC2Client()
-        asg_client = AutoScalingClient()
+        # One launch per student at a time; duplicates share its result
+        if not CACHE_TABLE:
+            return launch()
+        return LaunchGate().run(student_id, idempotency_key, launch)
+    
+    except Exception as e:
+        logger.exception("Error creating session")
+        return error_response(500, "Internal server error", str(e))
+
+
+def accept_launch(
+    student_id: str,
+    student_name: str,
+    course_id: str,
+    lab_id: str,
+    metadata: dict,
+    token_payload: dict,
+    prober: ReadinessProber,
+) -> dict:
+    """
+    Accept a launch for an authenticated student.
+    
+    Checks quota and the student's existing sessions, then writes a PENDING
+    session and queues its launch job. Runs under the student's LaunchGate,
+    so no other launch for the student is in flight.
+    """
+    # Resolve plan and quota from token
+    plan, quota_minutes, roles = resolve_plan_info(token_payload)
+    logger.info(f"User {student_id} plan: {plan}, quota: {quota_minutes} minutes")
+    
+    # Check usage quota (unless unlimited)
+    if USAGE_TABLE and quota_minutes != -1:
+        usage_tracker = UsageTracker(USAGE_TABLE)
+        quota_check = usage_tracker.check_quota(student_id, quota_minutes)
         
-        # Check for existing active session
-        existing_sessions = sessions_db.query_by_index(
-            "StudentIndex", "student_id", student_id
-        )
+        if not quota_check["allowed"]:
+            logger.warning(f"Quota exceeded for user {student_id}: {quota_check}")
+            return error_response(
+                403,
+                "Monthly usage limit exceeded",
+                {
+                    "error": "quota_exceeded",
+                    "plan": plan,
+                    "consumed_minutes": quota_check["consumed_minutes"],
+                    "quota_minutes": quota_minutes,
+                    "remaining_minutes": 0,
+                    "resets_at": quota_check["resets_at"],
+                }
+            )
         
-        logger.info(f"[STALE_SESSION_CHECK] Checking for existing sessions for student_id={student_id}")
-        logger.info(f"[STALE_SESSION_CHECK] Found {len(existing_sessions)} total session(s) in database")
+        logger.info(f"Quota check passed: {quota_check['remaining_minutes']} minutes remaining")
+    
+    # Initialize clients
+    sessions_db = DynamoDBClient(SESSIONS_TABLE)
+    pool_db = DynamoDBClient(INSTANCE_POOL_TABLE)
+    
+    # Stale session the new one replaces; its instance and Guacamole resources
+    # are released by the provisioning worker
+    stale_session_id = None
+    
+    # Check for existing active session: one consistent read of the student's
+    # pointer, or StudentCreatedIndex for students who do not have one yet
+    # (filtered server-side so a student's terminated history is never transferred)
+    pointers = ActiveSessionPointers(sessions_db) if ACTIVE_SESSIONS_TABLE else None
+    existing_sessions = pointers.live_sessions(student_id) if pointers else None
+    if existing_sessions is None:
+        existing_sessions = sessions_db.query_user_sessions(
+            student_id,
+            limit=None,
+            status_filter=[SessionStatus.PENDING, SessionStatus.PROVISIONING,
+                           SessionStatus.READY, SessionStatus.ACTIVE],
+        )
+        if pointers:
+            pointers.seed(student_id, existing_sessions)
+    
+    logger.info(f"[STALE_SESSION_CHECK] Checking for existing sessions for student_id={student_id}")
+    logger.info(f"[STALE_SESSION_CHECK] Found {len(existing_sessions)} live session(s) in database")
+    
+    # Log all session statuses for debugging
+    for idx, sess in enumerate(existing_sessions):
+        logger.info(f"[STALE_SESSION_CHECK] Session {idx+1}: id={sess.get('session_id')}, status={sess.get('status')}, created_at={sess.get('created_at')}")
+    
+    active_sessions = [
+        s for s in existing_sessions
+        if s.get("status") in [SessionStatus.PENDING, SessionStatus.PROVISIONING, 
+                                SessionStatus.READY, SessionStatus.ACTIVE]
+    ]
+    
+    logger.info(f"[STALE_SESSION_CHECK] Found {len(active_sessions)} active session(s) (status in [PENDING, PROVISIONING, READY, ACTIVE])")
+    logger.info(f"[STALE_SESSION_CHECK] MAX_SESSIONS={MAX_SESSIONS}, will check if {len(active_sessions)} >= {MAX_SESSIONS}")
+    
+    if len(active_sessions) >= MAX_SESSIONS:
+        session = active_sessions[0]
+        connection_info = session.get("connection_info", {})
+        guac_connection_id = connection_info.get("guacamole_connection_id")
         
-        # Log all session statuses for debugging
-        for idx, sess in enumerate(existing_sessions):
-            logger.info(f"[STALE_SESSION_CHECK] Session {idx+1}: id={sess.get('session_id')}, status={sess.get('status')}, created_at={sess.get('created_at')}")
+        logger.info(f"[STALE_SESSION_CHECK] ========== EXISTING SESSION FOUND ==========")
+        logger.info(f"[STALE_SESSION_CHECK] User {student_id} already has {len(active_sessions)} active session(s)")
+        logger.info(f"[STALE_SESSION_CHECK] Existing session ID: {session['session_id']}")
+        logger.info(f"[STALE_SESSION_CHECK] Existing session status: {session.get('status')}")
+        logger.info(f"[STALE_SESSION_CHECK] Guacamole connection ID: {guac_connection_id}")
+        logger.info(f"[STALE_SESSION_CHECK] Checking if user is actually connected to Guacamole...")
         
-        active_sessions = [
-            s for s in existing_sessions
-            if s.get("status") in [SessionStatus.PENDING, SessionStatus.PROVISIONING, 
-                                    SessionStatus.READY, SessionStatus.ACTIVE]
-        ]
+        # Check if the user is actually connected to Guacamole and session is valid
+        # If they logged out via Guacamole's logout button, the session
+        # will appear "active" in DynamoDB but they won't be connected
+        # OR the session user might have been deleted
+        is_session_valid = False
         
-        logger.info(f"[STALE_SESSION_CHECK] Found {len(active_sessions)} active session(s) (status in [PENDING, PROVISIONING, READY, ACTIVE])")
-        logger.info(f"[STALE_SESSION_CHECK] MAX_SESSIONS={MAX_SESSIONS}, will check if {len(active_sessions)} >= {MAX_SESSIONS}")
+        if guac_connection_id:
+            guac_session_user = connection_info.get("guacamole_session_user")
+            is_session_valid = check_guacamole_session_valid(
+                connection_id=guac_connection_id,
+                session_user=guac_session_user,
+                session_id=session.get("session_id"),
+                student_id=session.get("student_id", student_id)
+            )
+            logger.info(f"[STALE_SESSION_CHECK] Guacamole session validity check result: valid={is_session_valid}")
+        else:
+            # No Guacamole connection ID - might be in PENDING/PROVISIONING state
+            # These are still valid sessions that haven't finished setup yet
+            if session.get("status") in [SessionStatus.PENDING, SessionStatus.PROVISIONING]:
+                logger.info(f"[STALE_SESSION_CHECK] Session is still provisioning (no Guacamole connection yet)")
+                logger.info(f"[STALE_SESSION_CHECK] Returning existing provisioning session")
+                return success_response(
+                    {
+                        "session_id": session["session_id"],
+                        "status": session["status"],
+                        "instance_id": session.get("instance_id"),
+                        "connection_info": connection_info,
+                        "created_at": session.get("created_at"),
+                        "expires_at": session.get("expires_at"),
+                        "reused": True,
+                    },
+                    "Existing session found (provisioning)"
+                )
+            else:
+                logger.info(f"[STALE_SESSION_CHECK] No Guacamole connection ID but session is {session.get('status')}")
         
-        if len(active_sessions) >= MAX_SESSIONS:
-            session = active_sessions[0]
-            connection_info = session.get("connection_info", {})
-            guac_connection_id = connection_info.get("guacamole_connection_id")
-            
-            logger.info(f"[STALE_SESSION_CHECK] ========== EXISTING SESSION FOUND ==========")
-            logger.info(f"[STALE_SESSION_CHECK] User {student_id} already has {len(active_sessions)} active session(s)")
-            logger.info(f"[STALE_SESSION_CHECK] Existing session ID: {session['session_id']}")
-            logger.info(f"[STALE_SESSION_CHECK] Existing session status: {session.get('status')}")
-            logger.info(f"[STALE_SESSION_CHECK] Guacamole connection ID: {guac_connection_id}")
-            logger.info(f"[STALE_SESSION_CHECK] Checking if user is actually connected to Guacamole...")
+        if is_session_valid:
+            # User appears connected, but their Guacamole auth token might be invalid
+            # (e.g., they logged out via Guacamole UI but the tunnel is still active)
+            # Regenerate the session user and URL to ensure they can connect
+            logger.info(f"[STALE_SESSION_CHECK] ===== CONNECTION APPEARS ACTIVE =====")
+            logger.info(f"[STALE_SESSION_CHECK] Regenerating Guacamole session user to ensure valid access")
             
-            # Check if the user is actually connected to Guacamole and session is valid
-            # If they logged out via Guacamole's logout button, the session
-            # will appear "active" in DynamoDB but they won't be connected
-            # OR the session user might have been deleted
-            is_session_valid = False
-            
-            if guac_connection_id:
-                guac_session_user = connection_info.get("guacamole_session_user")
-                is_session_valid = check_guacamole_session_valid(
+            # Try to regenerate the Guacamole session user and get a fresh URL
+            instance_ip = session.get("instance_ip")
+            if instance_ip and guac_connection_id:
+                fresh_connection_info = regenerate_guacamole_session_access(
+                    session_id=session["session_id"],
+                    student_id=session.get("student_id", student_id),
                     connection_id=guac_connection_id,
-                    session_user=guac_session_user,
-                    session_id=session.get("session_id"),
-                    student_id=session.get("student_id", student_id)
+                    existing_connection_info=connection_info,
+                    prober=prober,
                 )
-                logger.info(f"[STALE_SESSION_CHECK] Guacamole session validity check result: valid={is_session_valid}")
-            else:
-                # No Guacamole connection ID - might be in PENDING/PROVISIONING state
-                # These are still valid sessions that haven't finished setup yet
-                if session.get("status") in [SessionStatus.PENDING, SessionStatus.PROVISIONING]:
-                    logger.info(f"[STALE_SESSION_CHECK] Session is still provisioning (no Guacamole connection yet)")
-                    logger.info(f"[STALE_SESSION_CHECK] Returning existing provisioning session")
-                    return success_response(
-                        {
-                            "session_id": session["session_id"],
-                            "status": session["status"],
-                            "instance_id": session.get("instance_id"),
-                            "connection_info": connection_info,
-                            "created_at": session.get("created_at"),
-                            "expires_at": session.get("expires_at"),
-                            "reused": True,
-                        },
-                        "Existing session found (provisioning)"
-                    )
-                else:
-                    logger.info(f"[STALE_SESSION_CHECK] No Guacamole connection ID but session is {session.get('status')}")
-            
-            if is_session_valid:
-                # User appears connected, but their Guacamole auth token might be invalid
-                # (e.g., they logged out via Guacamole UI but the tunnel is still active)
-                # Regenerate the session user and URL to ensure they can connect
-                logger.info(f"[STALE_SESSION_CHECK] ===== CONNECTION APPEARS ACTIVE =====")
-                logger.info(f"[STALE_SESSION_CHECK] Regenerating Guacamole session user to ensure valid access")
                 
-                # Try to regenerate the Guacamole session user and get a fresh URL
-                instance_ip = session.get("instance_ip")
-                if instance_ip and guac_connection_id:
-                    fresh_connection_info = regenerate_guacamole_session_access(
-                        session_id=session["session_id"],
-                        student_id=session.get("student_id", student_id),
-                        connection_id=guac_connection_id,
-                        existing_connection_info=connection_info,
-                    )
-                    
-                if fresh_connection_info:
-                    # Update the session with the new connection info
-                    sessions_db.update_item(
-                        {"session_id": session["session_id"]},
-                        {
-                            "connection_info": fresh_connection_info,
-                            "updated_at": get_current_timestamp(),
-                        }
-                    )
-                    logger.info(f"[STALE_SESSION_CHECK] Regenerated session access, returning refreshed session")
-                    return success_response(
-                        {
-                            "session_id": session["session_id"],
-                            "status": session["status"],
-                            "instance_id": session.get("instance_id"),
-                            "connection_info": fresh_connection_info,
-                            "created_at": session.get("created_at"),
-                            "expires_at": session.get("expires_at"),
-                            "reused": True,
-                            "access_refreshed": True,
-                        },
-                        "Existing session found (access refreshed)"
-                    )
-                else:
-                    logger.warning(f"[STALE_SESSION_CHECK] Failed to regenerate session access - cleaning up and creating NEW session")
-                    cleanup_stale_session(session, sessions_db, pool_db, reason="stale_access_regeneration_failed")
-                    # Fall through to create a new session
+            if fresh_connection_info:
+                # Update the session with the new connection info
+                sessions_db.update_item(
+                    {"session_id": session["session_id"]},
+                    {
+                        "connection_info": fresh_connection_info,
+                        "updated_at": get_current_timestamp(),
+                    }
+                )
+                logger.info(f"[STALE_SESSION_CHECK] Regenerated session access, returning refreshed session")
+                return success_response(
+                    {
+                        "session_id": session["session_id"],
+                        "status": session["status"],
+                        "instance_id": session.get("instance_id"),
+                        "connection_info": fresh_connection_info,
+                        "created_at": session.get("created_at"),
+                        "expires_at": session.get("expires_at"),
+                        "reused": True,
+                        "access_refreshed": True,
+                    },
+                    "Existing session found (access refreshed)"
+                )
             else:
-                # Session is NOT valid - user logged out of Guacamole or session user was deleted
-                # Clean up the stale session and continue to create a new one
-                logger.info(f"[STALE_SESSION_CHECK] ===== STALE SESSION DETECTED =====")
-                logger.info(f"[STALE_SESSION_CHECK] User logged out of Guacamole or session user was deleted")
-                logger.info(f"[STALE_SESSION_CHECK] Auto-terminating stale session and creating a new one...")
-                cleanup_stale_session(session, sessions_db, pool_db, reason="stale_guacamole_logout")
-                logger.info(f"[STALE_SESSION_CHECK] Proceeding to create new session for user {student_id}")
-                
-                # Longer delay to ensure Guacamole cleanup completes before creating new connection
-                # This prevents "disconnected" errors when reusing the same instance
-                # Guacamole needs time to fully clean up connections and reset internal state
-                # Windows RDP also needs time to reset after session ends
-                import time
-                time.sleep(5.0)  # Increased delay for Windows RDP reset
-                logger.info(f"[STALE_SESSION_CHECK] Delay complete, creating new session")
-        
-        # Generate new session
-        session_id = generate_session_id()
-        now = get_current_timestamp()
-        expires_at = calculate_expiry(SESSION_TTL_HOURS)
-        
-        # Get the ASG for this user's plan
-        asg_name = get_asg_for_plan(plan)
-        logger.info(f"Using ASG {asg_name} for plan {plan}")
-        
-        # Create session record in pending state
-        session_record = {
+                logger.warning(f"[STALE_SESSION_CHECK] Failed to regenerate session access - cleaning up and creating NEW session")
+                cleanup_stale_session(session, sessions_db, pool_db, reason="stale_access_regeneration_failed", release_resources=False, pointers=pointers)
+                stale_session_id = session["session_id"]
+                # Fall through to create a new session
+        else:
+            # Session is NOT valid - user logged out of Guacamole or session user was deleted
+            # Clean up the stale session and continue to create a new one
+            logger.info(f"[STALE_SESSION_CHECK] ===== STALE SESSION DETECTED =====")
+            logger.info(f"[STALE_SESSION_CHECK] User logged out of Guacamole or session user was deleted")
+            logger.info(f"[STALE_SESSION_CHECK] Auto-terminating stale session and creating a new one...")
+            cleanup_stale_session(session, sessions_db, pool_db, reason="stale_guacamole_logout", release_resources=False, pointers=pointers)
+            stale_session_id = session["session_id"]
+            logger.info(f"[STALE_SESSION_CHECK] Proceeding to create new session for user {student_id}")
+    
+    # Generate new session
+    session_id = generate_session_id()
+    now = get_current_timestamp()
+    expires_at = calculate_expiry(SESSION_TTL_HOURS)
+    
+    # Create session record in pending state
+    session_record = {
+        "session_id": session_id,
+        "student_id": student_id,
+        "student_name": student_name,
+        "course_id": course_id,
+        "lab_id": lab_id,
+        "plan": plan,  # Store plan in session for filtering
+        "status": SessionStatus.PENDING,
+        "created_at": now,
+        "updated_at": now,
+        "expires_at": expires_at,
+        "metadata": metadata,
+    }
+    
+    if pointers:
+        created = pointers.create_session(session_record, MAX_SESSIONS)
+        if created is False:
+            # Another session went live since the check above
+            return error_response(409, "An active session already exists for this student")
+    else:
+        created = sessions_db.put_item(session_record)
+    if not created:
+        return error_response(500, "Failed to create session record")
+    
+    # Allocation, tagging and Guacamole setup run in the provisioning worker
+    job = {"session_id": session_id, "enqueued_at": now}
+    if stale_session_id:
+        job["stale_session_id"] = stale_session_id
+    
+    launch_queue = get_launch_queue()
+    if not launch_queue.send(job):
+        logger.warning(f"[LAUNCH_QUEUE] Could not enqueue session {session_id}, provisioning inline")
+        return provision_session(job)
+    
+    if isinstance(launch_queue, MemoryLaunchQueue):
+        # Nothing else drains an in-process queue, so provision before returning
+        return process_launch_queue(launch_queue).get(session_id) or error_response(
+            500, "Failed to provision session"
+        )
+    
+    logger.info(f"[LAUNCH_QUEUE] Accepted session {session_id} for student {student_id}")
+    return success_response(
+        {
             "session_id": session_id,
-            "student_id": student_id,
-            "student_name": student_name,
-            "course_id": course_id,
-            "lab_id": lab_id,
-            "plan": plan,  # Store plan in session for filtering
             "status": SessionStatus.PENDING,
+            "message": "Session accepted. Please poll for status.",
+            "poll_interval_seconds": 3,
             "created_at": now,
-            "updated_at": now,
             "expires_at": expires_at,
-            "metadata": metadata,
-        }
+        },
+        "Session accepted, provisioning queued"
+    )
+
+def provision_session(job: dict) -> dict:
+    """
+    Provision a PENDING session from a launch job.
+    
+    Releases the stale session the launch replaces (if any), allocates an
+    instance from the pool, warm pool or ASG, and sets up Guacamole, moving the
+    session through PROVISIONING to READY. Returns the API response for the
+    result, which the accept step returns directly when provisioning inline.
+    """
+    session_id = job.get("session_id")
+    enqueued_at = job.get("enqueued_at") or 0
+    
+    sessions_db = DynamoDBClient(SESSIONS_TABLE)
+    pool_db = DynamoDBClient(INSTANCE_POOL_TABLE)
+    
+    # Claim the job so a redelivered message never provisions a session twice.
+    # The claim is a lease: once it lapses, a worker that died mid-claim is replaced
+    now = get_current_timestamp()
+    claimed = sessions_db.conditional_update(
+        {"session_id": session_id},
+        {"provisioning_started_at": now, "updated_at": now},
+        condition_expression=(
+            "#status = :pending AND (attribute_not_exists(provisioning_started_at)"
+            " OR provisioning_started_at < :lease_expired)"
+        ),
+        expression_attribute_names={"#status": "status"},
+        expression_attribute_values={
+            ":pending": SessionStatus.PENDING,
+            ":lease_expired": now - PROVISIONING_LEASE,
+        },
+    )
+    if not claimed:
+        logger.info(f"[LAUNCH_WORKER] Session {session_id} is not pending or already claimed, skipping")
+        return error_response(409, "Session is not awaiting provisioning")
+    
+    logger.info(f"[LAUNCH_WORKER] Provisioning session {session_id} (queued {now - int(enqueued_at)}s)")
+    
+    try:
+        session = sessions_db.get_item({"session_id": session_id})
+        if not session:
+            return error_response(404, "Session not found")
+        
+        student_id = session["student_id"]
+        student_name = session.get("student_name", "Unknown")
+        course_id = session.get("course_id", "independent")
+        plan = session.get("plan", "pro")
+        expires_at = session.get("expires_at")
         
-        if not sessions_db.put_item(session_record):
-            return error_response(500, "Failed to create session record")
+        ec2_client = EC2Client()
+        asg_client = AutoScalingClient()
         
-        # Try to find an available instance from the pool for this plan
-        # Use pessimistic locking to prevent race conditions
+        # Records how long each readiness condition takes on this launch
+        prober = ReadinessProber()
+        
+        # Release what the replaced stale session still holds. No fixed delay is needed
+        # afterwards: the Guacamole cleanup is synchronous, and the released instance is
+        # marked with released_at so allocation probes its RDP reset below
+        stale_session_id = job.get("stale_session_id")
+        if stale_session_id:
+            stale_session = sessions_db.get_item({"session_id": stale_session_id})
+            if stale_session:
+                release_stale_session_resources(stale_session, pool_db)
+        
+        # Get the ASG for this user's plan
+        asg_name = get_asg_for_plan(plan)
+        logger.info(f"Using ASG {asg_name} for plan {plan}")
+        
+        # Try to find an available instance from the pool for this plan.
+        # Concurrent launches spread their claims over the candidates (see InstanceClaimer)
         instance_id = None
         instance_ip = None
-        max_allocation_retries = 3
-        
-        # Query available instances and filter by plan
-        all_available = pool_db.query_by_index(
-            "StatusIndex", "status", InstanceStatus.AVAILABLE
-        )
-        # Filter by plan - only use instances from the same tier
-        available_instances = [
-            inst for inst in all_available
-            if inst.get("plan", "pro") == plan  # Default to "pro" for backward compat
-        ]
-        logger.info(f"Found {len(available_instances)} available instances for plan {plan}")
+        pooled_connection_id = None
+        previous_session_user = None
+        claimer = InstanceClaimer(pool_db, tickets=get_claim_tickets())
+        unusable = set()
         
-        # Try to allocate an instance with retry logic for race conditions
-        for retry_attempt in range(max_allocation_retries):
-            if not available_instances:
-                logger.info(f"No available instances found (attempt {retry_attempt + 1}/{max_allocation_retries})")
+        # Claim first, then check only the instance that was won: under a burst of
+        # launches this is one EC2 describe per claim instead of one per candidate
+        for _ in range(MAX_UNUSABLE_CLAIMS):
+            pool_record = claimer.claim(
+                plan,
+                session_id,
+                {
+                    "status": InstanceStatus.ASSIGNED,
+                    "session_id": session_id,
+                    "student_id": student_id,
+                    "assigned_at": now,
+                    "guacamole_session_user": f"session_{session_id[-8:]}",
+                },
+                now,
+                exclude=unusable,
+            )
+            logger.info(f"[CLAIM] Session {session_id} claim stats: {claimer.stats}")
+            if not pool_record:
                 break
-                
-            # Try each available instance until we successfully claim one
-            for pool_record in available_instances:
-                candidate_id = pool_record["instance_id"]
-                
+            
+            candidate_id = pool_record["instance_id"]
+            instance_info = ec2_client.get_instance_status(candidate_id)
+            if not instance_info or instance_info.get("State", {}).get("Name") != "running":
+                # Instance not running, mark as unhealthy and claim another
+                pool_db.update_item(
+                    {"instance_id": candidate_id},
+                    {"status": InstanceStatus.UNHEALTHY}
+                )
+                unusable.add(candidate_id)
+                continue
+            
+            instance_id = candidate_id
+            instance_ip = instance_info.get("PrivateIpAddress")
+            
+            # Connection pre-built by pool-manager, and the last session user
+            # on it if that session's cleanup didn't remove it
+            pooled_connection_id = get_pooled_connection_id(pool_record, instance_ip)
+            previous_session_user = pool_record.get("guacamole_session_user")
+            
+            # Check if instance was recently released (Windows RDP needs time to reset)
+            released_at = pool_record.get("released_at", 0)
+            if released_at:
+                # Convert Decimal to int if needed (DynamoDB returns Decimal)
                 try:
-                    # Verify instance is actually running
-                    instance_info = ec2_client.get_instance_status(candidate_id)
-                    if not instance_info or instance_info.get("State", {}).get("Name") != "running":
-                        # Instance not running, mark as unhealthy
-                        pool_db.update_item(
-                            {"instance_id": candidate_id},
-                            {"status": InstanceStatus.UNHEALTHY}
-                        )
-                        continue
-                    
-                    # Atomically claim the instance using conditional update
-                    # This prevents race conditions by ensuring status is still AVAILABLE
-                    update_success = pool_db.conditional_update(
-                        {"instance_id": candidate_id},
-                        {
-                            "status": InstanceStatus.ASSIGNED,
-                            "session_id": session_id,
-                            "student_id": student_id,
-                            "assigned_at": now,
-                        },
-                        condition_expression="#status = :available",
-                        expression_attribute_names={"#status": "status"},
-                        expression_attribute_values={":available": InstanceStatus.AVAILABLE}
-                    )
-                    
-                    if update_success:
-                        # Successfully claimed the instance
-                        instance_id = candidate_id
-                        instance_ip = instance_info.get("PrivateIpAddress")
-                        
-                        # Check if instance was recently released (Windows RDP needs time to reset)
-                        released_at = pool_record.get("released_at", 0)
-                        if released_at:
-                            # Convert Decimal to int if needed (DynamoDB returns Decimal)
-                            try:
-                                released_at = int(float(released_at))
-                            except (ValueError, TypeError):
-                                released_at = 0
-                        
-                        if released_at > 0:
-                            seconds_since_release = now - released_at
-                            if seconds_since_release < 20:
-                                # Instance was released recently - Windows RDP needs time to reset
-                                # Windows keeps RDP sessions in "disconnected" state for a while
-                                extra_delay = 20 - seconds_since_release
-                                logger.info(f"Instance {instance_id} was released {seconds_since_release}s ago, adding {int(extra_delay)}s delay for Windows RDP reset")
-                                import time
-                                time.sleep(int(extra_delay))
-                        
-                        # Tag the instance
-                        ec2_client.tag_instance(instance_id, {
-                            "SessionId": session_id,
-                            "StudentId": student_id,
-                            "AssignedAt": get_iso_timestamp(),
-                        })
-                        
-                        logger.info(f"Successfully allocated instance {instance_id} to session {session_id}")
-                        break
-                    else:
-                        # Another Lambda grabbed this instance, try next one
-                        logger.info(f"Instance {candidate_id} was claimed by another session, trying next")
-                        continue
-                        
-                except Exception as e:
-                    logger.warning(f"Error attempting to allocate instance {candidate_id}: {str(e)}")
-                    continue
+                    released_at = int(float(released_at))
+                except (ValueError, TypeError):
+                    released_at = 0
             
-            # If we successfully allocated an instance, break out of retry loop
-            if instance_id:
-                break
+            if released_at > 0:
+                seconds_since_release = now - released_at
+                if seconds_since_release < RDP_RESET_TIMEOUT:
+                    # Instance was released recently - the RDP server keeps the old
+                    # session in "disconnected" state for a while before it resets
+                    max_wait = RDP_RESET_TIMEOUT - seconds_since_release
+                    logger.info(f"Instance {instance_id} was released {seconds_since_release}s ago, waiting up to {int(max_wait)}s for RDP reset")
+                    wait_for_rdp_reset(prober, instance_ip, released_at, max_wait)
             
-            # If not successful and we have retries left, re-query for available instances
-            if retry_attempt < max_allocation_retries - 1:
-                import time
-                time.sleep(0.3 * (retry_attempt + 1))  # Exponential backoff
-                all_available = pool_db.query_by_index(
-                    "StatusIndex", "status", InstanceStatus.AVAILABLE
-                )
-                available_instances = [
-                    inst for inst in all_available
-                    if inst.get("plan", "pro") == plan
-                ]
+            # Tag the instance
+            ec2_client.tag_instance(instance_id, {
+                "SessionId": session_id,
+                "StudentId": student_id,
+                "AssignedAt": get_iso_timestamp(),
+            })
+            
+            logger.info(f"Successfully allocated instance {instance_id} to session {session_id}")
+            break
         
         # If no available instance, check ASG for stopped instances or scale up
         if not instance_id:
@@ -875,13 +1139,22 @@ def handler(event, context):
             asg_instances = asg_client.get_asg_instances(asg_name)
             logger.info(f"Found {len(asg_instances)} instances in ASG {asg_name}")
             
+            # Resolve state for all candidate ASG instances in one batched EC2 call
+            asg_states = ec2_client.get_instances_status(
+                [
+                    inst.get("InstanceId") for inst in asg_instances
+                    if inst.get("LifecycleState") in ["InService", "Warmed:Stopped"]
+                ],
+                include_health=False,
+            )
+            
             # Look for stopped instances we can start (warm pool) or running instances we can use
             for asg_instance in asg_instances:
                 inst_id = asg_instance.get("InstanceId")
                 lifecycle_state = asg_instance.get("LifecycleState")
                 
                 if lifecycle_state == "InService" or lifecycle_state == "Warmed:Stopped":
-                    instance_info = ec2_client.get_instance_status(inst_id)
+                    instance_info = asg_states.get(inst_id)
                     if instance_info:
                         state = instance_info.get("State", {}).get("Name")
                         
@@ -975,6 +1248,7 @@ def handler(event, context):
                             "provisioning_note": "Waiting for new instance from ASG",
                         }
                     )
+                    schedule_advance(session_id)
                     
                     return success_response(
                         {
@@ -1021,6 +1295,11 @@ def handler(event, context):
                 student_name=student_name,
                 instance_ip=instance_ip,
                 course_id=course_id,
+                prober=prober,
+                pooled_connection_id=pooled_connection_id,
+                previous_session_user=previous_session_user,
+                pool_db=pool_db,
+                instance_id=instance_id,
             )
             
             if guac_result:
@@ -1028,15 +1307,16 @@ def handler(event, context):
                 # The direct URL to the RDP session
                 connection_info["direct_url"] = guac_result.get("guacamole_connection_url")
                 
-                # Add delay after creating Guacamole connection to ensure it's fully initialized
-                # This prevents "disconnected" errors when the URL is opened immediately
-                # Windows RDP needs time to reset after previous sessions, especially if instance
-                # was recently released. Windows keeps disconnected sessions active for ~30 seconds.
-                import time
-                logger.info(f"Waiting for Guacamole connection and Windows RDP service to initialize before returning URL...")
-                logger.info(f"Adding extra delay for protocol-level reset...")
-                time.sleep(8.0)  # Increased delay for Windows RDP reset (was 5.0s)
-                logger.info(f"Guacamole connection initialization delay complete")
+                # The Guacamole connection and session token were verified above; make sure the
+                # RDP server itself accepts a new session before the student opens the URL
+                if ENABLE_RDP_PROBE:
+                    prober.wait_for("rdp_handshake", lambda: probe_rdp(instance_ip), RDP_READY_TIMEOUT)
+                else:
+                    prober.skip("rdp_handshake", "ENABLE_RDP_PROBE is false")
+            
+            readiness = prober.summary()
+            logger.info(f"[READINESS] Launch readiness for session {session_id}: {readiness}")
+            logger.info(f"[HTTP] Guacamole requests for session {session_id}: {get_http_transport().metrics(reset=True)}")
             
             # Update session as ready
             sessions_db.update_item(
@@ -1046,6 +1326,7 @@ def handler(event, context):
                     "instance_id": instance_id,
                     "instance_ip": instance_ip,
                     "connection_info": connection_info,
+                    "readiness": readiness,
                     "updated_at": now,
                 }
             )
@@ -1056,6 +1337,7 @@ def handler(event, context):
                     "status": SessionStatus.READY,
                     "instance_id": instance_id,
                     "connection_info": connection_info,
+                    "readiness": readiness,
                     "created_at": now,
                     "expires_at": expires_at,
                 },
@@ -1071,6 +1353,7 @@ def handler(event, context):
                     "updated_at": now,
                 }
             )
+            schedule_advance(session_id)
             
             return success_response(
                 {
@@ -1086,5 +1369,317 @@ def handler(event, context):
             )
     
     except Exception as e:
-        logger.exception("Error creating session")
+        logger.exception(f"[LAUNCH_WORKER] Error provisioning session {session_id}")
+        sessions_db.update_item(
+            {"session_id": session_id},
+            {
+                "status": SessionStatus.ERROR,
+                "error": str(e),
+                "updated_at": get_current_timestamp(),
+            }
+        )
         return error_response(500, "Internal server error", str(e))
+
+
+def schedule_advance(session_id: str, attempt: int = 0, chain: int = None, delay_seconds: int = ADVANCE_INTERVAL) -> bool:
+    """
+    Queue a delayed progression pass for a session that is still provisioning.
+    
+    `chain` must match the session's advance_chain for the pass to run, so
+    when pool-manager restarts a stalled chain the old one stops.
+    """
+    job = {"action": "advance", "session_id": session_id, "attempt": attempt, "chain": chain}
+    if not get_launch_queue().send(job, delay_seconds=delay_seconds):
+        logger.warning(f"[ALLOCATOR] Could not queue progression for session {session_id}, pool-manager will requeue it")
+        return False
+    return True
+
+
+def claim_waiting_instance(session: dict, pool_db, ec2_client, now: int) -> dict:
+    """
+    Claim an instance for a PROVISIONING session that has none yet.
+    
+    Tries AVAILABLE pool records for the session's plan first, then healthy
+    InService ASG instances pool-manager has not synced yet. Returns the
+    claimed instance's {instance_id, instance_ip}, or {} if none was free.
+    """
+    session_id = session["session_id"]
+    student_id = session.get("student_id")
+    plan = session.get("plan", "pro")
+    
+    try:
+        claimer = InstanceClaimer(pool_db, tickets=get_claim_tickets())
+        unusable = set()
+        for _ in range(MAX_UNUSABLE_CLAIMS):
+            pool_record = claimer.claim(
+                plan,
+                session_id,
+                {
+                    "status": InstanceStatus.ASSIGNED,
+                    "session_id": session_id,
+                    "student_id": student_id,
+                    "assigned_at": now,
+                    "guacamole_session_user": f"session_{session_id[-8:]}",
+                },
+                now,
+                exclude=unusable,
+            )
+            if not pool_record:
+                break
+            
+            candidate_id = pool_record["instance_id"]
+            instance_info = ec2_client.get_instance_status(candidate_id)
+            if not instance_info or instance_info.get("State", {}).get("Name") != "running":
+                pool_db.update_item({"instance_id": candidate_id}, {"status": InstanceStatus.UNHEALTHY})
+                unusable.add(candidate_id)
+                continue
+            
+            logger.info(f"[ALLOCATOR] Allocated pool instance {candidate_id} to session {session_id} ({claimer.stats})")
+            return {"instance_id": candidate_id, "instance_ip": instance_info.get("PrivateIpAddress")}
+    except Exception as e:
+        logger.warning(f"[ALLOCATOR] Error trying to allocate pool instance: {str(e)}")
+    
+    # The pool-manager may not have synced a freshly launched ASG instance yet
+    asg_name = get_asg_for_plan(plan)
+    if not asg_name:
+        return {}
+    
+    try:
+        asg_instances = AutoScalingClient().get_asg_instances(asg_name)
+        asg_states = ec2_client.get_instances_status([
+            inst.get("InstanceId") for inst in asg_instances
+            if inst.get("LifecycleState") == "InService"
+        ])
+        
+        for inst_id, instance_info in asg_states.items():
+            if instance_info.get("State", {}).get("Name") != "running":
+                continue
+            if not instance_info.get("HealthChecks", {}).get("all_passed", False):
+                continue
+            
+            # Only instances pool-manager has never recorded are free to take here;
+            # recorded ones are claimed through their pool record above
+            claimed = pool_db.conditional_update(
+                {"instance_id": inst_id},
+                {
+                    "status": InstanceStatus.ASSIGNED,
+                    "session_id": session_id,
+                    "student_id": student_id,
+                    "assigned_at": now,
+                    "plan": plan,
+                },
+                condition_expression="attribute_not_exists(instance_id)",
+            )
+            if claimed:
+                ec2_client.tag_instance(inst_id, {
+                    "SessionId": session_id,
+                    "StudentId": student_id,
+                    "AssignedAt": get_iso_timestamp(),
+                })
+                logger.info(f"[ALLOCATOR] Allocated unsynced ASG instance {inst_id} to session {session_id}")
+                return {"instance_id": inst_id, "instance_ip": instance_info.get("PrivateIpAddress")}
+    except Exception as e:
+        logger.warning(f"[ALLOCATOR] Error trying to allocate ASG instance: {str(e)}")
+    
+    return {}
+
+
+def progress_session(session: dict, pool_db, ec2_client, now: int) -> dict:
+    """
+    Work out the next state of a PROVISIONING session.
+    
+    Allocates an instance if the session is still waiting for one, follows
+    the instance through start-up and status checks, and sets up Guacamole
+    once it is usable. Returns the session fields that should change.
+    """
+    session_id = session["session_id"]
+    changes = {}
+    time_waiting = now - int(session.get("created_at", now))
+    
+    instance_id = session.get("instance_id")
+    if not instance_id:
+        claimed = claim_waiting_instance(session, pool_db, ec2_client, now)
+        if not claimed:
+            if time_waiting > ALLOCATION_TIMEOUT:
+                logger.error(f"[ALLOCATOR] Session {session_id} stuck in provisioning without instance for {time_waiting}s")
+                changes["status"] = SessionStatus.ERROR
+                changes["error"] = "Instance allocation timed out. The system may be at capacity. Please try again in a moment."
+            return changes
+        instance_id = claimed["instance_id"]
+        changes["instance_id"] = instance_id
+        changes["instance_ip"] = claimed["instance_ip"]
+    
+    instance_info = ec2_client.get_instance_status(instance_id)
+    if not instance_info:
+        changes["status"] = SessionStatus.ERROR
+        changes["error"] = "Instance not found"
+        return changes
+    
+    instance_state = instance_info.get("State", {}).get("Name", "unknown")
+    changes["instance_state"] = instance_state
+    
+    if instance_state == "pending":
+        return changes
+    if instance_state in ["stopping", "shutting-down"]:
+        changes["status"] = SessionStatus.TERMINATING
+        return changes
+    if instance_state in ["stopped", "terminated"]:
+        changes["status"] = SessionStatus.TERMINATED
+        return changes
+    if instance_state != "running":
+        return changes
+    
+    instance_ip = instance_info.get("PrivateIpAddress")
+    health_checks = instance_info.get("HealthChecks", {})
+    changes["instance_ip"] = instance_ip
+    changes["health_checks"] = {
+        "system_status": health_checks.get("system_status", "unknown"),
+        "instance_status": health_checks.get("instance_status", "unknown"),
+        "passed_checks": health_checks.get("passed_checks", 0),
+        "total_checks": health_checks.get("total_checks", 3),
+        "all_passed": health_checks.get("all_passed", False),
+    }
+    
+    health_passed = health_checks.get("all_passed", False)
+    if not health_passed and time_waiting <= HEALTH_CHECK_GRACE:
+        changes["provisioning_stage"] = "waiting_health_checks"
+        return changes
+    if not health_passed:
+        logger.warning(f"[ALLOCATOR] Session {session_id} proceeding after {time_waiting}s. Health checks: {health_checks}")
+    
+    connection_info = {
+        "type": "rdp",
+        "guacamole_url": get_guacamole_public_url(),
+        "instance_ip": instance_ip,
+        "rdp_port": 3389,
+        "vnc_port": 5901,
+        "ssh_port": 22,
+    }
+    
+    # Attach to the connection pool-manager pre-built for this instance, if any
+    pool_record = pool_db.get_item({"instance_id": instance_id}) or {}
+    guac_result = create_guacamole_connection(
+        session_id=session_id,
+        student_id=session.get("student_id", ""),
+        student_name=session.get("student_name", "Unknown"),
+        instance_ip=instance_ip,
+        course_id=session.get("course_id", ""),
+        pooled_connection_id=get_pooled_connection_id(pool_record, instance_ip),
+        previous_session_user=pool_record.get("guacamole_session_user"),
+        pool_db=pool_db,
+        instance_id=instance_id,
+    )
+    
+    if guac_result:
+        connection_info.update(guac_result)
+        connection_info["direct_url"] = guac_result.get("guacamole_connection_url")
+    elif time_waiting <= ALLOCATION_TIMEOUT:
+        # Guacamole may still be coming up: try again on the next pass
+        logger.warning(f"[ALLOCATOR] Guacamole connection for session {session_id} failed, retrying")
+        changes["provisioning_stage"] = "creating_guac_connection"
+        return changes
+    
+    changes["status"] = SessionStatus.READY
+    changes["connection_info"] = connection_info
+    return changes
+
+
+def advance_session(job: dict) -> dict:
+    """
+    Run one progression pass for a PROVISIONING session.
+    
+    This is the only place a provisioning session moves forward after the
+    launch job, so status reads never write. Only changed fields are saved,
+    conditional on the session still being PROVISIONING so a concurrent
+    terminate wins; the next pass is queued until the session settles.
+    """
+    session_id = job.get("session_id")
+    sessions_db = DynamoDBClient(SESSIONS_TABLE)
+    pool_db = DynamoDBClient(INSTANCE_POOL_TABLE)
+    
+    session = sessions_db.get_item({"session_id": session_id})
+    if not session or session.get("status") != SessionStatus.PROVISIONING:
+        logger.info(f"[ALLOCATOR] Session {session_id} is no longer provisioning, stopping")
+        return {"session_id": session_id, "status": (session or {}).get("status")}
+    if job.get("chain") != session.get("advance_chain"):
+        logger.info(f"[ALLOCATOR] Progression chain {job.get('chain')} for session {session_id} was replaced, stopping")
+        return {"session_id": session_id, "status": session["status"]}
+    
+    now = get_current_timestamp()
+    if session.get("expires_at") and now > session["expires_at"]:
+        # pool-manager terminates expired sessions
+        return {"session_id": session_id, "status": session["status"]}
+    
+    changes = {
+        field: value
+        for field, value in progress_session(session, pool_db, EC2Client(), now).items()
+        if session.get(field) != value
+    }
+    
+    if changes:
+        changes["updated_at"] = now
+        saved = sessions_db.conditional_update(
+            {"session_id": session_id},
+            changes,
+            condition_expression="#status = :provisioning",
+            expression_attribute_names={"#status": "status"},
+            expression_attribute_values={":provisioning": SessionStatus.PROVISIONING},
+        )
+        if not saved:
+            logger.info(f"[ALLOCATOR] Session {session_id} changed while advancing, stopping")
+            return {"session_id": session_id, "status": None}
+        if "status" in changes:
+            logger.info(f"[ALLOCATOR] Session {session_id}: {session['status']} -> {changes['status']}")
+    
+    status = changes.get("status", session["status"])
+    if status == SessionStatus.PROVISIONING:
+        schedule_advance(session_id, attempt=int(job.get("attempt", 0)) + 1, chain=job.get("chain"))
+    
+    return {"session_id": session_id, "status": status}
+
+
+def run_launch_job(job: dict) -> dict:
+    """Dispatch a launch queue job: first provisioning, or a later progression pass."""
+    if job.get("action") == "advance":
+        return advance_session(job)
+    return provision_session(job)
+
+
+def process_launch_queue(launch_queue, max_jobs: int = None) -> dict:
+    """
+    Drain launch jobs from a queue, provisioning each one.
+    
+    Returns {session_id: response} for the jobs processed.
+    """
+    results = {}
+    while max_jobs is None or len(results) < max_jobs:
+        batch = launch_queue.receive(max_messages=10 if max_jobs is None else min(10, max_jobs - len(results)))
+        if not batch:
+            break
+        
+        for receipt, job in batch:
+            # Keep the provisioning response when a progression pass follows it
+            results.setdefault(job.get("session_id"), run_launch_job(job))
+            launch_queue.delete(receipt)
+    
+    return results
+
+
+def worker_handler(event, context):
+    """
+    Provisioning worker handler.
+    
+    Triggered by SQS with a batch of launch jobs and delayed progression
+    passes for sessions still provisioning. Invoked without SQS
+    records, it drains the configured launch queue instead (local runs).
+    """
+    if event.get("Records"):
+        jobs = parse_sqs_launch_jobs(event)
+        for message_id, job in jobs:
+            run_launch_job(job)
+        processed = len(jobs)
+    else:
+        processed = len(process_launch_queue(get_launch_queue()))
+    
+    logger.info(f"[LAUNCH_WORKER] Processed {processed} launch job(s)")
+    return {"processed": processed}
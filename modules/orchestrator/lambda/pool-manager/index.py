@@ -6,25 +6,37 @@ Scheduled function that:
 2. Syncs instance pool state with actual EC2 instances
 3. Manages ASG scaling based on demand
 4. Releases orphaned instances
+5. Restarts stalled progression of provisioning sessions
 """
 
 import logging
 import os
 import sys
 
+from botocore.exceptions import ClientError
+
 # Add common layer to path
 sys.path.insert(0, "/opt/python")
 
 from utils import (
     AutoScalingClient,
+    CACHE_TABLE,
     DynamoDBClient,
     EC2Client,
+    GuacamoleActivitySnapshot,
     GuacamoleClient,
+    HEARTBEATS_TABLE,
+    HeartbeatStore,
     InstanceStatus,
+    POOL_CLAIM_CONDITION,
+    PROVISIONING_LEASE,
     SessionStatus,
     UsageTracker,
+    get_claim_tickets,
     get_current_timestamp,
     get_iso_timestamp,
+    get_launch_queue,
+    get_pooled_connection_id,
 )
 
 logger = logging.getLogger()
@@ -41,6 +53,11 @@ ENVIRONMENT = os.environ.get("ENVIRONMENT", "dev")
 ENABLE_IDLE_DETECTION = os.environ.get("ENABLE_IDLE_DETECTION", "true").lower() == "true"
 IDLE_HEARTBEAT_GRACE_PERIOD = int(os.environ.get("IDLE_HEARTBEAT_GRACE_PERIOD", "120"))  # 2 min grace
 
+# Provisioning sessions untouched for this long get a new progression chain
+STALLED_PROVISIONING_AFTER = int(os.environ.get("STALLED_PROVISIONING_AFTER", "60"))
+# Launch jobs queued for a PENDING session before it is given up as failed
+MAX_LAUNCH_ATTEMPTS = int(os.environ.get("MAX_LAUNCH_ATTEMPTS", "3"))
+
 # Guacamole configuration for activity checking
 GUACAMOLE_PRIVATE_IP = os.environ.get("GUACAMOLE_PRIVATE_IP", "")
 GUACAMOLE_PUBLIC_IP = os.environ.get("GUACAMOLE_PUBLIC_IP", "")
@@ -48,6 +65,13 @@ GUACAMOLE_API_URL = os.environ.get("GUACAMOLE_API_URL", "")
 GUACAMOLE_ADMIN_USER = os.environ.get("GUACAMOLE_ADMIN_USER", "guacadmin")
 GUACAMOLE_ADMIN_PASS = os.environ.get("GUACAMOLE_ADMIN_PASS", "guacadmin")
 
+# Pre-built Guacamole connections for AVAILABLE pool instances
+PREBUILD_GUACAMOLE_CONNECTIONS = os.environ.get("PREBUILD_GUACAMOLE_CONNECTIONS", "true").lower() == "true"
+MAX_CONNECTIONS_PREPARED_PER_RUN = int(os.environ.get("MAX_CONNECTIONS_PREPARED_PER_RUN", "10"))
+CONNECTION_PREPARE_LEASE_SECONDS = int(os.environ.get("CONNECTION_PREPARE_LEASE_SECONDS", "60"))
+RDP_USERNAME = os.environ.get("RDP_USERNAME", "kali")
+RDP_PASSWORD = os.environ.get("RDP_PASSWORD", "kali")
+
 # Tier-specific idle thresholds (seconds)
 IDLE_THRESHOLDS = {
     "freemium": {
@@ -82,6 +106,310 @@ def get_configured_asgs():
     return {plan: asg for plan, asg in PLAN_ASG_MAP.items() if asg}
 
 
+# Session statuses that still hold (or are waiting for) an instance
+ACTIVE_SESSION_STATUSES = [
+    SessionStatus.PENDING,
+    SessionStatus.PROVISIONING,
+    SessionStatus.READY,
+    SessionStatus.ACTIVE,
+]
+
+
+class ReconciliationSnapshot:
+    """
+    One in-memory view of live sessions and pool records for a pool-manager tick.
+    
+    Every phase reads from this snapshot instead of querying StatusIndex again,
+    and records its writes here. Writes are applied to the in-memory records
+    immediately (so later phases see them) and sent to DynamoDB once, as a
+    coalesced diff, by flush(). Read cost per tick is one paginated pool scan
+    plus one paginated StatusIndex query per active session status, no matter
+    how many plan tiers are managed.
+    
+    The diff is written item by item, each write conditional on the status
+    the item had when the snapshot was loaded, so a claim, launch or
+    termination that changed an item during the tick is never overwritten;
+    the next tick sees the change and reconciles it.
+    """
+    
+    def __init__(self, sessions_db, pool_db):
+        self.sessions_db = sessions_db
+        self.pool_db = pool_db
+        
+        self.sessions = {}  # session_id -> session item
+        self.pool = {}      # instance_id -> pool record
+        
+        # In-memory indexes
+        self.sessions_by_status = {}       # status -> {session_id}
+        self.sessions_by_instance = {}     # instance_id -> session_id
+        self.pool_by_plan_status = {}      # (plan, status) -> {instance_id}
+        
+        # Statuses as loaded, the conditions of the flushed writes
+        self.loaded_session_status = {}    # session_id -> status
+        self.loaded_pool_status = {}       # instance_id -> status
+        
+        # Pending writes (the diff)
+        self.session_updates = {}          # session_id -> merged updates
+        self.pool_updates = {}             # instance_id -> merged updates
+        self.pool_conditions = {}          # instance_id -> expected session_id
+        self.pool_puts = {}                # instance_id -> full item
+        self.pool_deletes = set()          # instance_ids
+        self.instance_tags = {}            # instance_id -> tags to apply after the pool write
+        
+        # Collected by the sync phase for the connection-prebuild phase
+        self.instance_states = {}          # instance_id -> EC2 describe result
+        self.retired_connections = []      # Guacamole connections of instances that left the ASG
+    
+    def load(self) -> None:
+        """Load the snapshot. Raises on DynamoDB errors so a tick never runs on partial data."""
+        # Read the pool first: any assignment it shows belongs to a session that already
+        # exists when sessions are read below, so it cannot be mistaken for an orphan.
+        for record in self.pool_db.scan_all(strict=True):
+            self.pool[record["instance_id"]] = record
+            self.loaded_pool_status[record["instance_id"]] = record.get("status")
+            self._index_pool(record)
+        
+        for status in ACTIVE_SESSION_STATUSES:
+            for session in self.sessions_db.query_all_by_index("StatusIndex", "status", status, strict=True):
+                self.sessions[session["session_id"]] = session
+                self.loaded_session_status[session["session_id"]] = session.get("status")
+                self._index_session(session)
+        
+        logger.info(f"Loaded snapshot: {len(self.sessions)} live session(s), {len(self.pool)} pool record(s)")
+    
+    # -------------------------------------------------------------------------
+    # Indexes
+    # -------------------------------------------------------------------------
+    
+    def _index_session(self, session: dict) -> None:
+        self.sessions_by_status.setdefault(session.get("status"), set()).add(session["session_id"])
+        if session.get("instance_id"):
+            self.sessions_by_instance[session["instance_id"]] = session["session_id"]
+    
+    def _unindex_session(self, session: dict) -> None:
+        self.sessions_by_status.get(session.get("status"), set()).discard(session["session_id"])
+        if self.sessions_by_instance.get(session.get("instance_id")) == session["session_id"]:
+            del self.sessions_by_instance[session["instance_id"]]
+    
+    def _index_pool(self, record: dict) -> None:
+        # Default to "pro" for backward compatibility with records created before tiers
+        key = (record.get("plan", "pro"), record.get("status"))
+        self.pool_by_plan_status.setdefault(key, set()).add(record["instance_id"])
+    
+    def _unindex_pool(self, record: dict) -> None:
+        key = (record.get("plan", "pro"), record.get("status"))
+        self.pool_by_plan_status.get(key, set()).discard(record["instance_id"])
+    
+    # -------------------------------------------------------------------------
+    # Reads
+    # -------------------------------------------------------------------------
+    
+    def get_session(self, session_id: str):
+        """Return a live session, or None if it is terminated, errored or missing."""
+        session = self.sessions.get(session_id)
+        if session and session.get("status") in ACTIVE_SESSION_STATUSES:
+            return session
+        return None
+    
+    def sessions_with_status(self, statuses, plan: str = None) -> list:
+        """Return live sessions in any of the given statuses, optionally for one plan."""
+        result = []
+        for status in statuses:
+            for session_id in self.sessions_by_status.get(status, ()):
+                session = self.sessions[session_id]
+                if plan is None or session.get("plan", "pro") == plan:
+                    result.append(session)
+        return result
+    
+    def pool_records(self, plan: str = None, statuses=None) -> list:
+        """Return pool records, optionally filtered by plan and statuses."""
+        result = []
+        for (record_plan, status), instance_ids in self.pool_by_plan_status.items():
+            if plan is not None and record_plan != plan:
+                continue
+            if statuses is not None and status not in statuses:
+                continue
+            result.extend(self.pool[iid] for iid in instance_ids)
+        return result
+    
+    def count_pool(self, plan: str, status: str) -> int:
+        return len(self.pool_by_plan_status.get((plan, status), ()))
+    
+    # -------------------------------------------------------------------------
+    # Writes (recorded into the diff)
+    # -------------------------------------------------------------------------
+    
+    def update_session(self, session_id: str, updates: dict) -> None:
+        session = self.sessions.get(session_id)
+        if session is not None:
+            self._unindex_session(session)
+            session.update(updates)
+            self._index_session(session)
+        self.session_updates.setdefault(session_id, {}).update(updates)
+    
+    def update_pool(self, instance_id: str, updates: dict, expected_session_id: str = None) -> None:
+        """
+        Record a pool record update.
+        
+        If expected_session_id is given, the write only applies if the instance is
+        still assigned to that session when the diff is flushed.
+        """
+        record = self.pool.get(instance_id)
+        if record is not None:
+            self._unindex_pool(record)
+            record.update(updates)
+            self._index_pool(record)
+        
+        if instance_id in self.pool_puts:
+            self.pool_puts[instance_id].update(updates)
+            return
+        self.pool_updates.setdefault(instance_id, {}).update(updates)
+        if expected_session_id:
+            self.pool_conditions.setdefault(instance_id, expected_session_id)
+    
+    def put_pool(self, item: dict) -> None:
+        instance_id = item["instance_id"]
+        old = self.pool.get(instance_id)
+        if old is not None:
+            self._unindex_pool(old)
+        self.pool[instance_id] = dict(item)
+        self._index_pool(self.pool[instance_id])
+        
+        self.pool_puts[instance_id] = dict(item)
+        self.pool_updates.pop(instance_id, None)
+        self.pool_conditions.pop(instance_id, None)
+        self.pool_deletes.discard(instance_id)
+    
+    def delete_pool(self, instance_id: str) -> None:
+        record = self.pool.pop(instance_id, None)
+        if record is not None:
+            self._unindex_pool(record)
+        
+        self.pool_deletes.add(instance_id)
+        self.pool_puts.pop(instance_id, None)
+        self.pool_updates.pop(instance_id, None)
+        self.pool_conditions.pop(instance_id, None)
+        self.instance_tags.pop(instance_id, None)
+    
+    def tag_instance(self, instance_id: str, tags: dict) -> None:
+        self.instance_tags.setdefault(instance_id, {}).update(tags)
+    
+    def release_instance(self, instance_id: str, session_id: str, now: int, extra_tags: dict = None) -> None:
+        """Return an instance to the pool and clear its session tags."""
+        self.update_pool(
+            instance_id,
+            {
+                "status": InstanceStatus.AVAILABLE,
+                "session_id": None,
+                "student_id": None,
+                "released_at": now,
+            },
+            expected_session_id=session_id,
+        )
+        tags = {
+            "SessionId": "",
+            "StudentId": "",
+            "ReleasedAt": get_iso_timestamp(),
+        }
+        tags.update(extra_tags or {})
+        self.tag_instance(instance_id, tags)
+    
+    @staticmethod
+    def _status_condition(loaded: dict, key_name: str, item_id: str):
+        """Return (condition, names, values) requiring the status seen at load, or just that the item exists."""
+        names = {"#status": "status"}
+        if item_id not in loaded:
+            return f"attribute_exists({key_name})", None, None
+        if loaded[item_id] is None:
+            return "attribute_not_exists(#status)", names, None
+        return "#status = :loaded_status", names, {":loaded_status": loaded[item_id]}
+    
+    def flush(self, ec2_client) -> dict:
+        """Send the accumulated diff to DynamoDB and EC2. Returns write counts."""
+        stats = {
+            "session_updates": 0,
+            "session_updates_skipped": 0,
+            "pool_updates": 0,
+            "pool_writes_skipped": 0,
+            "pool_puts": 0,
+            "pool_deletes": 0,
+            "instances_tagged": 0,
+        }
+        
+        skipped_sessions = set()
+        for session_id, updates in self.session_updates.items():
+            condition, names, values = self._status_condition(self.loaded_session_status, "session_id", session_id)
+            if self.sessions_db.conditional_update(
+                {"session_id": session_id}, updates, condition,
+                expression_attribute_names=names,
+                expression_attribute_values=values,
+            ):
+                stats["session_updates"] += 1
+            else:
+                skipped_sessions.add(session_id)
+                stats["session_updates_skipped"] += 1
+        
+        skipped = set()
+        for instance_id, item in self.pool_puts.items():
+            if instance_id in self.loaded_pool_status:
+                # An existing record is updated in place rather than replaced
+                updates = {k: v for k, v in item.items() if k != "instance_id"}
+                self.pool_updates[instance_id] = updates
+                continue
+            if self.pool_db.conditional_put(item, "attribute_not_exists(instance_id)"):
+                stats["pool_puts"] += 1
+            else:
+                skipped.add(instance_id)
+                stats["pool_writes_skipped"] += 1
+        
+        for instance_id in self.pool_deletes:
+            condition, names, values = self._status_condition(self.loaded_pool_status, "instance_id", instance_id)
+            if self.pool_db.conditional_delete(
+                {"instance_id": instance_id}, condition,
+                expression_attribute_names=names,
+                expression_attribute_values=values,
+            ):
+                stats["pool_deletes"] += 1
+            else:
+                stats["pool_writes_skipped"] += 1
+        
+        for instance_id, updates in self.pool_updates.items():
+            expected_session_id = self.pool_conditions.get(instance_id)
+            if expected_session_id in skipped_sessions:
+                # The session changed since the snapshot; leave its instance to the next tick
+                applied = False
+            else:
+                condition, names, values = self._status_condition(self.loaded_pool_status, "instance_id", instance_id)
+                names, values = dict(names or {}), dict(values or {})
+                if expected_session_id:
+                    # Don't clobber an instance that was re-assigned since the snapshot was read
+                    condition = f"({condition}) AND #session_id = :expected_session"
+                    names["#session_id"] = "session_id"
+                    values[":expected_session"] = expected_session_id
+                applied = self.pool_db.conditional_update(
+                    {"instance_id": instance_id},
+                    updates,
+                    condition_expression=condition,
+                    expression_attribute_names=names or None,
+                    expression_attribute_values=values or None,
+                )
+            
+            if applied:
+                stats["pool_updates"] += 1
+            else:
+                skipped.add(instance_id)
+                stats["pool_writes_skipped"] += 1
+        
+        for instance_id, tags in self.instance_tags.items():
+            if instance_id in skipped:
+                continue
+            if ec2_client.tag_instance(instance_id, tags):
+                stats["instances_tagged"] += 1
+        
+        logger.info(f"Flushed reconciliation diff: {stats}")
+        return stats
+
+
 def handler(event, context):
     """
     Main handler for pool manager.
@@ -104,6 +432,10 @@ def handler(event, context):
         configured_asgs = get_configured_asgs()
         logger.info(f"Managing pools: {list(configured_asgs.keys())}")
         
+        # Load one snapshot of sessions and pool records for the whole tick
+        snapshot = ReconciliationSnapshot(sessions_db, pool_db)
+        snapshot.load()
+        
         results = {
             "expired_sessions_cleaned": 0,
             "orphaned_instances_released": 0,
@@ -114,35 +446,61 @@ def handler(event, context):
         }
         
         # 1. Clean up expired sessions (applies to all plans)
-        results["expired_sessions_cleaned"] = cleanup_expired_sessions(
-            sessions_db, pool_db, ec2_client, now
-        )
+        results["expired_sessions_cleaned"] = cleanup_expired_sessions(snapshot, now)
+        
+        # 1.25. Fetch Guacamole activity once and publish it for heartbeats
+        guac_activity, results["guacamole_activity_published"] = refresh_guacamole_activity(snapshot, now)
         
         # 1.5. Check for idle sessions and handle warnings/termination
         if ENABLE_IDLE_DETECTION:
-            idle_results = check_idle_sessions(sessions_db, pool_db, ec2_client, now)
+            idle_results = check_idle_sessions(snapshot, now, guac_activity)
             results["idle_sessions_warned"] = idle_results.get("warned", 0)
             results["idle_sessions_terminated"] = idle_results.get("terminated", 0)
         
-        # 2. Sync instance pool with ASGs (for each tier)
+        # 2. Make sure every pool record is visible on PlanStatusIndex
+        results["pool_records_backfilled"] = backfill_pool_plans(snapshot, now)
+        
+        # 2.5. Sync instance pool with ASGs (for each tier)
         for plan, asg_name in configured_asgs.items():
             synced = sync_instance_pool_for_plan(
-                pool_db, ec2_client, asg_client, now, plan, asg_name
+                snapshot, ec2_client, asg_client, now, plan, asg_name
             )
             results["pools_synced"][plan] = synced
         
         # 3. Release orphaned instances (applies to all plans)
-        results["orphaned_instances_released"] = release_orphaned_instances(
-            sessions_db, pool_db, ec2_client, now
-        )
+        results["orphaned_instances_released"] = release_orphaned_instances(snapshot, now)
         
         # 4. Check if we need to scale (for each tier)
         for plan, asg_name in configured_asgs.items():
-            action = manage_scaling_for_plan(
-                sessions_db, pool_db, asg_client, plan, asg_name
-            )
+            action = manage_scaling_for_plan(snapshot, asg_client, plan, asg_name)
             results["scaling_actions"][plan] = action
         
+        # 4.5. Find provisioning sessions whose progression chain has stalled,
+        # and pending sessions whose launch job was lost or whose worker died
+        stalled_sessions = restart_stalled_provisioning(snapshot, now)
+        stalled_launches = find_stalled_launches(snapshot, now)
+        
+        # 5. Write the accumulated diff
+        results["writes"] = snapshot.flush(ec2_client)
+        
+        # 5.5. Queue their progression passes now that the new chains are written
+        results["provisioning_requeued"] = sum(
+            get_launch_queue().send({"action": "advance", "session_id": session_id, "attempt": 0, "chain": now})
+            for session_id in stalled_sessions
+        ) + sum(
+            get_launch_queue().send({"session_id": session_id, "enqueued_at": now})
+            for session_id in stalled_launches
+        )
+        
+        # 5.75. Issue claim tickets for AVAILABLE instances that have none outstanding
+        claim_tickets = get_claim_tickets()
+        if claim_tickets:
+            results["claim_tickets_issued"] = issue_claim_tickets(snapshot, pool_db, claim_tickets, now)
+        
+        # 6. Pre-build Guacamole connections for healthy AVAILABLE instances
+        if PREBUILD_GUACAMOLE_CONNECTIONS:
+            results["guacamole_connections"] = prepare_pool_connections(snapshot, pool_db, now)
+        
         logger.info(f"Pool manager completed: {results}")
         
         return {
@@ -158,76 +516,166 @@ def handler(event, context):
         }
 
 
-def cleanup_expired_sessions(sessions_db, pool_db, ec2_client, now: int) -> int:
+def cleanup_expired_sessions(snapshot: ReconciliationSnapshot, now: int) -> int:
     """Clean up sessions that have expired."""
     cleaned = 0
     usage_tracker = UsageTracker(USAGE_TABLE) if USAGE_TABLE else None
     
-    # Query active sessions and check expiry
-    # Note: In production, you'd want a GSI on status or use DynamoDB Streams
-    for status in [SessionStatus.PENDING, SessionStatus.PROVISIONING, 
-                   SessionStatus.READY, SessionStatus.ACTIVE]:
-        sessions = sessions_db.query_by_index("StatusIndex", "status", status)
+    for session in snapshot.sessions_with_status(ACTIVE_SESSION_STATUSES):
+        expires_at = session.get("expires_at", 0)
         
-        for session in sessions:
-            expires_at = session.get("expires_at", 0)
+        if expires_at and now > expires_at:
+            session_id = session["session_id"]
+            instance_id = session.get("instance_id")
+            student_id = session.get("student_id")
+            created_at = session.get("created_at", now)
             
-            if expires_at and now > expires_at:
-                session_id = session["session_id"]
-                instance_id = session.get("instance_id")
-                student_id = session.get("student_id")
-                created_at = session.get("created_at", now)
-                
-                logger.info(f"Cleaning up expired session: {session_id}")
-                
-                # Track usage before terminating
-                if usage_tracker and student_id:
-                    duration_minutes = (now - created_at) / 60
-                    if duration_minutes >= 0.5:  # At least 30 seconds
-                        try:
-                            usage_tracker.record_usage(
-                                user_id=student_id,
-                                minutes=int(duration_minutes)
-                            )
-                            logger.info(f"Recorded {int(duration_minutes)} minutes for expired session {session_id}")
-                        except Exception as e:
-                            logger.error(f"Failed to record usage for expired session: {e}")
-                
-                # Update session status
-                sessions_db.update_item(
-                    {"session_id": session_id},
-                    {
-                        "status": SessionStatus.TERMINATED,
-                        "termination_reason": "expired",
-                        "terminated_at": now,
-                        "updated_at": now,
-                    }
-                )
-                
-                # Release instance
-                if instance_id:
-                    pool_db.update_item(
-                        {"instance_id": instance_id},
-                        {
-                            "status": InstanceStatus.AVAILABLE,
-                            "session_id": None,
-                            "student_id": None,
-                            "released_at": now,
-                        }
-                    )
-                    
-                    # Clear instance tags
-                    ec2_client.tag_instance(instance_id, {
-                        "SessionId": "",
-                        "StudentId": "",
-                        "ReleasedAt": get_iso_timestamp(),
-                    })
-                
-                cleaned += 1
+            logger.info(f"Cleaning up expired session: {session_id}")
+            
+            # Track usage before terminating
+            if usage_tracker and student_id:
+                duration_minutes = (now - created_at) / 60
+                if duration_minutes >= 0.5:  # At least 30 seconds
+                    try:
+                        usage_tracker.record_usage(
+                            user_id=student_id,
+                            minutes=int(duration_minutes)
+                        )
+                        logger.info(f"Recorded {int(duration_minutes)} minutes for expired session {session_id}")
+                    except Exception as e:
+                        logger.error(f"Failed to record usage for expired session: {e}")
+            
+            # Update session status
+            snapshot.update_session(
+                session_id,
+                {
+                    "status": SessionStatus.TERMINATED,
+                    "termination_reason": "expired",
+                    "terminated_at": now,
+                    "updated_at": now,
+                }
+            )
+            
+            # Release instance and clear its tags
+            if instance_id:
+                snapshot.release_instance(instance_id, session_id, now)
+            
+            cleaned += 1
     
     return cleaned
 
 
+def restart_stalled_provisioning(snapshot: ReconciliationSnapshot, now: int) -> list:
+    """
+    Start a new progression chain for PROVISIONING sessions that stopped moving.
+    
+    The provisioning worker advances these sessions with delayed launch jobs;
+    if one is lost, nothing else would. Recording advance_chain replaces any
+    chain still running, so a session never has two. Returns the session IDs
+    to queue a pass for once the snapshot is flushed.
+    """
+    stalled = []
+    for session in snapshot.sessions_with_status([SessionStatus.PROVISIONING]):
+        last_progress = max(int(session.get("updated_at", 0)), int(session.get("advance_chain") or 0))
+        if now - last_progress > STALLED_PROVISIONING_AFTER:
+            snapshot.update_session(session["session_id"], {"advance_chain": now})
+            stalled.append(session["session_id"])
+    
+    if stalled:
+        logger.info(f"[ALLOCATOR] Restarting progression for {len(stalled)} stalled session(s)")
+    return stalled
+
+
+def find_stalled_launches(snapshot: ReconciliationSnapshot, now: int) -> list:
+    """
+    Find PENDING sessions that no worker is provisioning.
+    
+    A worker claims a PENDING session by setting provisioning_started_at; if it
+    crashes or times out the session stays PENDING with an old claim, and a job
+    that went to the dead-letter queue leaves no claim at all. Either way the
+    claim (or the session, or the last re-queued job) is older than
+    PROVISIONING_LEASE, so a new launch job takes over. Takeovers are counted
+    in launch_attempts; a session that still hasn't launched after
+    MAX_LAUNCH_ATTEMPTS of them is marked ERROR and its instance released.
+    Returns the session IDs to queue a job for.
+    """
+    stalled = []
+    failed = 0
+    for session in snapshot.sessions_with_status([SessionStatus.PENDING]):
+        last_claim = max(
+            int(session.get("provisioning_started_at") or 0),
+            int(session.get("launch_requeued_at") or 0),
+            int(session.get("created_at") or now),
+        )
+        if now - last_claim <= PROVISIONING_LEASE:
+            continue
+        
+        session_id = session["session_id"]
+        attempts = int(session.get("launch_attempts") or 0) + 1
+        if attempts > MAX_LAUNCH_ATTEMPTS:
+            logger.warning(f"[ALLOCATOR] Session {session_id} did not launch after {MAX_LAUNCH_ATTEMPTS} re-queued job(s)")
+            snapshot.update_session(
+                session_id,
+                {
+                    "status": SessionStatus.ERROR,
+                    "error": "Launch did not complete",
+                    "termination_reason": "launch_failed",
+                    "terminated_at": now,
+                    "updated_at": now,
+                }
+            )
+            if session.get("instance_id"):
+                snapshot.release_instance(session["instance_id"], session_id, now)
+            failed += 1
+            continue
+        
+        snapshot.update_session(session_id, {"launch_attempts": attempts, "launch_requeued_at": now})
+        stalled.append(session_id)
+    
+    if stalled:
+        logger.info(f"[ALLOCATOR] Re-queueing launch jobs for {len(stalled)} stalled pending session(s)")
+    if failed:
+        logger.info(f"[ALLOCATOR] Gave up on {failed} pending session(s)")
+    return stalled
+
+
+def issue_claim_tickets(snapshot: ReconciliationSnapshot, pool_db, claim_tickets, now: int) -> int:
+    """
+    Issue a claim ticket for every claimable AVAILABLE instance without an outstanding one.
+    
+    A pool record's claim_ticket is outstanding while it is above its plan's
+    claimed counter. Taken tickets whose claim failed (the instance was still
+    preparing, or claimed through the index) are simply reissued here.
+    """
+    issued = 0
+    claimed_by_plan = {}
+    for record in snapshot.pool_records(statuses=[InstanceStatus.AVAILABLE]):
+        if int(record.get("preparing_until", 0)) >= now:
+            continue
+        plan = record.get("plan", "pro")
+        if plan not in claimed_by_plan:
+            claimed_by_plan[plan] = claim_tickets.counters(plan)["claimed"]
+        if int(record.get("claim_ticket", 0)) > claimed_by_plan[plan]:
+            continue
+        
+        seq = claim_tickets.issue(plan, record["instance_id"], now)
+        if seq:
+            # Only while the record still exists and is AVAILABLE: a claim or deletion
+            # during this tick must not be overwritten (the ticket then just goes stale)
+            pool_db.conditional_update(
+                {"instance_id": record["instance_id"]},
+                {"claim_ticket": seq},
+                condition_expression="attribute_exists(instance_id) AND #status = :available",
+                expression_attribute_names={"#status": "status"},
+                expression_attribute_values={":available": InstanceStatus.AVAILABLE},
+            )
+            issued += 1
+    
+    if issued:
+        logger.info(f"[CLAIM_TICKETS] Issued {issued} claim ticket(s)")
+    return issued
+
+
 def get_guacamole_internal_url() -> str:
     """Get the internal Guacamole URL for API calls."""
     if GUACAMOLE_API_URL:
@@ -239,9 +687,143 @@ def get_guacamole_internal_url() -> str:
     return ""
 
 
-def check_guacamole_activity_for_sessions(sessions: list) -> dict:
+def prepare_pool_connections(snapshot: ReconciliationSnapshot, pool_db, now: int) -> dict:
     """
-    Check Guacamole for active connections across multiple sessions.
+    Keep a ready-to-use Guacamole connection on every healthy AVAILABLE pool record.
+    
+    create-session then only attaches a session user at claim time, which takes
+    connection lookup, stale-connection purging and connection creation off the
+    launch path. Connections of released instances are recycled here (tunnels
+    killed, previous session user removed) rather than deleted.
+    
+    Each instance is held under a short preparing_until lease while Guacamole is
+    being changed, so it cannot be claimed halfway through.
+    """
+    results = {"created": 0, "recycled": 0, "retired": 0, "failed": 0}
+    
+    candidates = []
+    for record in snapshot.pool_records(statuses=[InstanceStatus.AVAILABLE]):
+        instance_info = snapshot.instance_states.get(record["instance_id"])
+        if not instance_info or instance_info.get("State", {}).get("Name") != "running":
+            continue
+        instance_ip = instance_info.get("PrivateIpAddress")
+        if not instance_ip:
+            continue
+        candidates.append((record, instance_ip))
+    
+    if not candidates and not snapshot.retired_connections:
+        return results
+    
+    internal_url = get_guacamole_internal_url()
+    if not internal_url:
+        logger.warning("Guacamole URL not configured, skipping connection prebuild")
+        return results
+    
+    try:
+        guac = GuacamoleClient(
+            base_url=internal_url,
+            username=GUACAMOLE_ADMIN_USER,
+            password=GUACAMOLE_ADMIN_PASS,
+        )
+        
+        for connection_id in snapshot.retired_connections:
+            guac.kill_active_sessions(connection_id)
+            if guac.delete_connection(connection_id):
+                results["retired"] += 1
+        
+        if not candidates:
+            return results
+        
+        # One listing for every instance handled this run
+        connections_by_ip = guac.list_connections_by_hostname(strict=True)
+    except Exception as e:
+        logger.warning(f"Error preparing Guacamole connections: {e}")
+        return results
+    
+    pending = []
+    for record, instance_ip in candidates:
+        # A recorded connection that no longer exists in Guacamole (e.g. removed by a
+        # launch's fallback) is rebuilt rather than trusted
+        connection_id = get_pooled_connection_id(record, instance_ip)
+        if connection_id not in connections_by_ip.get(instance_ip, []):
+            connection_id = None
+        if connection_id and not record.get("guacamole_session_user"):
+            continue  # Already ready for the next claim
+        pending.append((record, instance_ip, connection_id))
+    
+    for record, instance_ip, connection_id in pending[:MAX_CONNECTIONS_PREPARED_PER_RUN]:
+        instance_id = record["instance_id"]
+        previous_user = record.get("guacamole_session_user")
+        
+        # Take the lease - fails if the instance was claimed since the snapshot was read
+        leased = pool_db.conditional_update(
+            {"instance_id": instance_id},
+            {"preparing_until": now + CONNECTION_PREPARE_LEASE_SECONDS},
+            condition_expression=POOL_CLAIM_CONDITION,
+            expression_attribute_names={"#status": "status"},
+            expression_attribute_values={":available": InstanceStatus.AVAILABLE, ":now": now},
+        )
+        if not leased:
+            continue
+        
+        updates = {"preparing_until": 0}
+        try:
+            # Connections to this address other than the pooled one are left over from
+            # earlier sessions; they must not keep access to the next student's instance
+            for stale_id in connections_by_ip.get(instance_ip, []):
+                if stale_id != connection_id:
+                    guac.kill_active_sessions(stale_id)
+                    guac.delete_connection(stale_id)
+            
+            if connection_id:
+                guac.recycle_connection(connection_id, previous_user)
+                logger.info(f"[GUACAMOLE_POOL] Recycled connection {connection_id} for {instance_id}")
+                results["recycled"] += 1
+            else:
+                if previous_user:
+                    guac.delete_user(previous_user)
+                
+                connection_id = guac.create_rdp_connection(
+                    name=f"AttackBox Pool - {record.get('plan', 'pro')} - {instance_id}",
+                    hostname=instance_ip,
+                    port=3389,
+                    username=RDP_USERNAME,
+                    password=RDP_PASSWORD,
+                    security="any",
+                    ignore_cert=True,
+                )
+                if not connection_id:
+                    results["failed"] += 1
+                    continue
+                
+                updates.update({
+                    "guacamole_connection_id": connection_id,
+                    "guacamole_connection_ip": instance_ip,
+                    "connection_prepared_at": now,
+                })
+                logger.info(f"[GUACAMOLE_POOL] Pre-built connection {connection_id} for {instance_id} ({instance_ip})")
+                results["created"] += 1
+            
+            updates["guacamole_session_user"] = None
+        
+        except Exception as e:
+            logger.warning(f"Error preparing Guacamole connection for {instance_id}: {e}")
+            results["failed"] += 1
+        
+        finally:
+            # Always release the lease, unless the record was removed meanwhile
+            pool_db.conditional_update(
+                {"instance_id": instance_id},
+                updates,
+                condition_expression="attribute_exists(instance_id)",
+            )
+    
+    return results
+
+
+def check_guacamole_activity_for_sessions() -> dict:
+    """
+    Check Guacamole for active connections across all sessions.
     Returns a dict mapping connection_id to activity info.
     """
     internal_url = get_guacamole_internal_url()
@@ -264,13 +846,32 @@ def check_guacamole_activity_for_sessions(sessions: list) -> dict:
         return {}
 
 
-def check_idle_sessions(sessions_db, pool_db, ec2_client, now: int) -> dict:
+def refresh_guacamole_activity(snapshot: ReconciliationSnapshot, now: int):
+    """
+    Fetch activeConnections once for the tick and publish a per-connection
+    activity record for session-heartbeat to read.
+    
+    Returns (activity by connection id, records published).
+    """
+    if not snapshot.sessions_with_status([SessionStatus.READY, SessionStatus.ACTIVE]):
+        return {}, 0
+    
+    guac_activity = check_guacamole_activity_for_sessions()
+    if not guac_activity or not CACHE_TABLE:
+        return guac_activity, 0
+    
+    published = GuacamoleActivitySnapshot(CACHE_TABLE).publish(guac_activity, now)
+    logger.info(f"[GUACAMOLE_ACTIVITY] Published activity for {published} connection(s)")
+    return guac_activity, published
+
+
+def check_idle_sessions(snapshot: ReconciliationSnapshot, now: int, guac_activity: dict) -> dict:
     """
     Check for idle sessions and handle warnings/termination.
     
     This function:
-    1. Queries active sessions
-    2. Checks Guacamole for actual connection activity
+    1. Reads active sessions from the snapshot
+    2. Checks the tick's Guacamole connection activity
     3. Compares last_active_at with thresholds
     4. Updates sessions that are idle
     5. Terminates sessions that exceed termination threshold
@@ -281,26 +882,26 @@ def check_idle_sessions(sessions_db, pool_db, ec2_client, now: int) -> dict:
     usage_tracker = UsageTracker(USAGE_TABLE) if USAGE_TABLE else None
     
     # Get all active sessions
-    active_sessions = []
-    for status in [SessionStatus.READY, SessionStatus.ACTIVE]:
-        sessions = sessions_db.query_by_index("StatusIndex", "status", status)
-        active_sessions.extend(sessions)
+    active_sessions = snapshot.sessions_with_status([SessionStatus.READY, SessionStatus.ACTIVE])
     
     if not active_sessions:
         return results
     
     logger.info(f"Checking {len(active_sessions)} sessions for idle status")
     
-    # Get Guacamole activity for all connections at once
-    guac_activity = check_guacamole_activity_for_sessions(active_sessions)
+    # Latest heartbeats live in their own table, read in one batch
+    heartbeats = {}
+    if HEARTBEATS_TABLE:
+        heartbeats = HeartbeatStore(HEARTBEATS_TABLE).get_many([s["session_id"] for s in active_sessions])
     
     for session in active_sessions:
         session_id = session["session_id"]
         student_id = session.get("student_id")
         instance_id = session.get("instance_id")
         created_at = session.get("created_at", now)
-        last_active_at = session.get("last_active_at", created_at)
-        last_heartbeat_at = session.get("last_heartbeat_at", 0)
+        heartbeat = heartbeats.get(session_id, {})
+        last_active_at = max(session.get("last_active_at", created_at), heartbeat.get("last_active_at", 0))
+        last_heartbeat_at = max(session.get("last_heartbeat_at", 0), heartbeat.get("last_heartbeat_at", 0))
         idle_warning_sent_at = session.get("idle_warning_sent_at")
         focus_mode = session.get("focus_mode", False)
         plan = session.get("plan", "freemium")
@@ -371,8 +972,8 @@ def check_idle_sessions(sessions_db, pool_db, ec2_client, now: int) -> dict:
                         logger.error(f"Failed to record usage: {e}")
             
             # Update session status
-            sessions_db.update_item(
-                {"session_id": session_id},
+            snapshot.update_session(
+                session_id,
                 {
                     "status": SessionStatus.TERMINATED,
                     "termination_reason": "idle_timeout",
@@ -384,22 +985,10 @@ def check_idle_sessions(sessions_db, pool_db, ec2_client, now: int) -> dict:
             
             # Release instance back to pool
             if instance_id:
-                pool_db.update_item(
-                    {"instance_id": instance_id},
-                    {
-                        "status": InstanceStatus.AVAILABLE,
-                        "session_id": None,
-                        "student_id": None,
-                        "released_at": now,
-                    }
+                snapshot.release_instance(
+                    instance_id, session_id, now,
+                    extra_tags={"TerminationReason": "idle_timeout"},
                 )
-                
-                ec2_client.tag_instance(instance_id, {
-                    "SessionId": "",
-                    "StudentId": "",
-                    "ReleasedAt": get_iso_timestamp(),
-                    "TerminationReason": "idle_timeout",
-                })
             
             results["terminated"] += 1
             
@@ -408,8 +997,8 @@ def check_idle_sessions(sessions_db, pool_db, ec2_client, now: int) -> dict:
             if not idle_warning_sent_at:
                 logger.info(f"Session {session_id} entering idle warning state (idle for {idle_seconds}s)")
                 
-                sessions_db.update_item(
-                    {"session_id": session_id},
+                snapshot.update_session(
+                    session_id,
                     {
                         "idle_warning_sent_at": now,
                         "idle_seconds": idle_seconds,
@@ -423,8 +1012,8 @@ def check_idle_sessions(sessions_db, pool_db, ec2_client, now: int) -> dict:
         elif idle_warning_sent_at and idle_seconds < warning_threshold:
             logger.info(f"Session {session_id} became active, clearing idle warning")
             
-            sessions_db.update_item(
-                {"session_id": session_id},
+            snapshot.update_session(
+                session_id,
                 {
                     "idle_warning_sent_at": None,
                     "last_active_at": effective_last_active,
@@ -435,7 +1024,27 @@ def check_idle_sessions(sessions_db, pool_db, ec2_client, now: int) -> dict:
     return results
 
 
-def sync_instance_pool_for_plan(pool_db, ec2_client, asg_client, now: int, plan: str, asg_name: str) -> bool:
+def backfill_pool_plans(snapshot: ReconciliationSnapshot, now: int) -> int:
+    """
+    Set plan="pro" on pool records created before tiers existed.
+    
+    PlanStatusIndex is sparse, so records without a plan attribute would be
+    invisible to the tier-scoped lookups in create-session and get-session-status.
+    """
+    backfilled = 0
+    
+    for record in snapshot.pool_records(plan="pro"):
+        if "plan" not in record:
+            snapshot.update_pool(record["instance_id"], {"plan": "pro", "updated_at": now})
+            backfilled += 1
+    
+    if backfilled:
+        logger.info(f"Backfilled plan on {backfilled} legacy pool record(s)")
+    
+    return backfilled
+
+
+def sync_instance_pool_for_plan(snapshot: ReconciliationSnapshot, ec2_client, asg_client, now: int, plan: str, asg_name: str) -> bool:
     """Sync the instance pool table with actual ASG instances for a specific plan."""
     try:
         logger.info(f"Syncing pool for plan '{plan}' with ASG '{asg_name}'")
@@ -445,15 +1054,17 @@ def sync_instance_pool_for_plan(pool_db, ec2_client, asg_client, now: int, plan:
         asg_instance_ids = {inst["InstanceId"] for inst in asg_instances}
         
         # Get current pool records for this plan
-        all_pool_records = []
-        for status in [InstanceStatus.AVAILABLE, InstanceStatus.ASSIGNED, InstanceStatus.STARTING]:
-            records = pool_db.query_by_index("StatusIndex", "status", status)
-            # Filter by plan (default to "pro" for backward compatibility)
-            plan_records = [r for r in records if r.get("plan", "pro") == plan]
-            all_pool_records.extend(plan_records)
+        all_pool_records = snapshot.pool_records(
+            plan=plan,
+            statuses=[InstanceStatus.AVAILABLE, InstanceStatus.ASSIGNED, InstanceStatus.STARTING],
+        )
         
         pool_instance_ids = {rec["instance_id"] for rec in all_pool_records}
         
+        # Resolve state for every ASG instance in one batched EC2 call
+        instance_states = ec2_client.get_instances_status(asg_instance_ids, include_health=False)
+        snapshot.instance_states.update(instance_states)
+        
         # Add new instances to pool
         for asg_instance in asg_instances:
             instance_id = asg_instance["InstanceId"]
@@ -461,7 +1072,7 @@ def sync_instance_pool_for_plan(pool_db, ec2_client, asg_client, now: int, plan:
             
             if instance_id not in pool_instance_ids and lifecycle_state == "InService":
                 # Get instance details
-                instance_info = ec2_client.get_instance_status(instance_id)
+                instance_info = instance_states.get(instance_id)
                 if instance_info:
                     state = instance_info.get("State", {}).get("Name")
                     
@@ -473,7 +1084,7 @@ def sync_instance_pool_for_plan(pool_db, ec2_client, asg_client, now: int, plan:
                     elif state == "running":
                         pool_status = InstanceStatus.AVAILABLE
                     
-                    pool_db.put_item({
+                    snapshot.put_pool({
                         "instance_id": instance_id,
                         "status": pool_status,
                         "plan": plan,  # Store plan tier
@@ -487,14 +1098,16 @@ def sync_instance_pool_for_plan(pool_db, ec2_client, asg_client, now: int, plan:
         for pool_record in all_pool_records:
             instance_id = pool_record["instance_id"]
             if instance_id not in asg_instance_ids:
-                pool_db.delete_item({"instance_id": instance_id})
+                if pool_record.get("guacamole_connection_id"):
+                    snapshot.retired_connections.append(pool_record["guacamole_connection_id"])
+                snapshot.delete_pool(instance_id)
                 logger.info(f"Removed instance from {plan} pool: {instance_id}")
         
         # Update instance states
         for pool_record in all_pool_records:
             instance_id = pool_record["instance_id"]
             if instance_id in asg_instance_ids:
-                instance_info = ec2_client.get_instance_status(instance_id)
+                instance_info = instance_states.get(instance_id)
                 if instance_info:
                     state = instance_info.get("State", {}).get("Name")
                     current_status = pool_record.get("status")
@@ -507,8 +1120,8 @@ def sync_instance_pool_for_plan(pool_db, ec2_client, asg_client, now: int, plan:
                         new_status = InstanceStatus.AVAILABLE
                     
                     if new_status != current_status:
-                        pool_db.update_item(
-                            {"instance_id": instance_id},
+                        snapshot.update_pool(
+                            instance_id,
                             {
                                 "status": new_status,
                                 "instance_state": state,
@@ -523,12 +1136,24 @@ def sync_instance_pool_for_plan(pool_db, ec2_client, asg_client, now: int, plan:
         return False
 
 
-def release_orphaned_instances(sessions_db, pool_db, ec2_client, now: int) -> int:
+def release_orphaned_instances(snapshot: ReconciliationSnapshot, now: int) -> int:
     """Release instances that are assigned but have no active session."""
     released = 0
     
     # Get assigned instances
-    assigned_instances = pool_db.query_by_index("StatusIndex", "status", InstanceStatus.ASSIGNED)
+    assigned_instances = snapshot.pool_records(statuses=[InstanceStatus.ASSIGNED])
+    
+    # Heartbeats don't touch the session item, so activity comes from the heartbeat table.
+    # Without it an assignment can't be judged stale this tick
+    heartbeats = {}
+    heartbeats_read = True
+    if HEARTBEATS_TABLE:
+        session_ids = [r["session_id"] for r in assigned_instances if snapshot.get_session(r.get("session_id"))]
+        try:
+            heartbeats = HeartbeatStore(HEARTBEATS_TABLE).get_many(session_ids, strict=True)
+        except ClientError as e:
+            logger.warning(f"Failed to read heartbeats, skipping stale assignment checks: {e}")
+            heartbeats_read = False
     
     for pool_record in assigned_instances:
         instance_id = pool_record["instance_id"]
@@ -536,77 +1161,45 @@ def release_orphaned_instances(sessions_db, pool_db, ec2_client, now: int) -> in
         assigned_at = pool_record.get("assigned_at", 0)
         
         # Check if session exists and is active
+        # (the snapshot only holds live sessions, so terminated/errored/missing all read as None)
         is_orphaned = False
+        session = snapshot.get_session(session_id) if session_id else None
         
-        if not session_id:
+        if not session:
             is_orphaned = True
-        else:
-            session = sessions_db.get_item({"session_id": session_id})
-            if not session:
-                is_orphaned = True
-            elif session.get("status") in [SessionStatus.TERMINATED, SessionStatus.ERROR]:
-                is_orphaned = True
-        
-        # Also check for stale assignments (assigned > 1 hour with no session update)
-        if not is_orphaned and assigned_at:
+        
+        # Also check for stale assignments (assigned > 1 hour with no session update or heartbeat)
+        if not is_orphaned and assigned_at and heartbeats_read:
             if now - assigned_at > 3600:  # 1 hour
-                session = sessions_db.get_item({"session_id": session_id}) if session_id else None
-                if session:
-                    updated_at = session.get("updated_at", 0)
-                    if now - updated_at > 3600:
-                        is_orphaned = True
-                        logger.info(f"Instance {instance_id} appears stale (no session activity)")
+                last_activity = max(
+                    session.get("updated_at", 0),
+                    session.get("last_heartbeat_at", 0),
+                    heartbeats.get(session_id, {}).get("last_heartbeat_at", 0),
+                )
+                if now - last_activity > 3600:
+                    is_orphaned = True
+                    logger.info(f"Instance {instance_id} appears stale (no session activity)")
         
         if is_orphaned:
             logger.info(f"Releasing orphaned instance: {instance_id}")
-            
-            pool_db.update_item(
-                {"instance_id": instance_id},
-                {
-                    "status": InstanceStatus.AVAILABLE,
-                    "session_id": None,
-                    "student_id": None,
-                    "released_at": now,
-                }
-            )
-            
-            # Clear tags
-            ec2_client.tag_instance(instance_id, {
-                "SessionId": "",
-                "StudentId": "",
-                "ReleasedAt": get_iso_timestamp(),
-            })
-            
+            snapshot.release_instance(instance_id, session_id, now)
             released += 1
     
     return released
 
 
-def manage_scaling_for_plan(sessions_db, pool_db, asg_client, plan: str, asg_name: str) -> dict:
+def manage_scaling_for_plan(snapshot: ReconciliationSnapshot, asg_client, plan: str, asg_name: str) -> dict:
     """Check if we need to scale the ASG based on demand for a specific plan."""
     action = {"type": None, "reason": None, "plan": plan}
     
     try:
-        # Count active sessions for this plan
-        active_count = 0
-        for status in [SessionStatus.PENDING, SessionStatus.PROVISIONING,
-                       SessionStatus.READY, SessionStatus.ACTIVE]:
-            sessions = sessions_db.query_by_index("StatusIndex", "status", status)
-            # Filter by plan (default to "pro" for backward compatibility)
-            plan_sessions = [s for s in sessions if s.get("plan", "pro") == plan]
-            active_count += len(plan_sessions)
-        
-        # Count available instances for this plan
-        available_instances = pool_db.query_by_index("StatusIndex", "status", InstanceStatus.AVAILABLE)
-        available_count = len([i for i in available_instances if i.get("plan", "pro") == plan])
-        
-        # Count instances that are already starting for this plan
-        starting_instances = pool_db.query_by_index("StatusIndex", "status", InstanceStatus.STARTING)
-        starting_count = len([i for i in starting_instances if i.get("plan", "pro") == plan])
-        
-        # Count assigned instances for this plan
-        assigned_instances = pool_db.query_by_index("StatusIndex", "status", InstanceStatus.ASSIGNED)
-        assigned_count = len([i for i in assigned_instances if i.get("plan", "pro") == plan])
+        # Count active sessions for this plan (default to "pro" for backward compatibility)
+        active_count = len(snapshot.sessions_with_status(ACTIVE_SESSION_STATUSES, plan=plan))
+        
+        # Count available, starting and assigned instances for this plan
+        available_count = snapshot.count_pool(plan, InstanceStatus.AVAILABLE)
+        starting_count = snapshot.count_pool(plan, InstanceStatus.STARTING)
+        assigned_count = snapshot.count_pool(plan, InstanceStatus.ASSIGNED)
         
         # Get ASG capacity
         capacity = asg_client.get_asg_capacity(asg_name)
@@ -1,10 +1,13 @@
 """
 Session Heartbeat Lambda Function
 
-Receives heartbeats from the browser/client and optionally queries
-Guacamole for connection activity to track user activity.
+Receives heartbeats from the browser/client and reads the Guacamole
+connection activity that pool-manager publishes each minute to track user
+activity.
 
-Updates the session's last_active_at timestamp and returns idle status.
+Records each heartbeat in the narrow heartbeat table and returns idle
+status. The session item itself is only written on state transitions
+(READY -> ACTIVE, idle warning set or cleared, focus mode toggled).
 """
 
 import logging
@@ -15,8 +18,12 @@ import sys
 sys.path.insert(0, "/opt/python")
 
 from utils import (
+    CACHE_TABLE,
     DynamoDBClient,
+    GuacamoleActivitySnapshot,
     GuacamoleClient,
+    HEARTBEATS_TABLE,
+    HeartbeatStore,
     SessionStatus,
     error_response,
     get_current_timestamp,
@@ -56,9 +63,12 @@ def get_guacamole_internal_url() -> str:
     return ""
 
 
-def check_guacamole_activity(session: dict) -> dict:
+def check_guacamole_activity(session: dict, now: int) -> dict:
     """
-    Check Guacamole for recent connection activity.
+    Look up the session's Guacamole connection activity.
+    
+    Reads the connection's record from the activity snapshot. Without a cache
+    table it falls back to asking Guacamole directly.
     
     Returns dict with:
     - connected: bool - whether user is currently connected
@@ -78,6 +88,14 @@ def check_guacamole_activity(session: dict) -> dict:
         logger.debug("No Guacamole connection ID in session")
         return result
     
+    if CACHE_TABLE:
+        activity = GuacamoleActivitySnapshot(CACHE_TABLE).get(connection_id, now)
+        if activity:
+            result["connected"] = activity["active_connections"] > 0
+            result["last_activity"] = activity["last_activity"]
+            result["active_connections"] = activity["active_connections"]
+        return result
+    
     internal_url = get_guacamole_internal_url()
     if not internal_url:
         logger.debug("Guacamole URL not configured")
@@ -175,8 +193,14 @@ def handler(event, context):
         last_active_at = session.get("last_active_at", created_at)
         expires_at = session.get("expires_at", 0)
         
+        heartbeats = HeartbeatStore(HEARTBEATS_TABLE) if HEARTBEATS_TABLE else None
+        if heartbeats:
+            heartbeat = heartbeats.get(session_id)
+            if heartbeat:
+                last_active_at = max(last_active_at, heartbeat.get("last_active_at", 0))
+        
         # Check Guacamole activity for more accurate idle detection
-        guac_activity = check_guacamole_activity(session)
+        guac_activity = check_guacamole_activity(session, now)
         guac_connected = guac_activity.get("connected", False)
         guac_last_activity = guac_activity.get("last_activity", 0)
         
@@ -229,6 +253,9 @@ def handler(event, context):
             "guacamole_connected": guac_connected,
         }
         
+        if bool(session.get("focus_mode", False)) != bool(focus_mode):
+            update_data["focus_mode"] = bool(focus_mode)
+        
         # Track warning state
         if idle_warning and not session.get("idle_warning_sent_at"):
             update_data["idle_warning_sent_at"] = now
@@ -242,11 +269,20 @@ def handler(event, context):
         if status == SessionStatus.READY and should_update_activity:
             update_data["status"] = SessionStatus.ACTIVE
         
-        # Update session in DynamoDB
-        sessions_db.update_item(
-            {"session_id": session_id},
-            update_data
-        )
+        if heartbeats:
+            heartbeats.put(
+                session_id,
+                now,
+                last_active_at=effective_last_active,
+                idle_seconds=idle_seconds,
+                guacamole_connected=guac_connected,
+                focus_mode=bool(focus_mode),
+            )
+            # Only transitions touch the session item (and its stream)
+            if update_data.keys() & {"status", "idle_warning_sent_at", "focus_mode"}:
+                sessions_db.update_item({"session_id": session_id}, update_data)
+        else:
+            sessions_db.update_item({"session_id": session_id}, update_data)
         
         # Build response
         response_data = {
@@ -0,0 +1,215 @@
+"""
+Session Stats Lambda Function
+
+Consumes the DynamoDB Streams of the sessions and instance pool tables and
+keeps the statistics store current: per-status and per-plan session counters,
+instance pool occupancy, and the recent-sessions view read by admin-sessions.
+When USAGE_ROLLUP_TABLE is set it also maintains the per-student daily and
+monthly usage buckets read by usage-history, and when ACTIVE_SESSIONS_TABLE
+is set it removes sessions that stop being live from their student's active
+session pointer. When a session archive is configured (SESSION_HISTORY_TABLE
+or SESSION_ARCHIVE_DIR) it archives finished sessions and trims them from the
+sessions table; this runs here rather than in a third consumer of the
+sessions stream, which DynamoDB Streams would throttle.
+
+Invoke directly with {"action": "rebuild"} to recount everything from the
+source tables (needed once after first deploying the stats table), to seed
+usage buckets that don't exist yet and to archive finished sessions that
+were written before the archive existed.
+"""
+
+import logging
+import os
+import sys
+
+# Add common layer to path
+sys.path.insert(0, "/opt/python")
+
+from utils import (
+    ACTIVE_SESSIONS_TABLE,
+    ActiveSessionPointers,
+    DynamoDBClient,
+    LIVE_SESSION_STATUSES,
+    FINISHED_SESSION_STATUSES,
+    SessionStatsStore,
+    StreamImage,
+    UsageRollupStore,
+    get_current_timestamp,
+    get_session_archive,
+    RECENT_SESSIONS_RETENTION_DAYS,
+    USAGE_ROLLUP_TABLE,
+)
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Environment variables
+SESSIONS_TABLE = os.environ.get("SESSIONS_TABLE")
+INSTANCE_POOL_TABLE = os.environ.get("INSTANCE_POOL_TABLE")
+
+
+def counter_state(image):
+    """The (plan, status) pair an item is counted under, None if it doesn't exist."""
+    if image is None:
+        return None
+    return (image.get("plan"), image.get("status"))
+
+
+def apply_record(store, record, usage=None, pointers=None, archive=None, sessions_db=None) -> bool:
+    """
+    Apply one stream record to the statistics store and, for sessions, to the
+    usage rollups, active session pointers and session archive.
+    
+    Returns True if anything was written.
+    """
+    stream = record["dynamodb"]
+    keys = stream.get("Keys", {})
+    old = StreamImage(stream["OldImage"]) if "OldImage" in stream else None
+    new = StreamImage(stream["NewImage"]) if "NewImage" in stream else None
+    
+    # Counter and usage ADDs are written once per record (see apply_once), so a
+    # retried record doesn't count twice; every other write is idempotent
+    if "instance_id" in keys:
+        updates = store.transition_updates("pool", counter_state(old), counter_state(new))
+        return store.apply_once(record["eventID"], updates)
+    
+    if "session_id" not in keys:
+        return False
+    
+    # Archived first: its writes are idempotent, so a retry after a later
+    # failure repeats them harmlessly
+    changed = archive is not None and archive.apply_session(old, new, sessions_db)
+    
+    # Sessions count for as long as they are kept: once archived, their TTL
+    # removal from the sessions table leaves the counters alone
+    new_state = counter_state(new)
+    if new is None and old is not None and (
+        old.get("archived_at") is not None or (archive is not None and old.get("student_id"))
+    ):
+        new_state = counter_state(old)
+    updates = store.transition_updates("sessions", counter_state(old), new_state)
+    if usage is not None:
+        updates += usage.session_updates(old, new)
+    if store.apply_once(record["eventID"], updates):
+        changed = True
+    
+    # Sessions removed by TTL stay in the recent view until it ages them out
+    if new is not None and (old is None or not all(
+        new.raw_equal(old, field) for field in SessionStatsStore.RECENT_FIELDS
+    )):
+        store.put_recent(new.to_dict())
+        changed = True
+    
+    # Catches the terminations that don't go through ActiveSessionPointers
+    # (expiry, idle, provisioning errors); removing an absent ID is a no-op
+    if (pointers is not None and old is not None and old.get("student_id")
+            and old.get("status") in LIVE_SESSION_STATUSES
+            and (new is None or new.get("status") not in LIVE_SESSION_STATUSES)):
+        pointers.release(old.get("student_id"), old.get("session_id"))
+        changed = True
+    
+    return changed
+
+
+def rebuild(store, usage=None, archive=None) -> dict:
+    """
+    Recount every counter and refill the recent view from the source tables,
+    seed any usage buckets that are missing, and archive finished sessions
+    that haven't been.
+    """
+    counters = {}
+    usage_buckets = {}  # student_id -> {bucket: totals}
+    
+    def count(kind, plan, status):
+        if not status:
+            return
+        for sk in SessionStatsStore.counter_keys(kind, plan):
+            by_status = counters.setdefault(sk, {})
+            by_status[status] = by_status.get(status, 0) + 1
+    
+    recent_cutoff = get_current_timestamp() - RECENT_SESSIONS_RETENTION_DAYS * 86400
+    recent = 0
+    archived = 0
+    sessions_db = DynamoDBClient(SESSIONS_TABLE)
+    live_ids = set()
+    for session in sessions_db.iter_scan(strict=True):
+        live_ids.add(session["session_id"])
+        count("sessions", session.get("plan"), session.get("status"))
+        if int(session.get("created_at") or 0) >= recent_cutoff:
+            store.put_recent(session)
+            recent += 1
+        if usage is not None and session.get("student_id"):
+            student_buckets = usage_buckets.setdefault(session["student_id"], {})
+            for bucket, totals in UsageRollupStore.session_deltas(session, True, True).items():
+                merged = student_buckets.setdefault(bucket, {"seconds": 0, "sessions": 0})
+                merged["seconds"] += totals["seconds"]
+                merged["sessions"] += totals["sessions"]
+        if (archive is not None and session.get("student_id") and not session.get("archived_at")
+                and session.get("status") in FINISHED_SESSION_STATUSES):
+            archive.append(archive.compact(session))
+            archive.trim(session, sessions_db)
+            archived += 1
+    
+    # Archived sessions the TTL already removed from the sessions table
+    if archive is not None:
+        for record in archive.iter_records():
+            if record["session_id"] not in live_ids:
+                count("sessions", record.get("plan"), record.get("status"))
+    
+    pool_db = DynamoDBClient(INSTANCE_POOL_TABLE)
+    for record in pool_db.iter_scan(projection=["instance_id", "plan", "status"], strict=True):
+        count("pool", record.get("plan"), record.get("status"))
+    
+    # Zero out counter items for plans/statuses that no longer exist
+    for sk in store.get_counters():
+        counters.setdefault(sk, {})
+    
+    store.replace_counters(counters)
+    
+    seeded = 0
+    for student_id, buckets in usage_buckets.items():
+        seeded += usage.seed_buckets(student_id, buckets)
+    
+    logger.info(
+        f"[SESSION_STATS] Rebuilt {len(counters)} counter item(s) and {recent} recent session(s), "
+        f"seeded {seeded} usage bucket(s), archived {archived} session(s)"
+    )
+    return {"counters": len(counters), "recent": recent, "usage_buckets": seeded, "archived": archived}
+
+
+def handler(event, context):
+    """
+    Process DynamoDB Stream records from the sessions and instance pool tables.
+    
+    Records are applied in order. On the first failure the rest of the batch
+    is reported back for retry from that record, so none is skipped; a
+    retried record's counter and usage updates are not written again (see
+    SessionStatsStore.apply_once) and its other writes are idempotent.
+    """
+    store = SessionStatsStore()
+    usage = UsageRollupStore() if USAGE_ROLLUP_TABLE else None
+    sessions_db = DynamoDBClient(SESSIONS_TABLE)
+    pointers = ActiveSessionPointers(sessions_db) if ACTIVE_SESSIONS_TABLE else None
+    archive = get_session_archive()
+    
+    if event.get("action") == "rebuild":
+        return rebuild(store, usage, archive)
+    
+    records = event.get("Records", [])
+    applied = 0
+    skipped = 0
+    failures = []
+    
+    for record in records:
+        try:
+            if apply_record(store, record, usage, pointers, archive, sessions_db):
+                applied += 1
+            else:
+                skipped += 1
+        except Exception as e:
+            logger.error(f"[SESSION_STATS] Failed to apply stream record {record.get('eventID')}: {e}")
+            failures.append({"itemIdentifier": record["dynamodb"]["SequenceNumber"]})
+            break
+    
+    logger.info(f"[SESSION_STATS] {len(records)} record(s): {applied} applied, {skipped} unchanged, {len(failures)} failed")
+    return {"batchItemFailures": failures}
@@ -13,6 +13,8 @@ import sys
 sys.path.insert(0, "/opt/python")
 
 from utils import (
+    ACTIVE_SESSIONS_TABLE,
+    ActiveSessionPointers,
     DynamoDBClient,
     EC2Client,
     GuacamoleClient,
@@ -42,10 +44,14 @@ GUACAMOLE_ADMIN_PASS = os.environ.get("GUACAMOLE_ADMIN_PASS", "guacadmin")
 ENABLE_GUACAMOLE_CLEANUP = os.environ.get("ENABLE_GUACAMOLE_CLEANUP", "true").lower() == "true"
 
 
-def cleanup_guacamole_resources(connection_id: str, session_username: str = None) -> dict:
+def cleanup_guacamole_resources(connection_id: str, session_username: str = None, pooled: bool = False) -> dict:
     """
     Delete the Guacamole connection and session user for this session.
     
+    Connections pre-built by pool-manager (pooled=True) are recycled instead of
+    deleted: active sessions are killed and the session user is removed, but the
+    connection stays on the instance's pool record for the next session.
+    
     This is a best-effort operation - failures here should NOT block session termination.
     Uses a short timeout (2 seconds) to prevent blocking the termination process.
     
@@ -62,6 +68,7 @@ def cleanup_guacamole_resources(connection_id: str, session_username: str = None
     
     result = {
         "connection_deleted": False,
+        "connection_recycled": False,
         "user_deleted": False,
         "sessions_killed": 0,
         "error": None,
@@ -90,8 +97,11 @@ def cleanup_guacamole_resources(connection_id: str, session_username: str = None
             except Exception as e:
                 logger.warning(f"Error killing active sessions for {connection_id}: {e}")
         
-        # Delete the connection definition
-        if connection_id:
+        # Delete the connection definition (pooled connections are kept for the next session)
+        if connection_id and pooled:
+            result["connection_recycled"] = True
+            logger.info(f"Keeping pooled Guacamole connection {connection_id} for the next session")
+        elif connection_id:
             try:
                 result["connection_deleted"] = guac.delete_connection(connection_id)
                 if result["connection_deleted"]:
@@ -113,6 +123,10 @@ def cleanup_guacamole_resources(connection_id: str, session_username: str = None
             except Exception as e:
                 logger.warning(f"Error deleting Guacamole user {session_username}: {e}")
         
+        # Per-invocation Guacamole API timings and connection reuse
+        result["http"] = guac.transport.metrics(reset=True)
+        logger.info(f"[HTTP] Guacamole cleanup requests: {result['http']}")
+        
         return result
     except Exception as e:
         # Log but don't fail - Guacamole cleanup is best-effort
@@ -174,16 +188,19 @@ def handler(event, context):
         instance_id = session.get("instance_id")
         connection_info = session.get("connection_info", {})
         
-        # Update session status
-        sessions_db.update_item(
-            {"session_id": session_id},
-            {
-                "status": SessionStatus.TERMINATING,
-                "termination_reason": reason,
-                "terminated_at": now,
-                "updated_at": now,
-            }
-        )
+        # Update session status, freeing the student's active session pointer
+        # in the same transaction so a relaunch is not blocked by this session
+        updates = {
+            "status": SessionStatus.TERMINATING,
+            "termination_reason": reason,
+            "terminated_at": now,
+            "updated_at": now,
+        }
+        pointers = ActiveSessionPointers(sessions_db) if ACTIVE_SESSIONS_TABLE else None
+        if pointers is None or not pointers.end_session(session, updates):
+            sessions_db.update_item({"session_id": session_id}, updates)
+            if pointers is not None and session.get("student_id"):
+                pointers.release(session["student_id"], session_id)
         
         # Delete Guacamole connection and session user if they exist
         # This is best-effort - failures here should NOT block termination
@@ -197,7 +214,11 @@ def handler(event, context):
         elif guac_connection_id or guac_session_user:
             try:
                 logger.info(f"Attempting Guacamole cleanup for connection {guac_connection_id}")
-                guac_cleanup = cleanup_guacamole_resources(guac_connection_id, guac_session_user)
+                guac_cleanup = cleanup_guacamole_resources(
+                    guac_connection_id,
+                    guac_session_user,
+                    pooled=bool(connection_info.get("guacamole_connection_pooled")),
+                )
                 
                 if guac_cleanup.get("error"):
                     logger.warning(f"Guacamole cleanup completed with errors: {guac_cleanup['error']}")
@@ -212,15 +233,16 @@ def handler(event, context):
         instance_stopped = False
         if instance_id:
             # Update pool record
-            pool_db.update_item(
-                {"instance_id": instance_id},
-                {
-                    "status": InstanceStatus.STOPPING if stop_instance else InstanceStatus.AVAILABLE,
-                    "session_id": None,
-                    "student_id": None,
-                    "released_at": now,
-                }
-            )
+            pool_updates = {
+                "status": InstanceStatus.STOPPING if stop_instance else InstanceStatus.AVAILABLE,
+                "session_id": None,
+                "student_id": None,
+                "released_at": now,
+            }
+            if guac_cleanup.get("user_deleted"):
+                # Nothing left for pool-manager to revoke on the recycled connection
+                pool_updates["guacamole_session_user"] = None
+            pool_db.update_item({"instance_id": instance_id}, pool_updates)
             
             # Remove session tags from instance
             ec2_client.tag_instance(instance_id, {
@@ -279,6 +301,7 @@ def handler(event, context):
                 "instance_stopped": instance_stopped,
                 "guacamole_sessions_killed": guac_cleanup.get("sessions_killed", 0),
                 "guacamole_connection_deleted": guac_cleanup.get("connection_deleted", False),
+                "guacamole_connection_recycled": guac_cleanup.get("connection_recycled", False),
                 "guacamole_user_deleted": guac_cleanup.get("user_deleted", False),
                 "reason": reason,
                 "terminated_at": now,
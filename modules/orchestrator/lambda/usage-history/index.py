@@ -2,25 +2,32 @@
 Get Session History Lambda Function
 
 Returns user's session history and usage statistics.
-Queries DynamoDB for all sessions belonging to a specific user.
+Pages through a user's sessions newest first on StudentCreatedIndex
+(student_id + created_at), or through the session archive when one is
+configured, and serves day/month usage ranges from the usage rollup table.
 """
 
 import logging
 import os
 import sys
-from datetime import datetime, timezone
-from decimal import Decimal
+from datetime import datetime, timedelta, timezone
 
 # Add common layer to path
 sys.path.insert(0, "/opt/python")
 
 from utils import (
     DynamoDBClient,
+    UsageRollupStore,
     error_response,
     get_moodle_token_from_event,
     get_path_parameter,
+    get_session_archive,
+    iter_periods,
+    query_session_history_page,
     success_response,
+    to_epoch_seconds,
     verify_moodle_request,
+    USAGE_ROLLUP_TABLE,
 )
 
 logger = logging.getLogger()
@@ -31,6 +38,9 @@ SESSIONS_TABLE = os.environ.get("SESSIONS_TABLE")
 MOODLE_WEBHOOK_SECRET = os.environ.get("MOODLE_WEBHOOK_SECRET", "")
 REQUIRE_MOODLE_AUTH = os.environ.get("REQUIRE_MOODLE_AUTH", "false").lower() == "true"
 
+# Longest range one usage request may cover, per granularity
+MAX_USAGE_PERIODS = {"day": 366, "month": 60}
+
 
 def handler(event, context):
     """
@@ -39,10 +49,18 @@ def handler(event, context):
     Routes:
     - GET /sessions/history - Get history for authenticated user (from token)
     - GET /sessions/history/{userId} - Get history for specific user (requires admin)
+    - GET /sessions/usage - Get usage buckets for authenticated user (see get_usage_range)
+    - GET /sessions/usage/{userId} - Get usage buckets for specific user (requires admin)
     
     Query Parameters:
     - limit: Maximum number of sessions to return (default: 50, max: 100)
     - status: Filter by session status (optional)
+    - from: Only sessions created at or after this time (epoch seconds or ISO 8601)
+    - to: Only sessions created at or before this time; a bare date covers the whole day
+    - cursor: next_cursor from the previous page
+    
+    total_sessions and total_minutes are all-time totals from the usage
+    rollup when it is configured, otherwise they cover the returned sessions.
     
     Returns:
     {
@@ -59,7 +77,8 @@ def handler(event, context):
             }
         ],
         "total_sessions": 15,
-        "total_minutes": 2250
+        "total_minutes": 2250,
+        "next_cursor": "eyJzdHVkZW50X2lkIjogInVzZXIxMjMi..."
     }
     """
     logger.info(f"Get session history request: {event}")
@@ -100,114 +119,159 @@ def handler(event, context):
         
         # Parse query parameters
         query_params = event.get("queryStringParameters") or {}
+        
+        if event.get("routeKey", "").startswith("GET /sessions/usage"):
+            return get_usage_range(user_id, query_params)
+        
         limit = int(query_params.get("limit", "50"))
         limit = min(limit, 100)  # Cap at 100
         
         status_filter = query_params.get("status")
         
-        # Query sessions from DynamoDB
+        since = parse_history_bound(query_params.get("from"))
+        until = parse_history_bound(query_params.get("to"), end_of_day=True)
+        if (query_params.get("from") and since is None) or (query_params.get("to") and until is None):
+            return error_response(400, "from/to must be epoch seconds or ISO 8601 timestamps")
+        if since is not None and until is not None and since > until:
+            return error_response(400, "from must not be after to")
+        
+        # Query one page of sessions from DynamoDB, newest first
         db_client = DynamoDBClient(SESSIONS_TABLE)
-        sessions = db_client.query_user_sessions(user_id, limit, status_filter)
+        try:
+            sessions, next_cursor = query_session_history_page(
+                db_client, get_session_archive(), user_id, limit, status_filter, since, until,
+                query_params.get("cursor"),
+            )
+        except ValueError:
+            return error_response(400, "Invalid cursor")
         
         # Calculate total usage
         total_minutes = 0
         formatted_sessions = []
         
         for session in sessions:
-            session_id = session.get("session_id", "unknown")
-            # Calculate duration if both created_at and terminated_at exist
-            duration_minutes = 0
-            created_at = session.get("created_at")
-            terminated_at = session.get("terminated_at")
-            
-            # Log the types for debugging
-            logger.info(f"Session {session_id}: created_at type={type(created_at).__name__}, terminated_at type={type(terminated_at).__name__ if terminated_at else 'None'}")
-            
-            # Convert timestamps to ISO format if they're Unix timestamps (Decimal/int)
-            created_at_iso = None
-            terminated_at_iso = None
-            
-            if created_at:
-                try:
-                    # Convert Decimal to float first
-                    if isinstance(created_at, Decimal):
-                        created_at = float(created_at)
-                    
-                    # If it's a Unix timestamp (int or float), convert to ISO
-                    if isinstance(created_at, (int, float)):
-                        created_at_iso = datetime.fromtimestamp(created_at, tz=timezone.utc).isoformat()
-                    else:
-                        # It's already a string, use as-is
-                        created_at_iso = str(created_at)
-                except (ValueError, TypeError) as e:
-                    logger.warning(f"Error formatting created_at for session {session_id}: {e}, type={type(created_at)}")
-            
-            if terminated_at:
-                try:
-                    # Convert Decimal to float first
-                    if isinstance(terminated_at, Decimal):
-                        terminated_at = float(terminated_at)
-                    
-                    # If it's a Unix timestamp (int or float), convert to ISO
-                    if isinstance(terminated_at, (int, float)):
-                        terminated_at_iso = datetime.fromtimestamp(terminated_at, tz=timezone.utc).isoformat()
-                    else:
-                        # It's already a string, use as-is
-                        terminated_at_iso = str(terminated_at)
-                except (ValueError, TypeError) as e:
-                    logger.warning(f"Error formatting terminated_at for session {session_id}: {e}, type={type(terminated_at)}")
+            created_at = to_epoch_seconds(session.get("created_at"))
+            terminated_at = to_epoch_seconds(session.get("terminated_at"))
             
-            # Calculate duration
-            if created_at and terminated_at:
-                try:
-                    # Convert Decimal to float first
-                    if isinstance(created_at, Decimal):
-                        created_at = float(created_at)
-                    if isinstance(terminated_at, Decimal):
-                        terminated_at = float(terminated_at)
-                    
-                    # Work with the raw timestamps for calculation
-                    if isinstance(created_at, (int, float)):
-                        start_ts = float(created_at)
-                    else:
-                        # Parse ISO string
-                        start_ts = datetime.fromisoformat(str(created_at).replace("Z", "+00:00")).timestamp()
-                    
-                    if isinstance(terminated_at, (int, float)):
-                        end_ts = float(terminated_at)
-                    else:
-                        # Parse ISO string
-                        end_ts = datetime.fromisoformat(str(terminated_at).replace("Z", "+00:00")).timestamp()
-                    
-                    duration_seconds = end_ts - start_ts
-                    duration_minutes = int(duration_seconds / 60)
-                    total_minutes += duration_minutes
-                    logger.info(f"Session {session_id}: duration={duration_minutes} minutes")
-                except (ValueError, AttributeError, TypeError) as e:
-                    logger.warning(f"Error calculating duration for session {session_id}: {e}, created_at={created_at}, terminated_at={terminated_at}")
+            duration_minutes = 0
+            if created_at is not None and terminated_at is not None:
+                duration_minutes = int((terminated_at - created_at) / 60)
+                total_minutes += duration_minutes
             
             formatted_sessions.append({
-                "session_id": session_id,
+                "session_id": session.get("session_id", "unknown"),
                 "student_id": session.get("student_id"),
                 "student_name": session.get("student_name"),
                 "status": session.get("status"),
-                "created_at": created_at_iso,
-                "terminated_at": terminated_at_iso,
+                "created_at": to_iso(created_at),
+                "terminated_at": to_iso(terminated_at),
                 "duration_minutes": duration_minutes,
                 "instance_id": session.get("instance_id"),
             })
         
-        # Sort by created_at descending (most recent first)
-        formatted_sessions.sort(key=lambda x: x.get("created_at", ""), reverse=True)
-        
         result = {
             "sessions": formatted_sessions,
             "total_sessions": len(formatted_sessions),
             "total_minutes": total_minutes,
+            "next_cursor": next_cursor,
         }
         
+        if USAGE_ROLLUP_TABLE:
+            totals = UsageRollupStore().totals(user_id)
+            result["total_sessions"] = totals["sessions"]
+            result["total_minutes"] = totals["minutes"]
+        
         return success_response(result, "Session history retrieved")
     
     except Exception as e:
         logger.exception("Error getting session history")
         return error_response(500, "Internal server error", str(e))
+
+
+def parse_history_bound(value, end_of_day=False):
+    """
+    Parse a from/to query parameter to epoch seconds, None if missing or invalid.
+    
+    A bare YYYY-MM-DD date is the start of that UTC day, or its last second
+    with end_of_day so that to=<date> includes the whole day.
+    """
+    if not value:
+        return None
+    timestamp = to_epoch_seconds(value)
+    if timestamp is None:
+        return None
+    if end_of_day and len(value) == 10 and value[4] == "-":
+        timestamp += 86399
+    return int(timestamp)
+
+
+def to_iso(timestamp):
+    """Format epoch seconds as an ISO 8601 UTC string."""
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat()
+
+
+def get_usage_range(user_id: str, query_params: dict):
+    """
+    Return a user's usage buckets for a date range.
+    
+    Query Parameters:
+    - granularity: "day" (default) or "month"
+    - from: First period, YYYY-MM-DD or YYYY-MM (default: 30 days / 12 months back)
+    - to: Last period, same format (default: current day / month)
+    
+    Returns:
+    {
+        "granularity": "day",
+        "from": "2025-11-02",
+        "to": "2025-12-01",
+        "buckets": [{"period": "2025-11-02", "minutes": 95, "sessions": 2}, ...],
+        "total_minutes": 2250,
+        "total_sessions": 15
+    }
+    """
+    if not USAGE_ROLLUP_TABLE:
+        return error_response(503, "Usage rollup table not configured")
+    
+    granularity = query_params.get("granularity", "day")
+    if granularity not in UsageRollupStore.GRANULARITIES:
+        return error_response(400, "granularity must be 'day' or 'month'")
+    
+    period_format = "%Y-%m-%d" if granularity == "day" else "%Y-%m"
+    today = datetime.now(timezone.utc)
+    if granularity == "day":
+        default_start = today - timedelta(days=29)
+    else:
+        months_back = today.year * 12 + today.month - 1 - 11
+        default_start = today.replace(year=months_back // 12, month=months_back % 12 + 1, day=1)
+    
+    try:
+        end = query_params.get("to") or today.strftime(period_format)
+        start = query_params.get("from") or default_start.strftime(period_format)
+        # Round-trip to reject malformed or non-canonical periods
+        for period in (start, end):
+            if datetime.strptime(period, period_format).strftime(period_format) != period:
+                raise ValueError(period)
+    except ValueError:
+        return error_response(400, f"from/to must be formatted as {'YYYY-MM-DD' if granularity == 'day' else 'YYYY-MM'}")
+    
+    if start > end:
+        return error_response(400, "from must not be after to")
+    
+    periods = sum(1 for _ in iter_periods(granularity, start, end))
+    if periods > MAX_USAGE_PERIODS[granularity]:
+        return error_response(400, f"Range too long: at most {MAX_USAGE_PERIODS[granularity]} {granularity}s")
+    
+    buckets = UsageRollupStore().get_range(user_id, granularity, start, end)
+    
+    result = {
+        "granularity": granularity,
+        "from": start,
+        "to": end,
+        "buckets": buckets,
+        "total_minutes": sum(bucket["minutes"] for bucket in buckets),
+        "total_sessions": sum(bucket["sessions"] for bucket in buckets),
+    }
+    
+    return success_response(result, "Usage retrieved")
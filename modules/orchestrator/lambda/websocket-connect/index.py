@@ -19,7 +19,7 @@ sys.path.insert(0, "/opt/python")
 from utils import (
     DynamoDBClient,
     get_current_timestamp,
-    MoodleTokenVerifier,
+    get_token_verifier,
 )
 
 logger = logging.getLogger()
@@ -63,7 +63,7 @@ def handler(event, context):
             }
         
         try:
-            verifier = MoodleTokenVerifier(MOODLE_WEBHOOK_SECRET)
+            verifier = get_token_verifier(MOODLE_WEBHOOK_SECRET)
             token_data = verifier.verify_token(token)
             if not token_data:
                 logger.warning(f"Connection {connection_id} rejected: Invalid token")
@@ -2,19 +2,25 @@
 WebSocket Push Handler
 
 Processes DynamoDB Stream events and pushes session status updates
-to connected WebSocket clients.
+to connected WebSocket clients. Records are coalesced per session and
+only changes to user-visible fields (PUSH_FIELDS) are pushed, as deltas.
 """
 
 import json
 import logging
 import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 import boto3
+from boto3.dynamodb.conditions import Key
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
 # Add common layer to path
 sys.path.insert(0, "/opt/python")
 
-from utils import DynamoDBClient
+from utils import DecimalEncoder, DynamoDBClient, StreamImage
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -23,111 +29,214 @@ logger.setLevel(logging.INFO)
 CONNECTIONS_TABLE = os.environ.get("CONNECTIONS_TABLE")
 WEBSOCKET_API_ENDPOINT = os.environ.get("WEBSOCKET_API_ENDPOINT")
 WEBSOCKET_API_ID = os.environ.get("WEBSOCKET_API_ID")
+# Session fields clients display; changes to anything else are not pushed
+PUSH_FIELDS = [
+    f.strip() for f in os.environ.get(
+        "PUSH_FIELDS",
+        "status,instance_id,instance_ip,direct_url,connection_info,progress,stage,stage_message,expires_at,error",
+    ).split(",")
+    if f.strip()
+]
+# Maximum concurrent post_to_connection calls per batch
+PUSH_MAX_WORKERS = int(os.environ.get("PUSH_MAX_WORKERS", "16"))
+
+# Shared across warm invocations of the same Lambda container
+_apigw_client = None
+_push_executor = None
+
 
 # Initialize API Gateway Management API client
 # The endpoint URL should be the WebSocket API endpoint (wss:// -> https://)
 def get_apigw_client():
-    """Get API Gateway Management API client with proper endpoint."""
+    """Get the cached API Gateway Management API client with proper endpoint."""
+    global _apigw_client
+    if _apigw_client is not None:
+        return _apigw_client
+    
     if WEBSOCKET_API_ENDPOINT:
         # Convert wss:// to https:// for Management API
         endpoint = WEBSOCKET_API_ENDPOINT.replace("wss://", "https://").replace("ws://", "http://")
-        return boto3.client(
-            "apigatewaymanagementapi",
-            endpoint_url=endpoint
-        )
     elif WEBSOCKET_API_ID:
         # Fallback: construct endpoint from API ID and region
         region = os.environ.get("AWS_REGION", "us-east-1")
         endpoint = f"https://{WEBSOCKET_API_ID}.execute-api.{region}.amazonaws.com/{os.environ.get('API_STAGE_NAME', 'v1')}"
-        return boto3.client(
-            "apigatewaymanagementapi",
-            endpoint_url=endpoint
-        )
     else:
         raise ValueError("WEBSOCKET_API_ENDPOINT or WEBSOCKET_API_ID environment variable must be set")
+    
+    # One pooled HTTPS connection per fan-out worker
+    _apigw_client = boto3.client(
+        "apigatewaymanagementapi",
+        endpoint_url=endpoint,
+        config=Config(max_pool_connections=PUSH_MAX_WORKERS),
+    )
+    return _apigw_client
+
 
+def get_push_executor():
+    """Get the thread pool used to fan out posts to connections."""
+    global _push_executor
+    if _push_executor is None:
+        _push_executor = ThreadPoolExecutor(max_workers=PUSH_MAX_WORKERS, thread_name_prefix="ws-push")
+    return _push_executor
 
-def send_to_connection(connection_id, message):
-    """Send message to a WebSocket connection."""
+
+def send_to_connection(connection_id, data):
+    """
+    Send a serialized message to a WebSocket connection.
+    
+    Returns "pushed", "gone" (the client disconnected) or "error".
+    """
     try:
-        apigw_client = get_apigw_client()
-        apigw_client.post_to_connection(
+        get_apigw_client().post_to_connection(
             ConnectionId=connection_id,
-            Data=json.dumps(message)
+            Data=data
         )
-        return True
-    except apigw_client.exceptions.ClientError as e:
+        return "pushed"
+    except ClientError as e:
         error_code = e.response.get("Error", {}).get("Code", "")
         if error_code == "GoneException":
             logger.warning(f"Connection {connection_id} is gone, will be cleaned up")
-        else:
-            logger.error(f"Error sending to connection {connection_id}: {e}")
-        return False
+            return "gone"
+        logger.error(f"Error sending to connection {connection_id}: {e}")
+        return "error"
     except Exception as e:
         logger.error(f"Error sending to connection {connection_id}: {e}")
-        return False
+        return "error"
 
 
-def handler(event, context):
+def send_in_order(connection_id, payloads):
+    """Send a connection's messages sequentially, keeping their order, and time each post."""
+    results = []
+    for data in payloads:
+        started = time.monotonic()
+        outcome = send_to_connection(connection_id, data)
+        results.append((outcome, (time.monotonic() - started) * 1000))
+        if outcome == "gone":
+            break
+    return results
+
+
+def push_to_connections(outbox):
     """
-    Process DynamoDB Stream events and push updates to WebSocket connections.
+    Post queued messages concurrently, one task per connection.
+    
+    Args:
+        outbox: {connection_id: [serialized message, ...]} in send order
+    
+    Returns:
+        Metrics dict with pushed/gone/error counts and post latencies
     """
-    logger.info(f"Processing {len(event['Records'])} DynamoDB stream records")
+    metrics = {"connections": len(outbox), "pushed": 0, "gone": 0, "errors": 0}
+    latencies = []
+    if not outbox:
+        return metrics
     
-    connections_db = DynamoDBClient(CONNECTIONS_TABLE)
-    pushed_count = 0
-    error_count = 0
+    executor = get_push_executor()
+    futures = [
+        executor.submit(send_in_order, connection_id, payloads)
+        for connection_id, payloads in outbox.items()
+    ]
+    for future in futures:
+        for outcome, latency_ms in future.result():
+            metrics["pushed" if outcome == "pushed" else "gone" if outcome == "gone" else "errors"] += 1
+            latencies.append(latency_ms)
+    
+    latencies.sort()
+    metrics["latency_ms"] = {
+        "avg": round(sum(latencies) / len(latencies), 1),
+        "p50": round(latencies[len(latencies) // 2], 1),
+        "max": round(latencies[-1], 1),
+    }
+    return metrics
+
+
+def coalesce_records(records):
+    """
+    Group MODIFY records by session, keeping the oldest OldImage and newest NewImage.
     
-    for record in event["Records"]:
+    Returns ({session_id: (old_session, new_session)}, malformed record count).
+    """
+    changes = {}
+    errors = 0
+    for record in records:
         try:
             # Only process MODIFY events
             if record["eventName"] != "MODIFY":
                 continue
             
-            # Extract session data from DynamoDB stream
-            new_image = record["dynamodb"]["NewImage"]
-            old_image = record["dynamodb"].get("OldImage", {})
+            session = StreamImage(record["dynamodb"]["NewImage"])
+            session_id = session.get("session_id")
+            if not session_id:
+                continue
             
-            # Convert DynamoDB format to regular dict
-            session = {}
-            for key, value in new_image.items():
-                if "S" in value:
-                    session[key] = value["S"]
-                elif "N" in value:
-                    session[key] = int(value["N"])
-                elif "BOOL" in value:
-                    session[key] = value["BOOL"]
-                elif "M" in value:
-                    session[key] = {k: list(v.values())[0] for k, v in value["M"].items()}
+            if session_id in changes:
+                changes[session_id] = (changes[session_id][0], session)
+            else:
+                changes[session_id] = (StreamImage(record["dynamodb"].get("OldImage")), session)
+        except Exception as e:
+            logger.error(f"Error processing stream record: {e}")
+            errors += 1
+    return changes, errors
+
+
+def diff_session(old_session, session):
+    """Return {field: new value} for the user-visible fields that differ."""
+    # Compared on the typed stream values, so only changed fields are decoded
+    return {
+        field: session.get(field)
+        for field in PUSH_FIELDS
+        if not session.raw_equal(old_session, field)
+    }
+
+
+def handler(event, context):
+    """
+    Process DynamoDB Stream events and push updates to WebSocket connections.
+    """
+    logger.info(f"Processing {len(event['Records'])} DynamoDB stream records")
+    batch_started = time.monotonic()
+    
+    connections_db = DynamoDBClient(CONNECTIONS_TABLE)
+    
+    # Messages per connection, sent concurrently once every record is processed
+    outbox = {}
+    
+    # Net change per session across the batch, so a burst of writes to one
+    # session costs at most one pair of connection lookups and one push
+    changes, record_errors = coalesce_records(event["Records"])
+    unchanged = 0
+    
+    for session_id, (old_session, session) in changes.items():
+        try:
+            delta = diff_session(old_session, session)
+            if not delta:
+                # Only bookkeeping fields (updated_at, heartbeats, ...) changed
+                unchanged += 1
+                continue
             
-            session_id = session.get("session_id")
             status = session.get("status")
             student_id = session.get("student_id")
             
-            if not session_id:
-                continue
-            
-            logger.info(f"Session {session_id} status changed to {status}")
+            logger.info(f"Session {session_id} changed: {sorted(delta)}")
             
             # Find all connections subscribed to this session
             connections = []
             
             # Query by session_id
-            if session_id:
-                session_connections = connections_db.query_by_index(
-                    "SessionIndex",
-                    "session_id",
-                    session_id
-                )
-                connections.extend(session_connections)
+            session_connections = list(connections_db.iter_query(
+                Key("session_id").eq(session_id),
+                index_name="SessionIndex",
+                projection=["connection_id"],
+            ))
+            connections.extend(session_connections)
             
             # Query by user_id (student_id)
             if student_id:
-                user_connections = connections_db.query_by_index(
-                    "UserIndex",
-                    "user_id",
-                    student_id
-                )
+                user_connections = list(connections_db.iter_query(
+                    Key("user_id").eq(student_id),
+                    index_name="UserIndex",
+                    projection=["connection_id"],
+                ))
                 # Filter to avoid duplicates
                 existing_ids = {c["connection_id"] for c in connections}
                 connections.extend([
@@ -135,46 +244,42 @@ def handler(event, context):
                     if c["connection_id"] not in existing_ids
                 ])
             
-            # Prepare update message
+            # Prepare update message carrying only the fields that changed
             update_message = {
                 "type": "session_update",
                 "session_id": session_id,
                 "status": status,
+                "delta": True,
+                "changed": sorted(delta),
                 "data": {
                     "session_id": session_id,
                     "status": status,
                     "student_id": student_id,
-                    "instance_id": session.get("instance_id"),
-                    "instance_ip": session.get("instance_ip"),
-                    "direct_url": session.get("direct_url"),
-                    "connection_info": session.get("connection_info"),
-                    "progress": session.get("progress"),
-                    "stage": session.get("stage"),
-                    "stage_message": session.get("stage_message"),
+                    **delta,
                 }
             }
             
-            # Send update to all connected clients
+            # Queue the update for all connected clients
+            data = json.dumps(update_message, cls=DecimalEncoder)
             for connection in connections:
-                connection_id = connection["connection_id"]
-                if send_to_connection(connection_id, update_message):
-                    pushed_count += 1
-                    logger.debug(f"Pushed update to connection {connection_id}")
-                else:
-                    error_count += 1
+                outbox.setdefault(connection["connection_id"], []).append(data)
             
         except Exception as e:
-            logger.error(f"Error processing stream record: {e}")
-            error_count += 1
+            logger.error(f"Error processing changes for session {session_id}: {e}")
+            record_errors += 1
             continue
     
-    logger.info(f"Pushed {pushed_count} updates, {error_count} errors")
+    metrics = push_to_connections(outbox)
+    metrics["errors"] += record_errors
+    metrics["records"] = len(event["Records"])
+    metrics["sessions_changed"] = len(changes) - unchanged
+    metrics["sessions_unchanged"] = unchanged
+    metrics["batch_ms"] = round((time.monotonic() - batch_started) * 1000, 1)
+    
+    logger.info(f"Pushed {metrics['pushed']} updates, {metrics['gone']} gone, {metrics['errors']} errors: {metrics}")
     
     return {
         "statusCode": 200,
-        "body": json.dumps({
-            "pushed": pushed_count,
-            "errors": error_count
-        })
+        "body": json.dumps(metrics)
     }
 
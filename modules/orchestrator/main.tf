@@ -47,12 +47,28 @@ resource "aws_dynamodb_table" "sessions" {
     type = "S"
   }
 
+  attribute {
+    name = "created_at"
+    type = "N"
+  }
+
+  # No longer queried; kept so this apply only has one index to build
+  # (DynamoDB adds or removes one GSI per table update). Drop in a later apply.
   global_secondary_index {
     name            = "StudentIndex"
     hash_key        = "student_id"
     projection_type = "ALL"
   }
 
+  # Newest-first per-student history, ranges and cursors, and the
+  # active-session fallback check
+  global_secondary_index {
+    name            = "StudentCreatedIndex"
+    hash_key        = "student_id"
+    range_key       = "created_at"
+    projection_type = "ALL"
+  }
+
   global_secondary_index {
     name            = "InstanceIndex"
     hash_key        = "instance_id"
@@ -65,6 +81,18 @@ resource "aws_dynamodb_table" "sessions" {
     projection_type = "ALL"
   }
 
+  # Newest-first, cursor-paginated admin listing
+  global_secondary_index {
+    name            = "StatusCreatedIndex"
+    hash_key        = "status"
+    range_key       = "created_at"
+    projection_type = "ALL"
+  }
+
+  # Feeds websocket-push and session-stats
+  stream_enabled   = true
+  stream_view_type = "NEW_AND_OLD_IMAGES"
+
   ttl {
     attribute_name = "expires_at"
     enabled        = true
@@ -118,6 +146,10 @@ resource "aws_dynamodb_table" "instance_pool" {
     projection_type = "ALL"
   }
 
+  # Feeds session-stats (pool occupancy)
+  stream_enabled   = true
+  stream_view_type = "NEW_AND_OLD_IMAGES"
+
   tags = merge(
     local.common_tags,
     {
@@ -166,6 +198,249 @@ resource "aws_dynamodb_table" "usage" {
   )
 }
 
+# Shared short-lived key/value items (e.g. cached Guacamole admin tokens, used token nonces)
+resource "aws_dynamodb_table" "cache" {
+  name         = "${var.project_name}-${var.environment}-cache"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "cache_key"
+
+  attribute {
+    name = "cache_key"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+
+  tags = merge(
+    local.common_tags,
+    {
+      Name = "${var.project_name}-${var.environment}-cache"
+    }
+  )
+}
+
+# Stream-maintained session/pool counters and the recent-sessions view
+resource "aws_dynamodb_table" "stats" {
+  name         = "${var.project_name}-${var.environment}-stats"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "pk"
+  range_key    = "sk"
+
+  attribute {
+    name = "pk"
+    type = "S"
+  }
+
+  attribute {
+    name = "sk"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "ttl"
+    enabled        = true
+  }
+
+  tags = merge(
+    local.common_tags,
+    {
+      Name = "${var.project_name}-${var.environment}-stats"
+    }
+  )
+}
+
+# Heartbeat table - latest heartbeat per session, kept out of the session item
+resource "aws_dynamodb_table" "heartbeats" {
+  name         = "${var.project_name}-${var.environment}-heartbeats"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "session_id"
+
+  attribute {
+    name = "session_id"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+
+  tags = merge(
+    local.common_tags,
+    {
+      Name = "${var.project_name}-${var.environment}-heartbeats"
+    }
+  )
+}
+
+# Claim tickets - one per AVAILABLE instance, issued by pool-manager and taken
+# by launches with a single atomic counter update (enable_claim_tickets)
+resource "aws_dynamodb_table" "claim_tickets" {
+  name         = "${var.project_name}-${var.environment}-claim-tickets"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "plan"
+  range_key    = "seq"
+
+  attribute {
+    name = "plan"
+    type = "S"
+  }
+
+  attribute {
+    name = "seq"
+    type = "N"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+
+  tags = merge(
+    local.common_tags,
+    {
+      Name = "${var.project_name}-${var.environment}-claim-tickets"
+    }
+  )
+}
+
+# Encrypts the Guacamole admin token before it is shared through the cache table
+resource "aws_kms_key" "guacamole_token" {
+  description             = "${var.project_name}-${var.environment} Guacamole admin token cache"
+  deletion_window_in_days = 7
+  enable_key_rotation     = true
+
+  tags = merge(
+    local.common_tags,
+    {
+      Name = "${var.project_name}-${var.environment}-guacamole-token"
+    }
+  )
+}
+
+resource "aws_kms_alias" "guacamole_token" {
+  name          = "alias/${var.project_name}-${var.environment}-guacamole-token"
+  target_key_id = aws_kms_key.guacamole_token.key_id
+}
+
+# Active session pointers - one item per student listing their live session
+# IDs, written in the same transactions as session creation and termination
+resource "aws_dynamodb_table" "active_sessions" {
+  name         = "${var.project_name}-${var.environment}-active-sessions"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "student_id"
+
+  attribute {
+    name = "student_id"
+    type = "S"
+  }
+
+  tags = merge(
+    local.common_tags,
+    {
+      Name = "${var.project_name}-${var.environment}-active-sessions"
+    }
+  )
+}
+
+# Session history - append-only archive of finished sessions, written by
+# session-stats from the sessions stream (enable_session_archive)
+resource "aws_dynamodb_table" "session_history" {
+  name         = "${var.project_name}-${var.environment}-session-history"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "student_id"
+  range_key    = "sk"
+
+  attribute {
+    name = "student_id"
+    type = "S"
+  }
+
+  attribute {
+    name = "sk"
+    type = "S"
+  }
+
+  point_in_time_recovery {
+    enabled = var.environment == "production"
+  }
+
+  tags = merge(
+    local.common_tags,
+    {
+      Name = "${var.project_name}-${var.environment}-session-history"
+    }
+  )
+}
+
+# Usage rollup table - per-student day/month usage buckets, fed by session-stats
+resource "aws_dynamodb_table" "usage_rollup" {
+  name         = "${var.project_name}-${var.environment}-usage-rollup"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "student_id"
+  range_key    = "bucket"
+
+  attribute {
+    name = "student_id"
+    type = "S"
+  }
+
+  attribute {
+    name = "bucket"
+    type = "S"
+  }
+
+  point_in_time_recovery {
+    enabled = var.environment == "production"
+  }
+
+  tags = merge(
+    local.common_tags,
+    {
+      Name = "${var.project_name}-${var.environment}-usage-rollup"
+    }
+  )
+}
+
+# =============================================================================
+# Launch Queue
+# =============================================================================
+
+# Launch jobs accepted by create-session and consumed by the provisioning worker
+resource "aws_sqs_queue" "launch_jobs" {
+  name                       = "${local.function_name_prefix}-launch-jobs"
+  # At least 6x the worker timeout, as recommended for Lambda event sources
+  visibility_timeout_seconds = 720
+  message_retention_seconds  = 3600
+
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.launch_jobs_dlq.arn
+    maxReceiveCount     = 3
+  })
+
+  tags = merge(
+    local.common_tags,
+    {
+      Name = "${local.function_name_prefix}-launch-jobs"
+    }
+  )
+}
+
+resource "aws_sqs_queue" "launch_jobs_dlq" {
+  name                      = "${local.function_name_prefix}-launch-jobs-dlq"
+  message_retention_seconds = 1209600
+
+  tags = merge(
+    local.common_tags,
+    {
+      Name = "${local.function_name_prefix}-launch-jobs-dlq"
+    }
+  )
+}
+
 # =============================================================================
 # IAM Role for Lambda Functions
 # =============================================================================
@@ -217,6 +492,8 @@ resource "aws_iam_role_policy" "orchestrator_policy" {
           "dynamodb:PutItem",
           "dynamodb:UpdateItem",
           "dynamodb:DeleteItem",
+          "dynamodb:BatchWriteItem",
+          "dynamodb:BatchGetItem",
           "dynamodb:Query",
           "dynamodb:Scan"
         ]
@@ -226,9 +503,25 @@ resource "aws_iam_role_policy" "orchestrator_policy" {
           aws_dynamodb_table.instance_pool.arn,
           "${aws_dynamodb_table.instance_pool.arn}/index/*",
           aws_dynamodb_table.usage.arn,
-          "${aws_dynamodb_table.usage.arn}/index/*"
+          "${aws_dynamodb_table.usage.arn}/index/*",
+          aws_dynamodb_table.cache.arn,
+          aws_dynamodb_table.stats.arn,
+          aws_dynamodb_table.usage_rollup.arn,
+          aws_dynamodb_table.heartbeats.arn,
+          aws_dynamodb_table.claim_tickets.arn,
+          aws_dynamodb_table.active_sessions.arn,
+          aws_dynamodb_table.session_history.arn
         ]
       },
+      {
+        Sid    = "GuacamoleTokenKMS"
+        Effect = "Allow"
+        Action = [
+          "kms:Encrypt",
+          "kms:Decrypt"
+        ]
+        Resource = aws_kms_key.guacamole_token.arn
+      },
       {
         Sid    = "EC2Describe"
         Effect = "Allow"
@@ -264,6 +557,17 @@ resource "aws_iam_role_policy" "orchestrator_policy" {
         ]
         Resource = "*"
       },
+      {
+        Sid    = "LaunchQueueAccess"
+        Effect = "Allow"
+        Action = [
+          "sqs:SendMessage",
+          "sqs:ReceiveMessage",
+          "sqs:DeleteMessage",
+          "sqs:GetQueueAttributes"
+        ]
+        Resource = aws_sqs_queue.launch_jobs.arn
+      },
       {
         Sid    = "SSMParameterAccess"
         Effect = "Allow"
@@ -290,7 +594,10 @@ resource "aws_iam_role_policy" "orchestrator_policy" {
           "dynamodb:GetShardIterator",
           "dynamodb:ListStreams"
         ]
-        Resource = "${aws_dynamodb_table.sessions.arn}/stream/*"
+        Resource = [
+          "${aws_dynamodb_table.sessions.arn}/stream/*",
+          "${aws_dynamodb_table.instance_pool.arn}/stream/*"
+        ]
       },
       {
         Sid    = "SecretsManagerAccess"
@@ -334,6 +641,12 @@ resource "aws_cloudwatch_log_group" "create_session" {
   tags              = local.common_tags
 }
 
+resource "aws_cloudwatch_log_group" "provision_session" {
+  name              = "/aws/lambda/${local.function_name_prefix}-provision-session"
+  retention_in_days = var.log_retention_days
+  tags              = local.common_tags
+}
+
 resource "aws_cloudwatch_log_group" "terminate_session" {
   name              = "/aws/lambda/${local.function_name_prefix}-terminate-session"
   retention_in_days = var.log_retention_days
@@ -384,28 +697,36 @@ resource "aws_lambda_function" "create_session" {
 
   environment {
     variables = {
-      SESSIONS_TABLE        = aws_dynamodb_table.sessions.name
-      INSTANCE_POOL_TABLE   = aws_dynamodb_table.instance_pool.name
-      USAGE_TABLE           = aws_dynamodb_table.usage.name
+      SESSIONS_TABLE          = aws_dynamodb_table.sessions.name
+      INSTANCE_POOL_TABLE     = aws_dynamodb_table.instance_pool.name
+      USAGE_TABLE             = aws_dynamodb_table.usage.name
+      CACHE_TABLE             = aws_dynamodb_table.cache.name
+      GUACAMOLE_TOKEN_KMS_KEY = aws_kms_key.guacamole_token.arn
+      LAUNCH_QUEUE_URL        = aws_sqs_queue.launch_jobs.url
+      CLAIM_STRATEGY          = var.claim_strategy
+      CLAIM_TICKETS_TABLE     = var.enable_claim_tickets ? aws_dynamodb_table.claim_tickets.name : ""
+      ACTIVE_SESSIONS_TABLE   = aws_dynamodb_table.active_sessions.name
       # Multi-tier ASG configuration
-      ASG_NAME_FREEMIUM     = try(var.attackbox_pools["freemium"].asg_name, "")
-      ASG_NAME_STARTER      = try(var.attackbox_pools["starter"].asg_name, "")
-      ASG_NAME_PRO          = try(var.attackbox_pools["pro"].asg_name, "")
-      ATTACKBOX_POOLS       = jsonencode(var.attackbox_pools)
-      GUACAMOLE_PRIVATE_IP  = var.guacamole_private_ip
-      GUACAMOLE_PUBLIC_IP   = var.guacamole_public_ip
-      GUACAMOLE_API_URL     = var.guacamole_api_url
-      GUACAMOLE_ADMIN_USER  = var.guacamole_admin_username
-      GUACAMOLE_ADMIN_PASS  = var.guacamole_admin_password
-      RDP_USERNAME          = var.rdp_username
-      RDP_PASSWORD          = var.rdp_password
-      SESSION_TTL_HOURS     = tostring(var.session_ttl_hours)
-      MAX_SESSIONS          = tostring(var.max_sessions_per_student)
-      MOODLE_WEBHOOK_SECRET = var.moodle_webhook_secret
-      REQUIRE_MOODLE_AUTH   = tostring(var.require_moodle_auth)
-      ENVIRONMENT           = var.environment
-      PROJECT_NAME          = var.project_name
-      AWS_REGION_NAME       = var.aws_region
+      ASG_NAME_FREEMIUM       = try(var.attackbox_pools["freemium"].asg_name, "")
+      ASG_NAME_STARTER        = try(var.attackbox_pools["starter"].asg_name, "")
+      ASG_NAME_PRO            = try(var.attackbox_pools["pro"].asg_name, "")
+      ATTACKBOX_POOLS         = jsonencode(var.attackbox_pools)
+      GUACAMOLE_PRIVATE_IP    = var.guacamole_private_ip
+      GUACAMOLE_PUBLIC_IP     = var.guacamole_public_ip
+      GUACAMOLE_API_URL       = var.guacamole_api_url
+      GUACAMOLE_ADMIN_USER    = var.guacamole_admin_username
+      GUACAMOLE_ADMIN_PASS    = var.guacamole_admin_password
+      RDP_USERNAME            = var.rdp_username
+      RDP_PASSWORD            = var.rdp_password
+      # RDP handshake probing needs a network path to instance private IPs
+      ENABLE_RDP_PROBE        = tostring(var.enable_vpc_config)
+      SESSION_TTL_HOURS       = tostring(var.session_ttl_hours)
+      MAX_SESSIONS            = tostring(var.max_sessions_per_student)
+      MOODLE_WEBHOOK_SECRET   = var.moodle_webhook_secret
+      REQUIRE_MOODLE_AUTH     = tostring(var.require_moodle_auth)
+      ENVIRONMENT             = var.environment
+      PROJECT_NAME            = var.project_name
+      AWS_REGION_NAME         = var.aws_region
     }
   }
 
@@ -431,6 +752,85 @@ resource "aws_lambda_function" "create_session" {
   )
 }
 
+# Provisioning worker - consumes launch jobs queued by create-session
+# (same package as create-session, different handler)
+resource "aws_lambda_function" "provision_session" {
+  filename         = "${path.module}/lambda/packages/create-session.zip"
+  function_name    = "${local.function_name_prefix}-provision-session"
+  role             = aws_iam_role.lambda_role.arn
+  handler          = "index.worker_handler"
+  runtime          = "python3.11"
+  timeout          = 120
+  memory_size      = 256
+
+  source_code_hash = fileexists("${path.module}/lambda/packages/create-session.zip") ? filebase64sha256("${path.module}/lambda/packages/create-session.zip") : null
+
+  layers = [aws_lambda_layer_version.common.arn]
+
+  environment {
+    variables = {
+      SESSIONS_TABLE          = aws_dynamodb_table.sessions.name
+      INSTANCE_POOL_TABLE     = aws_dynamodb_table.instance_pool.name
+      USAGE_TABLE             = aws_dynamodb_table.usage.name
+      CACHE_TABLE             = aws_dynamodb_table.cache.name
+      GUACAMOLE_TOKEN_KMS_KEY = aws_kms_key.guacamole_token.arn
+      # Progression passes for sessions still provisioning are queued back onto the launch queue
+      LAUNCH_QUEUE_URL        = aws_sqs_queue.launch_jobs.url
+      CLAIM_STRATEGY          = var.claim_strategy
+      CLAIM_TICKETS_TABLE     = var.enable_claim_tickets ? aws_dynamodb_table.claim_tickets.name : ""
+      # Multi-tier ASG configuration
+      ASG_NAME_FREEMIUM       = try(var.attackbox_pools["freemium"].asg_name, "")
+      ASG_NAME_STARTER        = try(var.attackbox_pools["starter"].asg_name, "")
+      ASG_NAME_PRO            = try(var.attackbox_pools["pro"].asg_name, "")
+      ATTACKBOX_POOLS         = jsonencode(var.attackbox_pools)
+      GUACAMOLE_PRIVATE_IP    = var.guacamole_private_ip
+      GUACAMOLE_PUBLIC_IP     = var.guacamole_public_ip
+      GUACAMOLE_API_URL       = var.guacamole_api_url
+      GUACAMOLE_ADMIN_USER    = var.guacamole_admin_username
+      GUACAMOLE_ADMIN_PASS    = var.guacamole_admin_password
+      RDP_USERNAME            = var.rdp_username
+      RDP_PASSWORD            = var.rdp_password
+      # RDP handshake probing needs a network path to instance private IPs
+      ENABLE_RDP_PROBE        = tostring(var.enable_vpc_config)
+      SESSION_TTL_HOURS       = tostring(var.session_ttl_hours)
+      MAX_SESSIONS            = tostring(var.max_sessions_per_student)
+      MOODLE_WEBHOOK_SECRET   = var.moodle_webhook_secret
+      REQUIRE_MOODLE_AUTH     = tostring(var.require_moodle_auth)
+      ENVIRONMENT             = var.environment
+      PROJECT_NAME            = var.project_name
+      AWS_REGION_NAME         = var.aws_region
+    }
+  }
+
+  dynamic "vpc_config" {
+    for_each = var.enable_vpc_config ? [1] : []
+    content {
+      subnet_ids         = var.subnet_ids
+      security_group_ids = [var.lambda_security_group_id]
+    }
+  }
+
+  tracing_config {
+    mode = var.enable_xray_tracing ? "Active" : "PassThrough"
+  }
+
+  depends_on = [aws_cloudwatch_log_group.provision_session]
+
+  tags = merge(
+    local.common_tags,
+    {
+      Name = "${local.function_name_prefix}-provision-session"
+    }
+  )
+}
+
+resource "aws_lambda_event_source_mapping" "provision_session" {
+  event_source_arn = aws_sqs_queue.launch_jobs.arn
+  function_name    = aws_lambda_function.provision_session.arn
+  # One job per invocation so a slow launch never delays the next one
+  batch_size       = 1
+}
+
 # Terminate Session Lambda
 resource "aws_lambda_function" "terminate_session" {
   filename         = "${path.module}/lambda/packages/terminate-session.zip"
@@ -447,17 +847,20 @@ resource "aws_lambda_function" "terminate_session" {
 
   environment {
     variables = {
-      SESSIONS_TABLE       = aws_dynamodb_table.sessions.name
-      INSTANCE_POOL_TABLE  = aws_dynamodb_table.instance_pool.name
-      USAGE_TABLE          = aws_dynamodb_table.usage.name
-      GUACAMOLE_PRIVATE_IP = var.guacamole_private_ip
-      GUACAMOLE_PUBLIC_IP  = var.guacamole_public_ip
-      GUACAMOLE_API_URL    = var.guacamole_api_url
-      GUACAMOLE_ADMIN_USER = var.guacamole_admin_username
-      GUACAMOLE_ADMIN_PASS = var.guacamole_admin_password
-      ENVIRONMENT          = var.environment
-      PROJECT_NAME         = var.project_name
-      AWS_REGION_NAME      = var.aws_region
+      SESSIONS_TABLE          = aws_dynamodb_table.sessions.name
+      INSTANCE_POOL_TABLE     = aws_dynamodb_table.instance_pool.name
+      USAGE_TABLE             = aws_dynamodb_table.usage.name
+      CACHE_TABLE             = aws_dynamodb_table.cache.name
+      GUACAMOLE_TOKEN_KMS_KEY = aws_kms_key.guacamole_token.arn
+      ACTIVE_SESSIONS_TABLE   = aws_dynamodb_table.active_sessions.name
+      GUACAMOLE_PRIVATE_IP    = var.guacamole_private_ip
+      GUACAMOLE_PUBLIC_IP     = var.guacamole_public_ip
+      GUACAMOLE_API_URL       = var.guacamole_api_url
+      GUACAMOLE_ADMIN_USER    = var.guacamole_admin_username
+      GUACAMOLE_ADMIN_PASS    = var.guacamole_admin_password
+      ENVIRONMENT             = var.environment
+      PROJECT_NAME            = var.project_name
+      AWS_REGION_NAME         = var.aws_region
     }
   }
 
@@ -499,32 +902,14 @@ resource "aws_lambda_function" "get_session_status" {
 
   environment {
     variables = {
-      SESSIONS_TABLE       = aws_dynamodb_table.sessions.name
-      INSTANCE_POOL_TABLE  = aws_dynamodb_table.instance_pool.name
-      USAGE_TABLE          = aws_dynamodb_table.usage.name
-      # Multi-tier ASG configuration
-      ASG_NAME_FREEMIUM    = try(var.attackbox_pools["freemium"].asg_name, "")
-      ASG_NAME_STARTER     = try(var.attackbox_pools["starter"].asg_name, "")
-      ASG_NAME_PRO         = try(var.attackbox_pools["pro"].asg_name, "")
-      ATTACKBOX_POOLS      = jsonencode(var.attackbox_pools)
-      GUACAMOLE_PRIVATE_IP = var.guacamole_private_ip
-      GUACAMOLE_PUBLIC_IP  = var.guacamole_public_ip
-      GUACAMOLE_API_URL    = var.guacamole_api_url
-      GUACAMOLE_ADMIN_USER = var.guacamole_admin_username
-      GUACAMOLE_ADMIN_PASS = var.guacamole_admin_password
-      RDP_USERNAME         = var.rdp_username
-      RDP_PASSWORD         = var.rdp_password
-      ENVIRONMENT          = var.environment
-      PROJECT_NAME         = var.project_name
-      AWS_REGION_NAME      = var.aws_region
-    }
-  }
-
-  dynamic "vpc_config" {
-    for_each = var.enable_vpc_config ? [1] : []
-    content {
-      subnet_ids         = var.subnet_ids
-      security_group_ids = [var.lambda_security_group_id]
+      # Status reads only touch the sessions table; the provisioning worker keeps it current
+      SESSIONS_TABLE        = aws_dynamodb_table.sessions.name
+      # Per-student listings read finished sessions from the archive
+      SESSION_HISTORY_TABLE = var.enable_session_archive ? aws_dynamodb_table.session_history.name : ""
+      STATUS_CACHE_MAX_AGE  = "2"
+      ENVIRONMENT           = var.environment
+      PROJECT_NAME          = var.project_name
+      AWS_REGION_NAME       = var.aws_region
     }
   }
 
@@ -558,14 +943,21 @@ resource "aws_lambda_function" "pool_manager" {
 
   environment {
     variables = {
-      SESSIONS_TABLE      = aws_dynamodb_table.sessions.name
-      INSTANCE_POOL_TABLE = aws_dynamodb_table.instance_pool.name
-      USAGE_TABLE         = aws_dynamodb_table.usage.name
+      SESSIONS_TABLE              = aws_dynamodb_table.sessions.name
+      INSTANCE_POOL_TABLE         = aws_dynamodb_table.instance_pool.name
+      USAGE_TABLE                 = aws_dynamodb_table.usage.name
+      CACHE_TABLE                 = aws_dynamodb_table.cache.name
+      GUACAMOLE_TOKEN_KMS_KEY     = aws_kms_key.guacamole_token.arn
+      HEARTBEATS_TABLE            = aws_dynamodb_table.heartbeats.name
+      # Restarts stalled progression of provisioning sessions
+      LAUNCH_QUEUE_URL            = aws_sqs_queue.launch_jobs.url
+      # Issues claim tickets for AVAILABLE instances
+      CLAIM_TICKETS_TABLE         = var.enable_claim_tickets ? aws_dynamodb_table.claim_tickets.name : ""
       # Multi-tier ASG configuration
-      ASG_NAME_FREEMIUM   = try(var.attackbox_pools["freemium"].asg_name, "")
-      ASG_NAME_STARTER    = try(var.attackbox_pools["starter"].asg_name, "")
-      ASG_NAME_PRO        = try(var.attackbox_pools["pro"].asg_name, "")
-      ATTACKBOX_POOLS     = jsonencode(var.attackbox_pools)
+      ASG_NAME_FREEMIUM           = try(var.attackbox_pools["freemium"].asg_name, "")
+      ASG_NAME_STARTER            = try(var.attackbox_pools["starter"].asg_name, "")
+      ASG_NAME_PRO                = try(var.attackbox_pools["pro"].asg_name, "")
+      ATTACKBOX_POOLS             = jsonencode(var.attackbox_pools)
       # Idle detection configuration
       ENABLE_IDLE_DETECTION       = tostring(var.enable_idle_detection)
       IDLE_HEARTBEAT_GRACE_PERIOD = tostring(var.idle_heartbeat_grace_period)
@@ -575,15 +967,17 @@ resource "aws_lambda_function" "pool_manager" {
       IDLE_TERMINATION_STARTER    = tostring(var.idle_termination_seconds_starter)
       IDLE_WARNING_PRO            = tostring(var.idle_warning_seconds_pro)
       IDLE_TERMINATION_PRO        = tostring(var.idle_termination_seconds_pro)
-      # Guacamole for activity checking
-      GUACAMOLE_PRIVATE_IP = var.guacamole_private_ip
-      GUACAMOLE_PUBLIC_IP  = var.guacamole_public_ip
-      GUACAMOLE_API_URL    = var.guacamole_api_url
-      GUACAMOLE_ADMIN_USER = var.guacamole_admin_username
-      GUACAMOLE_ADMIN_PASS = var.guacamole_admin_password
-      ENVIRONMENT          = var.environment
-      PROJECT_NAME         = var.project_name
-      AWS_REGION_NAME      = var.aws_region
+      # Guacamole for activity checking and pre-built pool connections
+      GUACAMOLE_PRIVATE_IP        = var.guacamole_private_ip
+      GUACAMOLE_PUBLIC_IP         = var.guacamole_public_ip
+      GUACAMOLE_API_URL           = var.guacamole_api_url
+      GUACAMOLE_ADMIN_USER        = var.guacamole_admin_username
+      GUACAMOLE_ADMIN_PASS        = var.guacamole_admin_password
+      RDP_USERNAME                = var.rdp_username
+      RDP_PASSWORD                = var.rdp_password
+      ENVIRONMENT                 = var.environment
+      PROJECT_NAME                = var.project_name
+      AWS_REGION_NAME             = var.aws_region
     }
   }
 
@@ -626,6 +1020,7 @@ resource "aws_lambda_function" "get_usage" {
   environment {
     variables = {
       USAGE_TABLE           = aws_dynamodb_table.usage.name
+      CACHE_TABLE           = aws_dynamodb_table.cache.name
       MOODLE_WEBHOOK_SECRET = var.moodle_webhook_secret
       REQUIRE_MOODLE_AUTH   = tostring(var.require_moodle_auth)
       ENVIRONMENT           = var.environment
@@ -673,6 +1068,9 @@ resource "aws_lambda_function" "usage_history" {
   environment {
     variables = {
       SESSIONS_TABLE        = aws_dynamodb_table.sessions.name
+      USAGE_ROLLUP_TABLE    = aws_dynamodb_table.usage_rollup.name
+      SESSION_HISTORY_TABLE = var.enable_session_archive ? aws_dynamodb_table.session_history.name : ""
+      CACHE_TABLE           = aws_dynamodb_table.cache.name
       MOODLE_WEBHOOK_SECRET = var.moodle_webhook_secret
       REQUIRE_MOODLE_AUTH   = tostring(var.require_moodle_auth)
       ENVIRONMENT           = var.environment
@@ -733,6 +1131,10 @@ resource "aws_lambda_function" "session_heartbeat" {
   environment {
     variables = {
       SESSIONS_TABLE            = aws_dynamodb_table.sessions.name
+      CACHE_TABLE               = aws_dynamodb_table.cache.name
+      GUACAMOLE_TOKEN_KMS_KEY   = aws_kms_key.guacamole_token.arn
+      HEARTBEATS_TABLE          = aws_dynamodb_table.heartbeats.name
+      HEARTBEAT_TTL             = tostring(2 * max(var.idle_termination_seconds_freemium, var.idle_termination_seconds_starter, var.idle_termination_seconds_pro))
       GUACAMOLE_PRIVATE_IP      = var.guacamole_private_ip
       GUACAMOLE_PUBLIC_IP       = var.guacamole_public_ip
       GUACAMOLE_API_URL         = var.guacamole_api_url
@@ -797,6 +1199,9 @@ resource "aws_lambda_function" "admin_sessions" {
   environment {
     variables = {
       SESSIONS_TABLE_NAME   = aws_dynamodb_table.sessions.name
+      STATS_TABLE           = aws_dynamodb_table.stats.name
+      SESSION_HISTORY_TABLE = var.enable_session_archive ? aws_dynamodb_table.session_history.name : ""
+      AWS_REGION_NAME       = var.aws_region
       MOODLE_WEBHOOK_SECRET = var.moodle_webhook_secret
       REQUIRE_MOODLE_AUTH   = tostring(var.require_moodle_auth)
       ENVIRONMENT           = var.environment
@@ -826,6 +1231,72 @@ resource "aws_lambda_function" "admin_sessions" {
   )
 }
 
+# Session Stats Lambda (DynamoDB Streams consumer)
+resource "aws_cloudwatch_log_group" "session_stats" {
+  name              = "/aws/lambda/${local.function_name_prefix}-session-stats"
+  retention_in_days = var.log_retention_days
+
+  tags = local.common_tags
+}
+
+resource "aws_lambda_function" "session_stats" {
+  filename         = "${path.module}/lambda/packages/session-stats.zip"
+  function_name    = "${local.function_name_prefix}-session-stats"
+  role             = aws_iam_role.lambda_role.arn
+  handler          = "index.handler"
+  runtime          = "python3.11"
+  timeout          = 60
+  memory_size      = 128
+
+  source_code_hash = fileexists("${path.module}/lambda/packages/session-stats.zip") ? filebase64sha256("${path.module}/lambda/packages/session-stats.zip") : null
+
+  layers = [aws_lambda_layer_version.common.arn]
+
+  environment {
+    variables = {
+      SESSIONS_TABLE        = aws_dynamodb_table.sessions.name
+      INSTANCE_POOL_TABLE   = aws_dynamodb_table.instance_pool.name
+      STATS_TABLE           = aws_dynamodb_table.stats.name
+      USAGE_ROLLUP_TABLE    = aws_dynamodb_table.usage_rollup.name
+      ACTIVE_SESSIONS_TABLE = aws_dynamodb_table.active_sessions.name
+      SESSION_HISTORY_TABLE = var.enable_session_archive ? aws_dynamodb_table.session_history.name : ""
+      SESSION_ARCHIVE_GRACE = tostring(var.session_archive_grace_seconds)
+      ENVIRONMENT           = var.environment
+      PROJECT_NAME          = var.project_name
+      AWS_REGION_NAME       = var.aws_region
+    }
+  }
+
+  tracing_config {
+    mode = var.enable_xray_tracing ? "Active" : "PassThrough"
+  }
+
+  depends_on = [aws_cloudwatch_log_group.session_stats]
+
+  tags = merge(
+    local.common_tags,
+    {
+      Name = "${local.function_name_prefix}-session-stats"
+    }
+  )
+}
+
+resource "aws_lambda_event_source_mapping" "session_stats_sessions" {
+  event_source_arn        = aws_dynamodb_table.sessions.stream_arn
+  function_name           = aws_lambda_function.session_stats.arn
+  starting_position       = "LATEST"
+  batch_size              = 100
+  function_response_types = ["ReportBatchItemFailures"]
+}
+
+resource "aws_lambda_event_source_mapping" "session_stats_pool" {
+  event_source_arn        = aws_dynamodb_table.instance_pool.stream_arn
+  function_name           = aws_lambda_function.session_stats.arn
+  starting_position       = "LATEST"
+  batch_size              = 100
+  function_response_types = ["ReportBatchItemFailures"]
+}
+
 # =============================================================================
 # EventBridge Schedule for Pool Manager
 # =============================================================================
@@ -864,8 +1335,8 @@ resource "aws_apigatewayv2_api" "orchestrator" {
   cors_configuration {
     allow_origins     = var.allowed_origins
     allow_methods     = ["GET", "POST", "DELETE", "OPTIONS"]
-    allow_headers     = ["Content-Type", "Authorization", "X-Api-Key", "X-Moodle-Token", "X-Moodle-Signature", "Accept"]
-    expose_headers    = ["X-Request-Id"]
+    allow_headers     = ["Content-Type", "Authorization", "X-Api-Key", "X-Moodle-Token", "X-Moodle-Signature", "Accept", "If-None-Match", "Idempotency-Key"]
+    expose_headers    = ["X-Request-Id", "ETag", "Idempotent-Replayed"]
     max_age           = 3600
     allow_credentials = false
   }
@@ -1030,6 +1501,18 @@ resource "aws_apigatewayv2_route" "user_usage_history" {
   target    = "integrations/${aws_apigatewayv2_integration.usage_history.id}"
 }
 
+resource "aws_apigatewayv2_route" "usage_range" {
+  api_id    = aws_apigatewayv2_api.orchestrator.id
+  route_key = "GET /sessions/usage"
+  target    = "integrations/${aws_apigatewayv2_integration.usage_history.id}"
+}
+
+resource "aws_apigatewayv2_route" "user_usage_range" {
+  api_id    = aws_apigatewayv2_api.orchestrator.id
+  route_key = "GET /sessions/usage/{userId}"
+  target    = "integrations/${aws_apigatewayv2_integration.usage_history.id}"
+}
+
 resource "aws_lambda_permission" "usage_history_apigw" {
   statement_id  = "AllowAPIGatewayInvoke"
   action        = "lambda:InvokeFunction"
@@ -45,6 +45,31 @@ output "usage_table_arn" {
   value       = aws_dynamodb_table.usage.arn
 }
 
+output "cache_table_name" {
+  description = "DynamoDB cache table name"
+  value       = aws_dynamodb_table.cache.name
+}
+
+output "stats_table_name" {
+  description = "DynamoDB session statistics table name"
+  value       = aws_dynamodb_table.stats.name
+}
+
+output "heartbeats_table_name" {
+  description = "DynamoDB session heartbeat table name"
+  value       = aws_dynamodb_table.heartbeats.name
+}
+
+output "usage_rollup_table_name" {
+  description = "DynamoDB per-student usage rollup table name"
+  value       = aws_dynamodb_table.usage_rollup.name
+}
+
+output "launch_queue_url" {
+  description = "SQS queue of session launch jobs"
+  value       = aws_sqs_queue.launch_jobs.url
+}
+
 output "lambda_role_arn" {
   description = "IAM role ARN for Lambda functions"
   value       = aws_iam_role.lambda_role.arn
@@ -131,3 +156,18 @@ output "idle_detection_config" {
   }
 }
 
+
+output "claim_tickets_table_name" {
+  description = "DynamoDB claim ticket table name (used when enable_claim_tickets is set)"
+  value       = aws_dynamodb_table.claim_tickets.name
+}
+
+output "active_sessions_table_name" {
+  description = "DynamoDB active session pointer table name"
+  value       = aws_dynamodb_table.active_sessions.name
+}
+
+output "session_history_table_name" {
+  description = "DynamoDB session history (archive) table name (used when enable_session_archive is set)"
+  value       = aws_dynamodb_table.session_history.name
+}
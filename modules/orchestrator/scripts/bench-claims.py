@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Contention benchmark for claiming pool instances during burst launches.
+
+Starts N launches at once against an in-memory pool table that models
+DynamoDB: every request costs --latency, conditional updates are atomic, and
+PlanStatusIndex lags the table by --index-lag, so launches keep seeing
+instances that were just claimed. Each claim strategy is compared with the
+previous allocation loop (EC2 describe before each round, every launch
+trying candidates in index order, fixed 0.3s/0.6s sleeps between rounds):
+
+    python3 scripts/bench-claims.py [--launches 10 50 200] [--latency 0.008]
+
+Reports claims per second, the share of launches that got an instance,
+lost races (retries) per launch and p95 claim latency.
+"""
+
+import argparse
+import statistics
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "lambda" / "common"))
+
+from utils import InstanceClaimer, InstanceStatus  # noqa: E402
+
+PLAN = "pro"
+
+
+class SimulatedPoolTable:
+    """Pool table with per-request latency, atomic conditional updates and a lagging index."""
+    
+    def __init__(self, size: int, latency: float, index_lag: float):
+        self.latency = latency
+        self.index_lag = index_lag
+        self.lock = threading.Lock()
+        self.items = {
+            f"i-{n:05d}": {"instance_id": f"i-{n:05d}", "plan": PLAN, "status": InstanceStatus.AVAILABLE}
+            for n in range(size)
+        }
+        self.claimed_at = {}
+    
+    def _request(self) -> None:
+        time.sleep(self.latency)
+    
+    def query_by_composite_key(self, index_name, pk_name, pk_value, sk_name, sk_value):
+        self._request()
+        visible_since = time.monotonic() - self.index_lag
+        with self.lock:
+            return [
+                dict(item) for instance_id, item in self.items.items()
+                if item["plan"] == pk_value and (
+                    item["status"] == sk_value or self.claimed_at.get(instance_id, 0) > visible_since
+                )
+            ]
+    
+    def conditional_update(self, key, updates, condition_expression, expression_attribute_names=None,
+                           expression_attribute_values=None, return_old=False):
+        self._request()
+        with self.lock:
+            item = self.items[key["instance_id"]]
+            if item["status"] != InstanceStatus.AVAILABLE:
+                return False
+            previous = dict(item)
+            item.update(updates)
+            self.claimed_at[key["instance_id"]] = time.monotonic()
+        return previous if return_old else True
+    
+    def describe(self, instance_ids) -> None:
+        """The batched EC2 describe the previous loop made before each round."""
+        self._request()
+
+
+class SimulatedTicketQueue:
+    """ClaimTicketQueue with one pre-issued ticket per instance."""
+    
+    def __init__(self, table: SimulatedPoolTable):
+        self.table = table
+        self.tickets = list(table.items)
+        self.claimed = 0
+    
+    def take(self, plan: str):
+        self.table._request()  # Atomic ADD on the counter item
+        with self.table.lock:
+            if self.claimed >= len(self.tickets):
+                return None
+            seq = self.claimed
+            self.claimed += 1
+        self.table._request()  # Read the ticket
+        return {"plan": plan, "seq": seq + 1, "instance_id": self.tickets[seq]}
+
+
+def legacy_claim(table: SimulatedPoolTable, session_id: str, stats: dict) -> bool:
+    """The allocation loop provision_session used before InstanceClaimer."""
+    candidates = table.query_by_composite_key("PlanStatusIndex", "plan", PLAN, "status", InstanceStatus.AVAILABLE)
+    for attempt in range(3):
+        if not candidates:
+            return False
+        stats["rounds"] += 1
+        table.describe([c["instance_id"] for c in candidates])
+        for candidate in candidates:
+            stats["attempts"] += 1
+            if table.conditional_update({"instance_id": candidate["instance_id"]}, {"status": InstanceStatus.ASSIGNED,
+                                                                                   "session_id": session_id}, ""):
+                return True
+            stats["conflicts"] += 1
+        if attempt < 2:
+            time.sleep(0.3 * (attempt + 1))
+            candidates = table.query_by_composite_key("PlanStatusIndex", "plan", PLAN, "status", InstanceStatus.AVAILABLE)
+    return False
+
+
+def run(strategy: str, launches: int, pool_size: int, latency: float, index_lag: float) -> dict:
+    table = SimulatedPoolTable(pool_size, latency, index_lag)
+    tickets = SimulatedTicketQueue(table) if strategy == "tickets" else None
+    barrier = threading.Barrier(launches)
+    results = [None] * launches
+    
+    def launch(n: int) -> None:
+        session_id = f"sess-{n:05d}-burst"
+        barrier.wait()
+        started = time.monotonic()
+        if strategy == "legacy":
+            stats = {"attempts": 0, "conflicts": 0, "rounds": 0}
+            ok = legacy_claim(table, session_id, stats)
+        else:
+            claimer = InstanceClaimer(table, strategy="sharded" if strategy == "tickets" else strategy, tickets=tickets)
+            ok = bool(claimer.claim(PLAN, session_id, {"status": InstanceStatus.ASSIGNED, "session_id": session_id}, 0))
+            stats = claimer.stats
+        results[n] = (ok, time.monotonic() - started, stats["conflicts"])
+    
+    threads = [threading.Thread(target=launch, args=(n,)) for n in range(launches)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    
+    claimed = sum(1 for ok, _, _ in results if ok)
+    latencies = sorted(seconds for _, seconds, _ in results)
+    conflicts = [lost for _, _, lost in results]
+    assigned = [item["session_id"] for item in table.items.values() if item["status"] == InstanceStatus.ASSIGNED]
+    assert len(assigned) == len(set(assigned)) == claimed, "an instance was claimed twice"
+    return {
+        "claims_per_second": claimed / elapsed,
+        "claimed": claimed / launches,
+        "retries_mean": statistics.mean(conflicts),
+        "retries_max": max(conflicts),
+        "p95_ms": latencies[int(0.95 * (len(latencies) - 1))] * 1000,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--launches", type=int, nargs="+", default=[10, 50, 200], help="Concurrent launches per run")
+    parser.add_argument("--spare", type=float, default=1.2, help="Pool size as a multiple of the launches")
+    parser.add_argument("--latency", type=float, default=0.008, help="Seconds per simulated AWS request")
+    parser.add_argument("--index-lag", type=float, default=0.1, help="Seconds PlanStatusIndex lags the table")
+    parser.add_argument("--strategies", nargs="+", default=["legacy", "ordered", "random", "sharded", "tickets"])
+    args = parser.parse_args()
+    
+    print(f"{'launches':>8} {'strategy':10} {'claims/s':>10} {'claimed':>8} {'retries':>8} {'max':>5} {'p95 ms':>8}")
+    for launches in args.launches:
+        pool_size = max(launches, int(launches * args.spare))
+        for strategy in args.strategies:
+            r = run(strategy, launches, pool_size, args.latency, args.index_lag)
+            print(f"{launches:>8} {strategy:10} {r['claims_per_second']:>10.1f} {r['claimed']:>8.0%} "
+                  f"{r['retries_mean']:>8.2f} {r['retries_max']:>5} {r['p95_ms']:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
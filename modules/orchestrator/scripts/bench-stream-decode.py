@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for decoding DynamoDB stream images in websocket-push.
+
+Compares the previous hand-rolled converter, boto3's TypeDeserializer and
+the common layer's decode_stream_value / StreamImage on a realistic session
+image (nested connection_info and readiness maps, fractional numbers).
+
+    python3 scripts/bench-stream-decode.py [--number 20000]
+"""
+
+import argparse
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "lambda" / "common"))
+
+from utils import StreamImage, decode_stream_value  # noqa: E402
+
+PUSH_FIELDS = ["status", "instance_id", "instance_ip", "direct_url", "connection_info",
+               "progress", "stage", "stage_message", "expires_at", "error"]
+
+
+def session_image(updated_at: int) -> dict:
+    """A READY session as it appears in a stream record."""
+    probes = {
+        name: {"M": {"ok": {"BOOL": True}, "elapsed_ms": {"N": str(ms)}, "attempts": {"N": "3"}}}
+        for name, ms in [("guacamole_connection_resolvable", "41.7"), ("session_user_token", "88.25"),
+                         ("rdp_handshake", "1203.5"), ("stale_connections_released", "0")]
+    }
+    return {
+        "session_id": {"S": "sess-abc123def456"},
+        "student_id": {"S": "student123"},
+        "student_name": {"S": "Jane Doe"},
+        "plan": {"S": "pro"},
+        "status": {"S": "active"},
+        "instance_id": {"S": "i-0123456789abcdef0"},
+        "instance_ip": {"S": "10.0.10.15"},
+        "created_at": {"N": "1699990000"},
+        "updated_at": {"N": str(updated_at)},
+        "expires_at": {"N": "1699999999"},
+        "last_heartbeat_at": {"N": str(updated_at)},
+        "idle_seconds": {"N": "12.5"},
+        "error": {"NULL": True},
+        "connection_info": {"M": {
+            "type": {"S": "rdp"},
+            "guacamole_url": {"S": "https://guac.example.com/guacamole"},
+            "instance_ip": {"S": "10.0.10.15"},
+            "rdp_port": {"N": "3389"},
+            "guacamole_connection_id": {"S": "42"},
+            "guacamole_session_user": {"S": "session_3def456"},
+            "guacamole_connection_pooled": {"BOOL": True},
+            "direct_url": {"S": "https://guac.example.com/guacamole/#/client/NDIAYwBwb3N0Z3Jlc3Fs?token=ABCDEF"},
+        }},
+        "readiness": {"M": {
+            "probes": {"M": probes},
+            "total_ms": {"N": "1333.45"},
+            "slowest": {"S": "rdp_handshake"},
+        }},
+        "tags": {"SS": ["lab", "attackbox"]},
+        "history": {"L": [{"M": {"status": {"S": s}, "at": {"N": "1699990000"}}}
+                          for s in ["pending", "provisioning", "ready", "active"]]},
+    }
+
+
+def legacy_decode(image: dict) -> dict:
+    """The converter websocket-push used before the common-layer decoder."""
+    session = {}
+    for key, value in image.items():
+        if "S" in value:
+            session[key] = value["S"]
+        elif "N" in value:
+            session[key] = int(value["N"])
+        elif "BOOL" in value:
+            session[key] = value["BOOL"]
+        elif "M" in value:
+            session[key] = {k: list(v.values())[0] for k, v in value["M"].items()}
+    return session
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=20000, help="Iterations per case")
+    args = parser.parse_args()
+    
+    old_image, new_image = session_image(1699990100), session_image(1699990130)
+    # The legacy converter raises on fractional numbers, so time it without them
+    integral_image = {k: v for k, v in new_image.items() if k not in ("idle_seconds", "readiness")}
+    
+    try:
+        legacy_decode(new_image)
+        legacy_ok = True
+    except ValueError:
+        legacy_ok = False
+    legacy_session = legacy_decode(integral_image)
+    
+    cases = {
+        "legacy (integral numbers only)": lambda: legacy_decode(integral_image),
+        "decode_stream_value, same attributes": lambda: {k: decode_stream_value(v) for k, v in integral_image.items()},
+        "decode_stream_value, full image": lambda: {k: decode_stream_value(v) for k, v in new_image.items()},
+        "StreamImage + PUSH_FIELDS diff": lambda: [
+            field for field in PUSH_FIELDS
+            if not StreamImage(new_image).raw_equal(StreamImage(old_image), field)
+        ],
+        "StreamImage, read connection_info": lambda: StreamImage(new_image)["connection_info"],
+    }
+    try:
+        from boto3.dynamodb.types import TypeDeserializer
+        deserializer = TypeDeserializer()
+        cases["boto3 TypeDeserializer, full image"] = lambda: {
+            k: deserializer.deserialize(v) for k, v in new_image.items()
+        }
+    except ImportError:
+        pass
+    
+    print(f"Legacy converter handles fractional numbers: {legacy_ok}")
+    print(f"Legacy connection_info intact: {legacy_session['connection_info'] == StreamImage(new_image)['connection_info']}")
+    print(f"Legacy keeps NULL/SS/L attributes: {all(k in legacy_session for k in ('error', 'tags', 'history'))}")
+    print(f"{'case':40} {'us/op':>10}")
+    for name, fn in cases.items():
+        seconds = min(timeit.repeat(fn, number=args.number, repeat=3))
+        print(f"{name:40} {seconds / args.number * 1e6:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Run the session provisioning worker locally against a file-backed launch queue.
+
+Point create-session at the same directory with LAUNCH_QUEUE_DIR, then run:
+
+    LAUNCH_QUEUE_DIR=/tmp/launch-jobs python3 scripts/run-launch-worker.py
+
+The usual table, ASG and Guacamole environment variables must be set as for
+the deployed Lambda.
+"""
+
+import argparse
+import importlib.util
+import os
+import sys
+import time
+from pathlib import Path
+
+LAMBDA_DIR = Path(__file__).resolve().parent.parent / "lambda"
+
+
+def load_create_session():
+    """Import lambda/create-session/index.py with the common layer on the path."""
+    sys.path.insert(0, str(LAMBDA_DIR / "common"))
+    spec = importlib.util.spec_from_file_location("create_session", LAMBDA_DIR / "create-session" / "index.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queue-dir", default=os.environ.get("LAUNCH_QUEUE_DIR"), help="Launch queue spool directory")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds between polls of an empty queue")
+    parser.add_argument("--once", action="store_true", help="Drain the queue once and exit")
+    args = parser.parse_args()
+    
+    if not args.queue_dir:
+        parser.error("--queue-dir or LAUNCH_QUEUE_DIR is required")
+    os.environ["LAUNCH_QUEUE_DIR"] = args.queue_dir
+    
+    create_session = load_create_session()
+    launch_queue = create_session.get_launch_queue()
+    print(f"Provisioning worker polling {args.queue_dir}")
+    
+    while True:
+        results = create_session.process_launch_queue(launch_queue)
+        for session_id, response in results.items():
+            print(f"  {session_id}: HTTP {response.get('statusCode')}")
+        
+        if args.once:
+            break
+        if not results:
+            time.sleep(args.poll_interval)
+
+
+if __name__ == "__main__":
+    main()
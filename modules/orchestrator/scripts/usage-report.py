@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Stream a month's usage report from the usage table's MonthIndex GSI.
+
+Writes per-user rows as they are read, then per-plan aggregates (consumed
+minutes, sessions, users, quota exhaustions), the top-N heaviest users and a
+month total, as CSV or NDJSON:
+
+    python3 scripts/usage-report.py --month 2025-12 --table cyberlab-prod-usage > usage.csv
+    python3 scripts/usage-report.py --month 2025-12 --local usage-export.ndjson --format ndjson
+
+--local reads an NDJSON file (plain items or a DynamoDB export) instead of
+the table, for offline reports and testing.
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "lambda" / "common"))
+
+from utils import (  # noqa: E402
+    LocalUsageTable,
+    MonthlyUsageReport,
+    UsageTracker,
+    iter_csv,
+    iter_ndjson,
+)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--month", required=True, help="Usage month, YYYY-MM")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--table", help="Usage table name (AWS_REGION_NAME selects the region)")
+    source.add_argument("--local", help="NDJSON file of usage items to read instead of the table")
+    parser.add_argument("--format", choices=["csv", "ndjson"], default="csv")
+    parser.add_argument("--top", type=int, default=10, help="Number of heaviest users to list")
+    parser.add_argument("--page-size", type=int, default=500, help="Items per MonthIndex query page")
+    parser.add_argument("--no-users", action="store_true", help="Only write aggregates, not per-user rows")
+    args = parser.parse_args()
+
+    usage_table = LocalUsageTable(args.local) if args.local else UsageTracker(args.table)
+    report = MonthlyUsageReport(args.month, top_n=args.top)
+    records = report.iter_records(
+        usage_table.iter_month(args.month, page_size=args.page_size),
+        include_users=not args.no_users,
+    )
+
+    lines = iter_csv(records) if args.format == "csv" else iter_ndjson(records)
+    for line in lines:
+        sys.stdout.write(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -220,6 +220,36 @@ variable "idle_termination_seconds_pro" {
   default     = 3600  # 60 minutes
 }
 
+# Instance claim configuration
+variable "claim_strategy" {
+  description = "Order in which concurrent launches try AVAILABLE instances: sharded, random or ordered"
+  type        = string
+  default     = "sharded"
+
+  validation {
+    condition     = contains(["sharded", "random", "ordered"], var.claim_strategy)
+    error_message = "claim_strategy must be one of sharded, random or ordered."
+  }
+}
+
+variable "enable_claim_tickets" {
+  description = "Hand out AVAILABLE instances through the claim-ticket table (one atomic operation per claim)"
+  type        = bool
+  default     = false
+}
+
+variable "enable_session_archive" {
+  description = "Archive finished sessions to the session-history table and trim them from the sessions table"
+  type        = bool
+  default     = true
+}
+
+variable "session_archive_grace_seconds" {
+  description = "How long an archived session stays in the sessions table for status polls"
+  type        = number
+  default     = 900
+}
+
 variable "tags" {
   description = "Additional tags for resources"
   type        = map(string)
@@ -34,6 +34,7 @@ try {
     $status = optional_param('status', 'all', PARAM_ALPHA);
     $search = optional_param('search', '', PARAM_TEXT);
     $limit = optional_param('limit', 100, PARAM_INT);
+    $cursor = optional_param('cursor', '', PARAM_ALPHANUMEXT);
 
     // Get admin token (includes all permissions).
     $tokenData = $tokenManager->get_token_for_admin($USER->id);
@@ -54,6 +55,10 @@ try {
         $queryParams['search'] = $search;
     }
     $queryParams['limit'] = $limit;
+    if (!empty($cursor)) {
+        // Opaque next_cursor from the previous page.
+        $queryParams['cursor'] = $cursor;
+    }
 
     if (!empty($queryParams)) {
         $apiUrl .= '?' . http_build_query($queryParams);
@@ -0,0 +1,105 @@
+<?php
+/**
+ * AJAX endpoint to get daily or monthly AttackBox usage buckets
+ *
+ * @package    local_attackbox
+ * @copyright  2025 CyberLab
+ * @license    http://www.gnu.org/copyleft/gpl.html GNU GPL v3 or later
+ */
+
+define('AJAX_SCRIPT', true);
+
+require_once(__DIR__ . '/../../../config.php');
+require_once($CFG->dirroot . '/local/attackbox/classes/token_manager.php');
+
+require_login();
+
+header('Content-Type: application/json');
+
+try {
+    // Get plugin configuration
+    $api_url = get_config('local_attackbox', 'api_url');
+
+    if (empty($api_url)) {
+        throw new moodle_exception('API URL not configured');
+    }
+
+    // Range parameters (the orchestrator applies defaults and validates)
+    $granularity = optional_param('granularity', 'month', PARAM_ALPHA);
+    $from = optional_param('from', '', PARAM_RAW_TRIMMED);
+    $to = optional_param('to', '', PARAM_RAW_TRIMMED);
+
+    $query_params = ['granularity' => $granularity];
+    if (preg_match('/^\d{4}-\d{2}(-\d{2})?$/', $from)) {
+        $query_params['from'] = $from;
+    }
+    if (preg_match('/^\d{4}-\d{2}(-\d{2})?$/', $to)) {
+        $query_params['to'] = $to;
+    }
+
+    // Generate token
+    $token_manager = new \local_attackbox\token_manager();
+    $token = $token_manager->generate_token($USER);
+
+    // Call orchestrator API for usage buckets
+    $range_url = rtrim($api_url, '/') . '/sessions/usage?' . http_build_query($query_params);
+
+    $ch = curl_init($range_url);
+    curl_setopt_array($ch, [
+        CURLOPT_RETURNTRANSFER => true,
+        CURLOPT_HTTPHEADER => [
+            'X-Moodle-Token: ' . $token,
+            'Content-Type: application/json',
+        ],
+        CURLOPT_TIMEOUT => 10,
+        CURLOPT_SSL_VERIFYPEER => true,
+    ]);
+
+    $response = curl_exec($ch);
+    $http_code = curl_getinfo($ch, CURLINFO_HTTP_CODE);
+    $error = curl_error($ch);
+    curl_close($ch);
+
+    if ($error) {
+        throw new moodle_exception('API connection error: ' . $error);
+    }
+
+    if ($http_code !== 200) {
+        $error_data = json_decode($response, true);
+        $error_message = $error_data['message'] ?? 'Unknown error';
+        http_response_code($http_code);
+        echo json_encode([
+            'error' => true,
+            'message' => $error_message,
+            'http_code' => $http_code,
+        ]);
+        exit;
+    }
+
+    // Parse response
+    $data = json_decode($response, true);
+
+    if (!$data || !isset($data['data'])) {
+        throw new moodle_exception('Invalid API response');
+    }
+
+    $range = $data['data'];
+
+    echo json_encode([
+        'success' => true,
+        'granularity' => $range['granularity'] ?? $granularity,
+        'from' => $range['from'] ?? '',
+        'to' => $range['to'] ?? '',
+        'buckets' => $range['buckets'] ?? [],
+        'total_minutes' => $range['total_minutes'] ?? 0,
+        'total_sessions' => $range['total_sessions'] ?? 0,
+        'total_hours' => round(($range['total_minutes'] ?? 0) / 60, 1),
+    ]);
+
+} catch (Exception $e) {
+    http_response_code(500);
+    echo json_encode([
+        'error' => true,
+        'message' => $e->getMessage(),
+    ]);
+}
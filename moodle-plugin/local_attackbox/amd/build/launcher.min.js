@@ -1218,11 +1218,12 @@ define(["jquery", "core/str"], function ($, Str) {
         this.updateProgress(5, this.strings.progress5);
         const tokenData = await this.getToken();
 
-        // Step 2: Create session
+        // Step 2: Create session (one idempotency key per launch, shared by its retries)
         this.updateProgress(10, this.strings.progress10);
         const sessionData = await this.createSession(
           tokenData.token,
-          tokenData.api_url
+          tokenData.api_url,
+          this.newIdempotencyKey()
         );
 
         // API returns { success, message, data, timestamp }
@@ -1286,15 +1287,32 @@ define(["jquery", "core/str"], function ($, Str) {
       return data;
     }
 
+    /**
+     * Generate a key identifying one launch to the orchestrator
+     */
+    newIdempotencyKey() {
+      if (window.crypto && window.crypto.randomUUID) {
+        return window.crypto.randomUUID();
+      }
+      return (
+        Date.now().toString(36) + "-" + Math.random().toString(36).slice(2)
+      );
+    }
+
     /**
      * Create a session via the orchestrator API
+     *
+     * A network failure is retried once with the same Idempotency-Key, so the
+     * orchestrator returns the first attempt's session instead of launching again.
+     * Tokens are single-use, so the retry fetches a fresh one.
      */
-    async createSession(token, apiUrl) {
-      const response = await fetch(apiUrl + "/sessions", {
+    async createSession(token, apiUrl, idempotencyKey) {
+      const request = {
         method: "POST",
         headers: {
           "Content-Type": "application/json",
           "X-Moodle-Token": token,
+          "Idempotency-Key": idempotencyKey,
         },
         body: JSON.stringify({
           student_id: String(this.config.userId),
@@ -1304,7 +1322,17 @@ define(["jquery", "core/str"], function ($, Str) {
             page_url: window.location.href,
           },
         }),
-      });
+      };
+
+      let response;
+      try {
+        response = await fetch(apiUrl + "/sessions", request);
+      } catch (error) {
+        console.warn("Launch request failed, retrying once:", error);
+        const retryToken = await this.getToken();
+        request.headers["X-Moodle-Token"] = retryToken.token;
+        response = await fetch(apiUrl + "/sessions", request);
+      }
 
       if (!response.ok) {
         const errorData = await response.json().catch(() => ({}));
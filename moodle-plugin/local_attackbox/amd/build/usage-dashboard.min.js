@@ -40,6 +40,7 @@ define(["jquery"], function ($) {
      */
     init() {
       this.loadUsageData();
+      this.loadUsageTrend();
       this.loadSessionHistory();
     }
 
@@ -78,6 +79,44 @@ define(["jquery"], function ($) {
       }
     }
 
+    /**
+     * Load monthly usage buckets for the trend chart
+     */
+    async loadUsageTrend() {
+      try {
+        const params = new URLSearchParams({
+          sesskey: this.config.sesskey,
+          granularity: "month",
+        });
+
+        const response = await fetch(
+          M.cfg.wwwroot + "/local/attackbox/ajax/get_usage_range.php?" + params,
+          {
+            method: "GET",
+            credentials: "same-origin",
+            headers: {
+              Accept: "application/json",
+            },
+          }
+        );
+
+        if (!response.ok) {
+          throw new Error("Failed to load usage trend");
+        }
+
+        const data = await response.json();
+
+        if (!data.success) {
+          throw new Error(data.message || "Failed to load usage trend");
+        }
+
+        this.renderUsageChart(data.buckets || []);
+      } catch (error) {
+        console.error("Error loading usage trend:", error);
+        this.showError("#usage-chart", error.message);
+      }
+    }
+
     /**
      * Load session history
      */
@@ -174,6 +213,69 @@ define(["jquery"], function ($) {
       container.html(html);
     }
 
+    /**
+     * Render usage buckets as a bar chart of hours per period
+     */
+    renderUsageChart(buckets) {
+      const canvas = document.getElementById("usageCanvas");
+      if (!canvas || !canvas.getContext) return;
+
+      const width = canvas.parentElement.clientWidth || 600;
+      const height = 220;
+      const ratio = window.devicePixelRatio || 1;
+      canvas.width = width * ratio;
+      canvas.height = height * ratio;
+      canvas.style.width = width + "px";
+      canvas.style.height = height + "px";
+
+      const ctx = canvas.getContext("2d");
+      ctx.scale(ratio, ratio);
+      ctx.clearRect(0, 0, width, height);
+
+      const styles = getComputedStyle(canvas);
+      const barColor =
+        styles.getPropertyValue("--dashboard-primary").trim() || "#2196f3";
+      const textColor =
+        styles.getPropertyValue("--dashboard-text").trim() || "#333";
+
+      const hours = buckets.map((bucket) => bucket.minutes / 60);
+      const maxHours = Math.max(1, ...hours);
+      const top = 20;
+      const bottom = 24;
+      const plotHeight = height - top - bottom;
+      const slot = width / Math.max(1, buckets.length);
+      const barWidth = Math.max(4, slot * 0.6);
+
+      ctx.font = "11px sans-serif";
+      ctx.textAlign = "center";
+
+      buckets.forEach((bucket, i) => {
+        const x = i * slot + (slot - barWidth) / 2;
+        const barHeight = (hours[i] / maxHours) * plotHeight;
+
+        ctx.fillStyle = barColor;
+        ctx.fillRect(x, top + plotHeight - barHeight, barWidth, barHeight);
+
+        ctx.fillStyle = textColor;
+        if (hours[i] > 0) {
+          ctx.fillText(
+            hours[i].toFixed(1) + "h",
+            x + barWidth / 2,
+            top + plotHeight - barHeight - 4
+          );
+        }
+        // Months (YYYY-MM) are labelled by name, days (YYYY-MM-DD) by number
+        const label =
+          bucket.period.length === 7
+            ? new Date(bucket.period + "-01T00:00:00Z").toLocaleString(
+                "en-US",
+                { month: "short", timeZone: "UTC" }
+              )
+            : bucket.period.slice(8);
+        ctx.fillText(label, x + barWidth / 2, height - 8);
+      });
+    }
+
     /**
      * Render session history table
      */
@@ -29,6 +29,8 @@ define(["jquery", "core/ajax", "core/notification"], function (
       this.sessions = [];
       this.filteredSessions = [];
       this.autoRefreshInterval = null;
+      this.nextCursor = null;
+      this.pagesLoaded = 0;
     }
 
     /**
@@ -49,9 +51,9 @@ define(["jquery", "core/ajax", "core/notification"], function (
         this.loadSessions();
       });
 
-      // Status filter
+      // Status filter (served by the status index, so reload from page one)
       $("#status-filter").on("change", () => {
-        this.applyFilters();
+        this.loadSessions();
       });
 
       // Search filter
@@ -61,10 +63,18 @@ define(["jquery", "core/ajax", "core/notification"], function (
     }
 
     /**
-     * Load all sessions from API
+     * Load sessions from API
+     *
+     * @param {boolean} append Fetch the next page and append it instead of reloading
      */
-    async loadSessions() {
-      this.showLoading(true);
+    async loadSessions(append = false) {
+      if (append && !this.nextCursor) {
+        return;
+      }
+
+      if (!append) {
+        this.showLoading(true);
+      }
       this.hideError();
 
       try {
@@ -77,6 +87,9 @@ define(["jquery", "core/ajax", "core/notification"], function (
           search: search || "",
           limit: 200,
         });
+        if (append) {
+          params.set("cursor", this.nextCursor);
+        }
 
         const response = await fetch(
           `${this.config.wwwroot}/local/attackbox/ajax/get_all_sessions.php?${params}`,
@@ -99,10 +112,12 @@ define(["jquery", "core/ajax", "core/notification"], function (
           throw new Error(data.message || "Failed to load sessions");
         }
 
-        this.sessions = data.data.sessions || [];
-        this.filteredSessions = this.sessions;
+        const page = data.data.sessions || [];
+        this.sessions = append ? this.sessions.concat(page) : page;
+        this.nextCursor = data.data.next_cursor || null;
+        this.pagesLoaded = append ? this.pagesLoaded + 1 : 1;
         this.renderStats(data.data);
-        this.renderSessionsTable();
+        this.applyFilters();
       } catch (error) {
         console.error("Error loading sessions:", error);
         this.showError(error.message);
@@ -185,7 +200,7 @@ define(["jquery", "core/ajax", "core/notification"], function (
     renderSessionsTable() {
       const container = $("#sessions-table-container");
 
-      if (this.filteredSessions.length === 0) {
+      if (this.filteredSessions.length === 0 && !this.nextCursor) {
         container.html('<p class="no-sessions">No sessions found</p>');
         return;
       }
@@ -275,8 +290,23 @@ define(["jquery", "core/ajax", "core/notification"], function (
                 </table>
             `;
 
+      if (this.nextCursor) {
+        html += `
+                <div class="load-more">
+                    <button id="load-more-sessions" class="btn btn-secondary">
+                        Load more
+                    </button>
+                </div>
+            `;
+      }
+
       container.html(html);
 
+      $("#load-more-sessions").on("click", (e) => {
+        $(e.target).prop("disabled", true);
+        this.loadSessions(true);
+      });
+
       // Attach terminate button handlers
       $(".terminate-btn").on("click", (e) => {
         const sessionId = $(e.target).data("session-id");
@@ -432,9 +462,11 @@ define(["jquery", "core/ajax", "core/notification"], function (
      * Start auto-refresh
      */
     startAutoRefresh() {
-      // Refresh every 30 seconds
+      // Refresh every 30 seconds, unless the admin has paged further back
       this.autoRefreshInterval = setInterval(() => {
-        this.loadSessions();
+        if (this.pagesLoaded <= 1) {
+          this.loadSessions();
+        }
       }, 30000);
     }
 
@@ -43,7 +43,7 @@ $string['settings:sessionheading_desc'] = 'Configure session behavior and timeou
 $string['settings:session_ttl'] = 'Session Duration (hours)';
 $string['settings:session_ttl_desc'] = 'How long a LynkBox session remains active (for display purposes only, actual TTL is controlled by the API).';
 $string['settings:token_validity'] = 'Token Validity (seconds)';
-$string['settings:token_validity_desc'] = 'How long an authentication token remains valid. Recommended: 300 seconds (5 minutes).';
+$string['settings:token_validity_desc'] = 'How long an authentication token remains valid. Recommended: 300 seconds (5 minutes). The orchestrator rejects tokens valid for longer than its MOODLE_TOKEN_MAX_AGE (default 3600 seconds).';
 $string['settings:quotaheading'] = 'Role-based quotas';
 $string['settings:quotaheading_desc'] = 'Map Moodle roles to LynkBox plans and monthly time allowances.';
 $string['settings:role_freemium'] = 'Freemium role shortname';
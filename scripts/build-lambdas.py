@@ -84,6 +84,7 @@ def main():
         "usage-history",
         "admin-sessions",
         "session-heartbeat",
+        "session-stats",
         "websocket-connect",
         "websocket-disconnect",
         "websocket-default",